@@ -34,6 +34,7 @@ HELP_DICT = {
     'genomeDir': 'Required. Genome directory after running `celescope {assay} mkref`.',
     'thread': 'Thread to use.',
     'debug': 'If this argument is used, celescope may output addtional file for debugging.',
+    'resume': 'Skip the step if its arguments, input files and output files have not changed since the last successful run.',
     'fasta': 'Required. Genome fasta file. Use absolute path or relative path to `genomeDir`.',
     'outdir': 'Output directory.',
     'matrix_dir': 'Match celescope scRNA-Seq matrix directory.',
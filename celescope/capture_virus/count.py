@@ -7,16 +7,14 @@ import pandas as pd
 from celescope.tools.count import Count as Ct
 from celescope.tools import utils
 from celescope.tools.step import Step, s_common
-from celescope.tools import reference
+from celescope.tools.gtf_index import load_gtf_annotation
 from celescope.tools.matrix import CountMatrix
 
 class Count(Step):
     def __init__(self, args, display_title=None):
         Step.__init__(self, args, display_title=display_title)
         self.bam = args.bam
-        gp = reference.GtfParser(args.gtf)
-        gp.get_id_name()
-        self.features = gp.get_features()
+        self.features = load_gtf_annotation(args.gtf).get_features()
 
         self.count_detail_file = f'{self.outdir}/{self.sample}_count_detail.txt'
         self.matrix_dir = f'{self.outdir}/{self.sample}_virus_matrix'
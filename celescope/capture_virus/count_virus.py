@@ -12,7 +12,7 @@ class Count_virus(Count_bam):
     - Taking the bam file as input, count the number of UMIs and reads mapped to the viral genome.
 
     ## Output
-    - {sample_raw_read_count.json} : barcode - UMI - raw_reads_count
+    - {sample_raw_read_count.json} : barcode - UMI - raw_reads_count. `.npz` if `--read_count_format npz`.
     """
 
 
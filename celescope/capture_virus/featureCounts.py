@@ -1,11 +1,12 @@
-import json
 import collections
 
+import numpy as np
 import pandas as pd
 import pysam
 
 from celescope.tools.featureCounts import FeatureCounts as Fc
 from celescope.tools import utils
+from celescope.tools.capture.read_count import ReadCount
 from celescope.tools.step import Step, s_common
 from celescope.__init__ import HELP_DICT
 
@@ -26,16 +27,15 @@ class FeatureCounts(Step):
         return valid_barcodes
 
     @staticmethod
-    def get_valid_umis(filter_read_count_json, valid_barcodes):
+    def get_valid_umis(filter_read_count_file, valid_barcodes):
         barcode_umis = collections.defaultdict(set)
-        with open(filter_read_count_json) as fh:
-            dic = json.load(fh)
-        for barcode in dic:
-            if barcode in valid_barcodes:
-                for ref in dic[barcode]:
-                    for umi in dic[barcode][ref]:
-                        if dic[barcode][ref][umi] > 0:
-                            barcode_umis[barcode].add(umi)
+        read_count = ReadCount.read(filter_read_count_file)
+        bool_barcode = np.isin(read_count.barcodes, list(valid_barcodes))
+        bool_valid = bool_barcode[read_count.barcode_index] & (read_count.read_count > 0)
+        barcodes = read_count.barcodes[read_count.barcode_index[bool_valid]].tolist()
+        umis = read_count.umis[read_count.umi_index[bool_valid]].tolist()
+        for barcode, umi in zip(barcodes, umis):
+            barcode_umis[barcode].add(umi)
         return barcode_umis
 
     def run_filter(self):
@@ -120,6 +120,7 @@ def get_opts_featureCounts(parser, sub_program):
     if sub_program:
         parser.add_argument('--bam', help='input bam file', required=True)
         parser.add_argument('--filter_umi_file', help='filter umi file', required=True)
-        parser.add_argument('--filter_read_count_json', help='filter_read_count_json file', required=True)
+        parser.add_argument(
+            '--filter_read_count_json', help='Filtered read count file(`.json` or `.npz`).', required=True)
         parser.add_argument('--featureCounts_param', help=HELP_DICT['additional_param'], default="")
         s_common(parser)
\ No newline at end of file
@@ -51,7 +51,8 @@ class Multi_capture_virus(Multi):
     def filter_virus(self, sample):
         step = 'filter_virus'
         cmd_line = self.get_cmd_line(step, sample)
-        raw_read_count_file = f'{self.outdir_dic[sample]["count_virus"]}/{sample}_raw_read_count.json'
+        raw_read_count_file = (
+            f'{self.outdir_dic[sample]["count_virus"]}/{sample}_raw_read_count.{self.args.read_count_format}')
         cmd = (
             f'{cmd_line} '
             f'--match_dir {self.col4_dict[sample]} '
@@ -74,7 +75,8 @@ class Multi_capture_virus(Multi):
         step = 'featureCounts'
         cmd_line = self.get_cmd_line(step, sample)
         filter_umi_file = f'{self.outdir_dic[sample]["filter_virus"]}/{sample}_filtered_UMI.csv'
-        filter_read_count_json = f'{self.outdir_dic[sample]["filter_virus"]}/{sample}_filtered_read_count.json'
+        filter_read_count_json = (
+            f'{self.outdir_dic[sample]["filter_virus"]}/{sample}_filtered_read_count.{self.args.read_count_format}')
         bam = f'{self.outdir_dic[sample]["star_virus"]}/{sample}_virus_Aligned.sortedByCoord.out.bam'
         cmd = (
             f'{cmd_line} '
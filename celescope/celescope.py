@@ -1,45 +1,48 @@
 import argparse
+import sys
 
-from celescope.tools import utils
 from celescope.__init__ import __VERSION__, ASSAY_LIST
+from celescope.tools import cli_registry
+from celescope.tools.cli_registry import ArgFormatter
 
 
-class ArgFormatter(argparse.ArgumentDefaultsHelpFormatter, argparse.RawTextHelpFormatter):
-    pass
-
-
-def main():
+def main(argv=None):
     """celescope cli
+    Only the requested step module is imported. See celescope.tools.cli_registry.
     """
+    if argv is None:
+        argv = sys.argv[1:]
+    requested_assay, requested_step = cli_registry.get_requested(argv)
+    help_only = any(arg in cli_registry.HELP_FLAGS for arg in argv[2:])
+
     parser = argparse.ArgumentParser(description='CeleScope', formatter_class=ArgFormatter)
     parser.add_argument('-v', '--version', action='version', version=__VERSION__)
     subparsers = parser.add_subparsers(dest='subparser_assay')
 
     for assay in ASSAY_LIST:
-        text = utils.get_assay_text(assay)
+        text = cli_registry.get_assay_text(assay)
         subparser_1st = subparsers.add_parser(assay, description=text)
 
         # add 2ed subparser
         subparser_2nd = subparser_1st.add_subparsers()
+        if assay != requested_assay:
+            continue
+
+        for step in cli_registry.get_steps(assay):
+            if step == requested_step:
+                cli_registry.add_step_parser(subparser_2nd, assay, step, help_only=help_only)
+            else:
+                subparser_2nd.add_parser(step, formatter_class=ArgFormatter)
 
-        # import __STEPS__
-        init_module = utils.find_assay_init(assay)
-        __STEPS__ = init_module.__STEPS__
-
-        for step in __STEPS__:
-            # import function and opts
-            step_module = utils.find_step_module(assay, step)
-            func = getattr(step_module, step)
-            func_opts = getattr(step_module, f"get_opts_{step}")
-            parser_step = subparser_2nd.add_parser(step, formatter_class=ArgFormatter)
-            func_opts(parser_step, sub_program=True)
-            parser_step.set_defaults(func=func)
-
-    args = parser.parse_args()
-    if len(args.__dict__) <= 1:
+    args = parser.parse_args(argv)
+    if not hasattr(args, 'func'):
         # No arguments or subcommands were given.
         parser.print_help()
         parser.exit()
+    elif getattr(args, 'resume', False):
+        # imported here to keep help output fast
+        from celescope.tools.step_cache import StepCache
+        StepCache(args, requested_assay, requested_step).run(args.func)
     else:
         args.func(args)
 
@@ -1,11 +1,28 @@
-import pysam
-
 import pandas as pd
 
+from celescope.tools import utils
+from celescope.tools.bam_count import ReadParser, count_reads
 from celescope.tools.capture.count_bam import Count_bam, get_opts_count_bam
 from celescope.fusion.mkref import Mkref_fusion
 
 
+class FusionReadParser(ReadParser):
+    """
+    Keep reads that include flanking_base bases on both sides of the fusion position.
+    """
+
+    def __init__(self, pos_dict, flanking_base):
+        self.pos_dict = pos_dict
+        self.flanking_base = flanking_base
+
+    def parse(self, read):
+        pos = self.pos_dict[read.reference_name]
+        left_bases = read.get_overlap(pos - self.flanking_base, pos)
+        right_bases = read.get_overlap(pos, pos + self.flanking_base)
+        if left_bases < self.flanking_base or right_bases < self.flanking_base:
+            return None
+        return super().parse(read)
+
 
 class Count_fusion(Count_bam):
     """
@@ -35,35 +52,23 @@ class Count_fusion(Count_bam):
             pos_dict[name] = pos
         return pos_dict
 
+    @utils.add_log
     def process_bam(self):
         """
         find valid fusion reads
             1. flank the fusion position
             2. match barcode
+        Fusion regions are counted in parallel.
         """
-
-        with pysam.AlignmentFile(self.capture_bam, "rb") as bam:
-            header = bam.header
-            with pysam.AlignmentFile(self.fusion_bam, "wb", header=header) as fusion_bam:
-                for ref in self.pos_dict:
-                    pos = self.pos_dict[ref]
-                    left = pos - self.flanking_base
-                    right = pos + self.flanking_base
-                    for read in bam.fetch(
-                        reference=ref,
-                        start=left,
-                        end=right,
-                    ):
-                        left_bases = read.get_overlap(left, pos)
-                        right_bases = read.get_overlap(pos, right)
-                        if left_bases < self.flanking_base or right_bases < self.flanking_base:
-                            continue
-                        attr = read.query_name.split("_")
-                        barcode = attr[0]
-                        umi = attr[1]
-                        if barcode in self.match_barcode:
-                            fusion_bam.write(read)
-                            self.count_dict[barcode][ref][umi] += 1
+        regions = [(ref, pos - self.flanking_base, pos + self.flanking_base) for ref, pos in self.pos_dict.items()]
+        self.counts = count_reads(
+            self.capture_bam,
+            self.match_barcode,
+            parser=FusionReadParser(self.pos_dict, self.flanking_base),
+            thread=self.thread,
+            regions=regions,
+            out_bam=self.fusion_bam,
+        )
 
 
 def count_fusion(args):
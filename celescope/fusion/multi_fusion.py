@@ -50,7 +50,8 @@ class Multi_fusion(Multi):
     def filter_fusion(self, sample):
         step = 'filter_fusion'
         cmd_line = self.get_cmd_line(step, sample)
-        raw_read_count_file = f'{self.outdir_dic[sample]["count_fusion"]}/{sample}_raw_read_count.json'
+        raw_read_count_file = (
+            f'{self.outdir_dic[sample]["count_fusion"]}/{sample}_raw_read_count.{self.args.read_count_format}')
         cmd = (
             f'{cmd_line} '
             f'--match_dir {self.col4_dict[sample]} '
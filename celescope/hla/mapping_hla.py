@@ -7,6 +7,7 @@ import pysam
 
 import celescope
 from celescope.tools.utils import add_log, get_barcode_from_match_dir
+from celescope.tools.bam_count import ReadParser, UmiCounter
 
 
 @add_log
@@ -45,12 +46,13 @@ def split_bam(out_bam, barcodes, outdir, sample):
         barcodes: cell barcodes
     ouput:
         bam_dict: assign reads to cell barcodes and UMI
-        count_dict: UMI counts per cell
+        UMI count file: read counts per cell and UMI
         index: assign index(1-based) to cells
     '''
 
     # init
-    count_dict = defaultdict(dict)
+    counter = UmiCounter(barcodes)
+    parser = ReadParser()
     bam_dict = defaultdict(dict)
     index_dict = defaultdict(dict)
     cells_dir = f'{outdir}/cells/'
@@ -60,17 +62,11 @@ def split_bam(out_bam, barcodes, outdir, sample):
     samfile = pysam.AlignmentFile(out_bam, "rb")
     header = samfile.header
     for read in samfile:
-        attr = read.query_name.split('_')
-        barcode = attr[0]
-        umi = attr[1]
-        if barcode in barcodes:
+        barcode, _ref, umi = parser.parse(read)
+        if counter.add(barcode, None, umi):
             # keep one read for each UMI
             if umi not in bam_dict[barcode]:
                 bam_dict[barcode][umi] = read
-            if umi in count_dict[barcode]:
-                count_dict[barcode][umi] += 1
-            else:
-                count_dict[barcode][umi] = 1
 
     split_bam.logger.info('writing cell bam...')
     # write new bam
@@ -101,14 +97,11 @@ def split_bam(out_bam, barcodes, outdir, sample):
     index_file = f'{outdir}/{sample}_cell_index.tsv'
     df_index.to_csv(index_file, sep='\t')
 
-    # out count_dict
-    df_count = pd.DataFrame(count_dict).T
-    df_temp = df_count.stack()
-    df_temp = df_temp.astype(int)
-    df_temp = df_temp.reset_index()
-    df_temp.columns = ['barcode', 'UMI', 'read_count']
+    # out UMI counts
+    df_count = counter.get_counts().to_df()
+    df_count = df_count[['barcode', 'UMI', 'read_count']]
     count_file = f'{outdir}/{sample}_UMI_count.tsv'
-    df_temp.to_csv(count_file, sep='\t', index=False)
+    df_count.to_csv(count_file, sep='\t', index=False)
 
     return index_file, count_file
 
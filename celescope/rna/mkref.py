@@ -1,4 +1,6 @@
 from celescope.tools import utils
+from celescope.tools.__init__ import GTF_INDEX_DIR
+from celescope.tools.gtf_index import get_annotation
 from celescope.tools.mkref import Mkref, super_opts
 
 
@@ -20,6 +22,9 @@ class Mkref_rna(Mkref):
 
     - STAR genome index files
 
+    - `celescope_gtf_index` Compiled GTF annotation used by `featureCounts` and `count`. It is rebuilt by these steps
+    if the GTF file changes.
+
     - Genome config file
     ```
     $ cat celescope_genome.config
@@ -54,10 +59,15 @@ class Mkref_rna(Mkref):
         return Mkref.parse_genomeDir(genomeDir, files=('gtf', 'mt_gene_list'))
 
 
+    @utils.add_log
+    def build_gtf_index(self):
+        get_annotation(self.gtf, GTF_INDEX_DIR)
+
     @utils.add_log
     def run(self):
         super().run()
         self.build_star_index()
+        self.build_gtf_index()
 
 
 
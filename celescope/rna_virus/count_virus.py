@@ -1,50 +1,22 @@
 import logging
 import os
-from collections import defaultdict
 
 import pandas as pd
-import pysam
 
 from celescope.tools.utils import add_log
 from celescope.tools.step import s_common
-
-
-def genDict(dim=3):
-    if dim == 1:
-        return defaultdict(int)
-    else:
-        return defaultdict(lambda: genDict(dim - 1))
+from celescope.tools.bam_count import count_reads
 
 
 def sum_virus(validated_barcodes, virus_bam,
-              out_read_count_file, out_umi_count_file):
+              out_read_count_file, out_umi_count_file, thread=1):
     # process bam
-    samfile = pysam.AlignmentFile(virus_bam, "rb")
-    count_dic = genDict(dim=3)
-    for read in samfile:
-        tag = read.reference_name
-        attr = read.query_name.split('_')
-        barcode = attr[0]
-        umi = attr[1]
-        if barcode in validated_barcodes:
-            count_dic[barcode][tag][umi] += 1
-
-    # write dic to pandas df
-    rows = []
-    for barcode in count_dic:
-        for tag in count_dic[barcode]:
-            for umi in count_dic[barcode][tag]:
-                rows.append([barcode, tag, umi, count_dic[barcode][tag][umi]])
-    if len(rows) == 0:
+    counts = count_reads(virus_bam, validated_barcodes, thread=thread)
+    if len(counts) == 0:
         logging.warning("No cell virus UMI found!")
 
-    df_read = df_read = pd.DataFrame(
-        rows,
-        columns=[
-            "barcode",
-            "tag",
-            "UMI",
-            "read_count"])
+    # write counts to pandas df
+    df_read = counts.to_df().rename(columns={'feature': 'tag'})
     df_read.to_csv(out_read_count_file, sep="\t", index=False)
 
     df_umi = df_read.groupby(["barcode", "tag"]).agg({"UMI": "count"})
@@ -69,7 +41,8 @@ def count_virus(args):
         validated_barcodes,
         args.virus_bam,
         out_read_count_file,
-        out_umi_count_file)
+        out_umi_count_file,
+        thread=int(args.thread))
 
 
 def get_opts_count_virus(parser, sub_program):
@@ -2,11 +2,14 @@
 assign cell identity based on SNR and UMI_min
 """
 
+import unittest
+
 from celescope.__init__ import ROOT_PATH, HELP_DICT
 from celescope.tools.step import Step, s_common
 from celescope.tools import utils
 import pandas as pd
 import numpy as np
+import scipy.sparse
 import matplotlib.pyplot as plt
 
 import matplotlib
@@ -115,11 +118,38 @@ class Count_tag(Step):
     def get_UMI(row):
         return row.sum()
 
+    @staticmethod
+    def get_UMI_matrix(df_read_count, barcodes):
+        """
+        Args:
+            df_read_count: read count table indexed by barcode. Columns: tag, UMI, read_count.
+            barcodes: cell barcodes.
+        Returns:
+            UMI_matrix: scipy.sparse.csr_matrix of cell x tag UMI counts.
+            tags: sorted tag names of matrix columns.
+        """
+        tag_name = df_read_count.columns[0]
+        sr_UMI = df_read_count.reset_index().groupby(['barcode', tag_name])['UMI'].count()
+        tag_index, tags = pd.factorize(sr_UMI.index.get_level_values(tag_name), sort=True)
+        barcode_index = pd.Index(barcodes).get_indexer(sr_UMI.index.get_level_values('barcode'))
+        UMI_matrix = scipy.sparse.csr_matrix(
+            (sr_UMI.to_numpy(dtype=np.int64), (barcode_index, tag_index)), shape=(len(barcodes), len(tags)))
+        return UMI_matrix, list(tags)
+
+    @staticmethod
+    def get_UMIs(matrix):
+        """
+        Args:
+            matrix: cell x tag UMI counts. DataFrame, 2D array or scipy sparse matrix.
+        """
+        return np.asarray(matrix.sum(axis=1)).ravel()
+
     @staticmethod
     def get_UMI_min(df_cell_UMI, UMI_min):
         if UMI_min == "auto":
-            UMI_min1 = np.percentile(df_cell_UMI.sum(axis=1), 5)
-            UMI_min2 = np.median(df_cell_UMI.sum(axis=1)) / 10
+            UMIs = Count_tag.get_UMIs(df_cell_UMI)
+            UMI_min1 = np.percentile(UMIs, 5)
+            UMI_min2 = np.median(UMIs) / 10
             UMI_min = int(min(UMI_min1, UMI_min2))
             UMI_min = max(UMI_min, 1)
             return UMI_min
@@ -137,17 +167,77 @@ class Count_tag(Step):
             return np.inf
         return float(signal) / noise
 
+    @staticmethod
+    def get_top_tags(matrix, dim):
+        """
+        Top dim + 1 UMI counts of each cell with a partial sort. Equal counts are ordered by tag(column) order.
+
+        Args:
+            matrix: cell x tag UMI counts. 2D array or scipy sparse matrix. Sparse matrix is not densified.
+        Returns:
+            top_values: (n_cell, dim + 1) array of descending UMI counts. 0 if there are not enough tags.
+            top_tags: (n_cell, dim + 1) array of tag indices of top_values. -1 if not known, i.e. a tag with 0 UMI
+                which is not stored in the sparse matrix, or not enough tags.
+        """
+        n_cell, n_tag = matrix.shape
+        k = dim + 1
+        top_keys = np.full((n_cell, k), -1, dtype=np.int64)
+        # unique sort key: UMI count first, then smaller tag index first
+        if scipy.sparse.issparse(matrix):
+            matrix = scipy.sparse.csr_matrix(matrix, copy=True)
+            matrix.sum_duplicates()
+            matrix.eliminate_zeros()
+            rows = np.repeat(np.arange(n_cell), np.diff(matrix.indptr))
+            keys = matrix.data.astype(np.int64) * n_tag + (n_tag - 1 - matrix.indices)
+            order = np.lexsort((-keys, rows))
+            rows = rows[order]
+            ranks = np.arange(len(rows)) - matrix.indptr[rows]
+            bool_top = ranks < k
+            top_keys[rows[bool_top], ranks[bool_top]] = keys[order][bool_top]
+        elif n_tag > 0:
+            keys = np.asarray(matrix, dtype=np.int64) * n_tag + (n_tag - 1 - np.arange(n_tag))
+            n_top = min(k, n_tag)
+            if n_top < n_tag:
+                keys = -np.partition(-keys, n_top - 1, axis=1)[:, :n_top]
+            top_keys[:, :n_top] = -np.sort(-keys, axis=1)[:, :n_top]
+
+        bool_known = top_keys >= 0
+        top_values = np.where(bool_known, top_keys // max(n_tag, 1), 0)
+        top_tags = np.where(bool_known, n_tag - 1 - top_keys % max(n_tag, 1), -1)
+        return top_values, top_tags
+
+    @staticmethod
+    def get_SNRs(top_values, dim):
+        """
+        Vectorized `get_SNR` from the output of `get_top_tags`
+        """
+        signal = top_values[:, dim - 1]
+        noise = top_values[:, dim]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            SNRs = np.where(noise == 0, np.inf, signal / noise)
+        SNRs[signal == 0] = 0
+        return SNRs
+
     @utils.add_log
-    def get_SNR_min(self, df_cell_UMI, SNR_min, UMI_min):
-        UMIs = df_cell_UMI.apply(Count_tag.get_UMI, axis=1)
-        df_valid_cell_UMI = df_cell_UMI[UMIs >= UMI_min]
+    def get_SNR_min(self, matrix, SNR_min, UMI_min):
+        """
+        Args:
+            matrix: cell x tag UMI counts. DataFrame, 2D array or scipy sparse matrix.
+        """
+        if isinstance(matrix, pd.DataFrame):
+            matrix = matrix.values
+        elif scipy.sparse.issparse(matrix):
+            matrix = scipy.sparse.csr_matrix(matrix)
+        UMIs = Count_tag.get_UMIs(matrix)
+        valid_matrix = matrix[UMIs >= UMI_min]
         if SNR_min == "auto":
             # no noise
-            if df_valid_cell_UMI.shape[1] <= self.dim:
+            if valid_matrix.shape[1] <= self.dim:
                 Count_tag.get_SNR_min.logger.warning('*** No NOISE FOUND! ***')
                 self.no_noise = True
                 return 0
-            SNRs = df_valid_cell_UMI.apply(Count_tag.get_SNR, dim=self.dim, axis=1)
+            top_values, _top_tags = Count_tag.get_top_tags(valid_matrix, self.dim)
+            SNRs = Count_tag.get_SNRs(top_values, self.dim)
             if np.median(SNRs) == np.inf:
                 return 10
             return max(np.median(SNRs) * self.coefficient, 2)
@@ -170,6 +260,66 @@ class Count_tag(Step):
         signal_tags_str = "_".join(signal_tags)
         return signal_tags_str
 
+    @staticmethod
+    def get_tag_types(matrix, tags, UMI_min, SNR_min, dim, no_noise=False):
+        """
+        Vectorized `tag_type` of all cells.
+
+        Args:
+            matrix: cell x tag UMI counts. 2D array or scipy sparse matrix.
+            tags: tag names of matrix columns.
+        Returns:
+            tag_types: array of tag type of each cell.
+            tag_type_count: dict of cell number of each tag type. 
+                'Undetermined' and 'Multiplet' first, then signal tags in alphabetical order.
+        """
+        if scipy.sparse.issparse(matrix):
+            matrix = scipy.sparse.csr_matrix(matrix)
+        tags = np.asarray(tags, dtype=object)
+        top_values, top_tags = Count_tag.get_top_tags(matrix, dim)
+        if no_noise:
+            SNRs = np.ones(len(top_values))
+        else:
+            SNRs = Count_tag.get_SNRs(top_values, dim)
+        UMIs = Count_tag.get_UMIs(matrix)
+        bool_undetermined = UMIs < UMI_min
+        bool_multiplet = ~bool_undetermined & (SNRs < SNR_min)
+        bool_signal = ~bool_undetermined & ~bool_multiplet
+
+        signal_tags = top_tags[bool_signal, :dim]
+        # tags with 0 UMI not stored in the sparse matrix
+        unknown_rows = np.flatnonzero((signal_tags == -1).any(axis=1))
+        if len(unknown_rows):
+            dense_rows = matrix[np.flatnonzero(bool_signal)[unknown_rows]]
+            if scipy.sparse.issparse(dense_rows):
+                dense_rows = dense_rows.toarray()
+            signal_tags[unknown_rows] = Count_tag.get_top_tags(dense_rows, dim)[1][:, :dim]
+        # tag names are sorted in each cell
+        tag_rank = np.empty(len(tags) + 1, dtype=np.int64)
+        tag_rank[np.argsort(tags, kind='stable')] = np.arange(len(tags))
+        tag_rank[-1] = len(tags)
+        signal_tags = np.take_along_axis(signal_tags, np.argsort(tag_rank[signal_tags], axis=1), axis=1)
+        signal_combinations, signal_codes = np.unique(signal_tags, axis=0, return_inverse=True)
+        signal_names = np.array(
+            ["_".join(tags[tag_indices[tag_indices >= 0]]) for tag_indices in signal_combinations], dtype=object)
+
+        tag_types = np.empty(len(UMIs), dtype=object)
+        tag_types[bool_undetermined] = "Undetermined"
+        tag_types[bool_multiplet] = "Multiplet"
+        tag_types[bool_signal] = signal_names[signal_codes.ravel()]
+
+        tag_type_count = {}
+        for tag_type, count in (
+            ("Undetermined", int(bool_undetermined.sum())), ("Multiplet", int(bool_multiplet.sum()))
+        ):
+            if count:
+                tag_type_count[tag_type] = count
+        signal_count = pd.Series(np.bincount(signal_codes.ravel(), minlength=len(signal_names)), index=signal_names)
+        signal_count = signal_count.groupby(level=0).sum()
+        for tag_type in sorted(signal_count.index):
+            tag_type_count[tag_type] = int(signal_count[tag_type])
+        return tag_types, tag_type_count
+
     @utils.add_log
     def write_and_plot(self, df, column_name, count_file, plot_file):
         df_count = df.groupby(["tag", column_name]).size().unstack()
@@ -217,27 +367,8 @@ class Count_tag(Step):
         )
 
         # UMI
-        tag_name = df_read_count_in_cell.columns[0]
-        df_UMI_in_cell = df_read_count_in_cell.reset_index().groupby([
-            'barcode', tag_name]).agg({'UMI': 'count'})
-        df_UMI_in_cell = df_UMI_in_cell.reset_index()
-        df_UMI_in_cell = df_UMI_in_cell.pivot(
-            index='barcode', columns=tag_name, values='UMI')
-        df_cell = pd.DataFrame(index=self.match_barcode)
-        df_UMI_cell = pd.merge(
-            df_cell,
-            df_UMI_in_cell,
-            how="left",
-            left_index=True,
-            right_index=True
-        )
-
-        # fillna
-        df_UMI_cell.fillna(0, inplace=True)
-        df_UMI_cell = df_UMI_cell.astype(int)
-
-        # UMI
-        UMIs = df_UMI_cell.apply(sum, axis=1)
+        UMI_matrix, tags = Count_tag.get_UMI_matrix(df_read_count_in_cell, self.match_barcode)
+        UMIs = Count_tag.get_UMIs(UMI_matrix)
         umi_median = round(np.median(UMIs), 2)
         umi_mean = round(np.mean(UMIs), 2)
         self.add_metric(
@@ -252,12 +383,14 @@ class Count_tag(Step):
             help_info="Mean UMI per scRNA-Seq cell barcode"
         )
 
-        UMI_min = Count_tag.get_UMI_min(df_UMI_cell, self.UMI_min)
+        UMI_min = Count_tag.get_UMI_min(UMI_matrix, self.UMI_min)
         Count_tag.run.logger.info(f'UMI_min: {UMI_min}')
-        SNR_min = self.get_SNR_min(df_UMI_cell, self.SNR_min, UMI_min)
+        SNR_min = self.get_SNR_min(UMI_matrix, self.SNR_min, UMI_min)
         Count_tag.run.logger.info(f'SNR_min: {SNR_min}')
-        df_UMI_cell["tag"] = df_UMI_cell.apply(
-            Count_tag.tag_type, UMI_min=UMI_min, SNR_min=SNR_min, dim=self.dim, no_noise=self.no_noise, axis=1)
+        tag_types, tag_type_count = Count_tag.get_tag_types(
+            UMI_matrix, tags, UMI_min=UMI_min, SNR_min=SNR_min, dim=self.dim, no_noise=self.no_noise)
+        df_UMI_cell = pd.DataFrame.sparse.from_spmatrix(UMI_matrix, index=self.match_barcode, columns=tags)
+        df_UMI_cell["tag"] = tag_types
         df_UMI_cell.to_csv(self.UMI_tag_file, sep="\t")
 
         df_tsne = pd.read_csv(self.tsne_file, sep="\t", index_col=0)
@@ -294,19 +427,10 @@ class Count_tag(Step):
                 plot_file=self.combine_cluster_plot
             )
 
-        sr_tag_count = df_UMI_cell["tag"].value_counts()  # series(index:tag name, value:tag count)
-        for tag_name in ("Undetermined", "Multiplet"):
-            if tag_name in sr_tag_count:
-                self.add_metric(
-                    name=tag_name + ' Cells',
-                    value=int(sr_tag_count[tag_name]),
-                    total=self.n_match_barcode,
-                )
-                sr_tag_count.drop(tag_name, inplace=True)
-        for tag_name in sorted(sr_tag_count.index):
+        for tag_name, tag_count in tag_type_count.items():
             self.add_metric(
                 name=tag_name + ' Cells',
-                value=int(sr_tag_count[tag_name]),
+                value=tag_count,
                 total=self.n_match_barcode,
             )
 
@@ -326,3 +450,59 @@ class Count_tag(Step):
             '2>&1 '
         )
         self.debug_subprocess_call(cmd)
+
+
+class Test_count_tag(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.tags = ['tag3', 'tag1', 'tag10', 'tag2']
+        # few UMIs to get many ties and zeros
+        self.matrix = np.random.poisson([0.3, 2, 0.5, 1], size=(2000, 4))
+        self.matrix[:10] = 0
+        self.df = pd.DataFrame(self.matrix, columns=self.tags)
+
+    def test_get_tag_types(self):
+        # if SNR_min <= 1, signal tags with equal UMI counts are ordered by `row.sort_values`, which is not stable
+        for dim in (1, 2):
+            for SNR_min in (1.5, 2, 5):
+                expected = self.df.apply(
+                    Count_tag.tag_type, UMI_min=2, SNR_min=SNR_min, dim=dim, axis=1).tolist()
+                for matrix in (self.matrix, scipy.sparse.csr_matrix(self.matrix), scipy.sparse.coo_matrix(self.matrix)):
+                    tag_types, tag_type_count = Count_tag.get_tag_types(
+                        matrix, self.tags, UMI_min=2, SNR_min=SNR_min, dim=dim)
+                    self.assertEqual(tag_types.tolist(), expected)
+                    self.assertEqual(tag_type_count, pd.Series(expected).value_counts().to_dict())
+
+    def test_get_SNRs(self):
+        for dim in (1, 2):
+            expected = self.df.apply(Count_tag.get_SNR, dim=dim, axis=1).tolist()
+            for matrix in (self.matrix, scipy.sparse.csc_matrix(self.matrix)):
+                top_values, _top_tags = Count_tag.get_top_tags(matrix, dim)
+                self.assertEqual(Count_tag.get_SNRs(top_values, dim).tolist(), expected)
+
+    def test_get_UMI_matrix(self):
+        df_read_count = pd.DataFrame({
+            'barcode': ['c1', 'c1', 'c1', 'c3', 'other'],
+            'tag': ['t2', 't2', 't1', 't1', 't3'],
+            'UMI': ['u1', 'u2', 'u1', 'u1', 'u1'],
+            'read_count': [1, 2, 3, 4, 5],
+        }).set_index('barcode')
+        barcodes = ['c1', 'c2', 'c3']
+        df_read_count = df_read_count[df_read_count.index.isin(barcodes)]
+        UMI_matrix, tags = Count_tag.get_UMI_matrix(df_read_count, barcodes)
+        self.assertEqual(tags, ['t1', 't2'])
+        self.assertEqual(UMI_matrix.toarray().tolist(), [[1, 2], [0, 0], [1, 0]])
+
+    def test_get_top_tags(self):
+        matrix = np.array([[0, 2, 0, 2], [0, 0, 0, 1], [0, 0, 0, 0]])
+        top_values, top_tags = Count_tag.get_top_tags(matrix, dim=2)
+        self.assertEqual(top_values.tolist(), [[2, 2, 0], [1, 0, 0], [0, 0, 0]])
+        self.assertEqual(top_tags.tolist(), [[1, 3, 0], [3, 0, 1], [0, 1, 2]])
+        # tags with 0 UMI are not stored
+        top_values, top_tags = Count_tag.get_top_tags(scipy.sparse.csr_matrix(matrix), dim=2)
+        self.assertEqual(top_values.tolist(), [[2, 2, 0], [1, 0, 0], [0, 0, 0]])
+        self.assertEqual(top_tags.tolist(), [[1, 3, -1], [3, -1, -1], [-1, -1, -1]])
+        tag_types, _tag_type_count = Count_tag.get_tag_types(
+            scipy.sparse.csr_matrix(matrix), ['a', 'b', 'c', 'd'], UMI_min=1, SNR_min=0, dim=2)
+        self.assertEqual(tag_types.tolist(), ['b_d', 'a_d', 'Undetermined'])
+
@@ -61,7 +61,9 @@ class Multi_tag(Multi):
             f'--match_dir {self.col4_dict[sample]} '
             f'--umi_tag_file {umi_tag_file} '
         )
-        self.process_cmd(cmd, step, sample, m=5, x=1)
+        # fastq files are gzipped in a process pool
+        x = self.args.thread if (self.args.split_fastq and self.args.gzip_split_fastq) else 1
+        self.process_cmd(cmd, step, sample, m=5, x=x)
 
 
 def main():
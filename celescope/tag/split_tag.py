@@ -2,9 +2,12 @@
 split scRNA-Seq fastq file(01.barcode/{sample}_2.fq)
 """
 import glob
+import gzip
 import os
 import itertools
-from collections import defaultdict
+import unittest
+from collections import OrderedDict, defaultdict
+from multiprocessing import Pool
 
 import pysam
 import pandas as pd
@@ -15,6 +18,9 @@ from celescope.tools.__init__ import FILTERED_MATRIX_DIR_SUFFIX
 from celescope.__init__ import HELP_DICT
 from celescope.tools.matrix import CountMatrix
 
+# bytes buffered for each output file before it is written
+CHUNK_SIZE = 1 << 20
+
 
 def get_clonotypes_table(df):
     chains = sorted(set(df['chain'].tolist()))
@@ -40,6 +46,89 @@ def get_clonotypes_table(df):
         return clonotypes, 'BCR'
 
 
+class TagFastqWriter:
+    """
+    Buffer records of each key(e.g. (tag, 1) for tag R1) and append them to the key's file in chunks.
+    - At most `max_open_files` files are open at the same time. The least recently used file is closed first.
+    - If gzip_out, each chunk is compressed to a gzip member(concatenated members are a valid gzip file).
+        Chunks are compressed in `thread` worker processes if thread > 1.
+    """
+
+    def __init__(self, file_dict, gzip_out=False, thread=1, max_open_files=64, chunk_size=CHUNK_SIZE):
+        """
+        Args:
+            file_dict: {key: file path}. Files are truncated.
+        """
+        self.file_dict = file_dict
+        self.gzip_out = gzip_out
+        self.thread = thread
+        self.max_open_files = max(max_open_files, 1)
+        self.chunk_size = chunk_size
+
+        self.buffers = defaultdict(list)
+        self.buffer_size = defaultdict(int)
+        self.handles = OrderedDict()
+        # (key, AsyncResult) of compressing chunks, in the order they are submitted
+        self.pending = []
+        self.pool = Pool(thread) if (gzip_out and thread > 1) else None
+
+        for file_path in file_dict.values():
+            open(file_path, 'wb').close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, key, record):
+        self.buffers[key].append(record)
+        self.buffer_size[key] += len(record)
+        if self.buffer_size[key] >= self.chunk_size:
+            self.flush(key)
+
+    def flush(self, key):
+        if not self.buffers[key]:
+            return
+        data = ''.join(self.buffers[key]).encode()
+        self.buffers[key] = []
+        self.buffer_size[key] = 0
+        if not self.gzip_out:
+            self._append(key, data)
+        elif self.pool is None:
+            self._append(key, gzip.compress(data))
+        else:
+            self.pending.append((key, self.pool.apply_async(gzip.compress, (data,))))
+            self._write_pending(max_pending=self.thread * 2)
+
+    def _write_pending(self, max_pending=0):
+        while len(self.pending) > max_pending:
+            key, result = self.pending.pop(0)
+            self._append(key, result.get())
+
+    def _append(self, key, data):
+        if key in self.handles:
+            self.handles.move_to_end(key)
+        else:
+            if len(self.handles) >= self.max_open_files:
+                _old_key, old_handle = self.handles.popitem(last=False)
+                old_handle.close()
+            self.handles[key] = open(self.file_dict[key], 'ab')
+        self.handles[key].write(data)
+
+    def close(self):
+        for key in list(self.buffers):
+            self.flush(key)
+        self._write_pending()
+        for handle in self.handles.values():
+            handle.close()
+        self.handles.clear()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
 class Split_tag(Step):
     """
     ## Features
@@ -47,7 +136,8 @@ class Split_tag(Step):
 
     ## Output
     - `matrix/` Matrix files of each tag.(Optional)
-    - `fastq/` Fastq files of each tag.(Optional)
+    - `fastqs/` Fastq files of each tag.(Optional) R1 and R2 reads are split in one pass. If `--gzip_split_fastq` is 
+    used, fastq files are gzipped by `--thread` processes.
     """
 
     def __init__(self, args, display_title=None):
@@ -76,15 +166,12 @@ class Split_tag(Step):
             fastq_outdir = f'{args.outdir}/fastqs/'
             os.system(f'mkdir -p {fastq_outdir}')
 
-            self.r2_fastq_files_handle = {}
-            self.r1_fastq_files_handle = {}
+            suffix = '.gz' if args.gzip_split_fastq else ''
+            # (tag, 1 or 2): fastq file
+            self.tag_fastq_file_dict = {}
             for tag in self.tag_barcode_dict:
-                r2_fastq_file_name = f'{fastq_outdir}/{tag}_2.fq'
-                self.r2_fastq_files_handle[tag] = open(r2_fastq_file_name, 'w')
-                r1_fastq_file_name = f'{fastq_outdir}/{tag}_1.fq'
-                self.r1_fastq_files_handle[tag] = open(r1_fastq_file_name, 'w')
-
-            self.tag_read_index_dict = defaultdict(set)
+                for read_num in (1, 2):
+                    self.tag_fastq_file_dict[(tag, read_num)] = f'{fastq_outdir}/{tag}_{read_num}.fq{suffix}'
 
         if args.split_vdj:
             self.cell_confident_vdj = glob.glob(f'{args.vdj_dir}/*count_vdj/*cell_confident.tsv*')[0]
@@ -119,38 +206,44 @@ class Split_tag(Step):
 
 
     @utils.add_log
-    def write_r2_fastq_files(self):
-        read_num = 0
-        with pysam.FastxFile(self.rna_fq_file, 'r') as rna_fq:
-            for read in rna_fq:
-                read_num += 1
+    def split_fastq(self):
+        """
+        Reads in `{sample}_2.fq` are a subset of R1 reads in the same order, and the read name contains the R1 read
+        index. Stream both together and write each pair to the files of its tag.
+        """
+        barcode_tag_dict = {
+            barcode: tag for tag, barcodes in self.tag_barcode_dict.items() for barcode in barcodes
+        }
+        r1_files = [pysam.FastxFile(r1, 'r') for r1 in self.args.R1_read.split(',')]
+        r1_reads = enumerate(itertools.chain(*r1_files), start=1)
+        r1_index = 0
+
+        with TagFastqWriter(
+            self.tag_fastq_file_dict,
+            gzip_out=self.args.gzip_split_fastq,
+            thread=self.thread,
+            max_open_files=self.args.max_open_files,
+        ) as writer, pysam.FastxFile(self.rna_fq_file, 'r') as rna_fq:
+            for read_num, read in enumerate(rna_fq, start=1):
                 attr = read.name.strip("@").split("_")
-                barcode = attr[0]
-                read_index = int(attr[2])
-                for tag in self.tag_barcode_dict:
-                    if barcode in self.tag_barcode_dict[tag]:
-                        self.tag_read_index_dict[tag].add(read_index)
-                        self.r2_fastq_files_handle[tag].write(str(read) + '\n')
+                tag = barcode_tag_dict.get(attr[0])
+                if tag is not None:
+                    read_index = int(attr[2])
+                    if read_index <= r1_index:
+                        raise ValueError(f'Reads in {self.rna_fq_file} are not in the order of R1 reads.')
+                    for r1_index, r1_read in r1_reads:
+                        if r1_index == read_index:
+                            break
+                    else:
+                        raise ValueError(f'R1 read {read_index} not found in {self.args.R1_read}.')
+                    writer.write((tag, 1), str(r1_read) + '\n')
+                    writer.write((tag, 2), str(read) + '\n')
 
                 if read_num % 1000000 == 0:
-                    self.write_r2_fastq_files.logger.info(f'{read_num} done')
-
-        for tag in self.r2_fastq_files_handle:
-            self.r2_fastq_files_handle[tag].close()
+                    self.split_fastq.logger.info(f'{read_num} done')
 
-    @utils.add_log
-    def write_r1_fastq_files(self):
-        file_handles = [pysam.FastxFile(r1, 'r') for r1 in self.args.R1_read.split(',')]
-        r1_read = itertools.chain(*file_handles)
-        for read_index, read in enumerate(r1_read, start=1):
-            for tag in self.tag_read_index_dict:
-                if read_index in self.tag_read_index_dict[tag]:
-                    self.r1_fastq_files_handle[tag].write(str(read) + '\n')
-
-        for r1 in file_handles:
+        for r1 in r1_files:
             r1.close()
-        for tag in self.r1_fastq_files_handle:
-            self.r1_fastq_files_handle[tag].close()
 
     @utils.add_log
     def split_matrix(self):
@@ -236,8 +329,7 @@ class Split_tag(Step):
         if self.args.split_matrix:
             self.split_matrix()
         if self.args.split_fastq:
-            self.write_r2_fastq_files()
-            self.write_r1_fastq_files()
+            self.split_fastq()
         if self.args.split_vdj:
             self.split_vdj()
         if self.args.split_fl_vdj:
@@ -271,9 +363,41 @@ def get_opts_split_tag(parser, sub_program):
         action='store_true',
     )
     parser.add_argument("--vdj_dir", help="Match celescope vdj directory. Required when --split_vdj or --split_fl_vdj is specified.")
+    parser.add_argument(
+        "--gzip_split_fastq",
+        help="Output gzipped fastq files when --split_fastq is specified. Files are compressed by `--thread` processes.",
+        action='store_true',
+    )
+    parser.add_argument(
+        "--max_open_files",
+        help="Maximum number of fastq files open at the same time when --split_fastq is specified.",
+        type=int,
+        default=64,
+    )
     if sub_program:
         parser.add_argument("--umi_tag_file", help="UMI tag file.", required=True)
         parser.add_argument("--match_dir", help=HELP_DICT['match_dir'])
         parser.add_argument("--matrix_dir", help="Match celescope scRNA-Seq matrix directory.")
         parser.add_argument("--R1_read", help='R1 read path.')
         s_common(parser)
+
+
+class Test_split_tag(unittest.TestCase):
+    def test_tag_fastq_writer(self):
+        import tempfile
+
+        records = [(f'tag{i % 5}', f'@read{i}\nACGT\n+\nFFFF\n') for i in range(1000)]
+        for gzip_out in (False, True):
+            for thread in (1, 2):
+                with tempfile.TemporaryDirectory() as temp_dir:
+                    suffix = '.gz' if gzip_out else ''
+                    file_dict = {f'tag{i}': f'{temp_dir}/tag{i}.fq{suffix}' for i in range(6)}
+                    with TagFastqWriter(
+                        file_dict, gzip_out=gzip_out, thread=thread, max_open_files=2, chunk_size=100
+                    ) as writer:
+                        for key, record in records:
+                            writer.write(key, record)
+                    for key, file_path in file_dict.items():
+                        with utils.generic_open(file_path, 'rt') as f:
+                            self.assertEqual(f.read(), ''.join(record for k, record in records if k == key))
+
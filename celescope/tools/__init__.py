@@ -20,7 +20,12 @@ RAW_MATRIX_DIR_SUFFIX = ['raw_feature_bc_matrix', 'all_matrix']
 FILTERED_MATRIX_DIR_SUFFIX = ['filtered_feature_bc_matrix', 'matrix_10X']
 MATRIX_FILE_NAME = 'matrix.mtx'
 FEATURE_FILE_NAME = 'genes.tsv'
+# gzipped Matrix Market directory uses 10X v3 file name
+FEATURE_FILE_NAME_V3 = 'features.tsv'
 BARCODE_FILE_NAME = 'barcodes.tsv'
+H5_SUFFIX = '.h5'
 
 # mkref
 GENOME_CONFIG = 'celescope_genome.config'
+# compiled GTF annotation next to GENOME_CONFIG. See celescope.tools.gtf_index
+GTF_INDEX_DIR = 'celescope_gtf_index'
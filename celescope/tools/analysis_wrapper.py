@@ -6,6 +6,7 @@ from celescope.tools import utils
 from celescope.__init__ import HELP_DICT
 from celescope.rna.mkref import Mkref_rna
 from celescope.tools.step import Step, s_common
+from celescope.tools.__init__ import H5_SUFFIX
 
 # markers adjust p_value
 PVAL_CUTOFF = 0.05
@@ -48,7 +49,7 @@ def get_opts_analysis(parser, sub_program):
     if sub_program:
         parser.add_argument(
             '--matrix_file',
-            help='Required. Matrix_10X directory from step count.',
+            help='Required. Matrix_10X directory or 10X HDF5 file(`.h5`) from step count.',
             required=True,
         )
         parser = s_common(parser)
@@ -61,10 +62,14 @@ class Scanpy_wrapper(Step):
         super().__init__(args, display_title=display_title)
 
         # data
-        self.adata = sc.read_10x_mtx(
-            args.matrix_file,  
-            var_names='gene_symbols',
-        )
+        if args.matrix_file.endswith(H5_SUFFIX):
+            self.adata = sc.read_10x_h5(args.matrix_file)
+            self.adata.var_names_make_unique()
+        else:
+            self.adata = sc.read_10x_mtx(
+                args.matrix_file,  
+                var_names='gene_symbols',
+            )
         self.mt_gene_list = Mkref_rna.parse_genomeDir(args.genomeDir)['mt_gene_list']
 
         # out
@@ -0,0 +1,451 @@
+"""
+Count reads of cell barcodes in a BAM file. Shared by capture-style count steps.
+
+Cell barcodes are encoded into integer indices once, so the membership test of a read is a dict lookup instead of a
+list scan. Features and UMIs are encoded when they are first seen. Each counted read is one (barcode index, feature
+index, UMI index) row in compact int arrays, and rows are reduced to read counts per UMI with numpy.
+
+If the BAM file is indexed, groups of contigs(or fetch regions) are counted in parallel processes. Parts are merged in
+region order, so the result is the same as reading the whole file in one pass.
+"""
+
+import json
+import shutil
+import unittest
+from array import array
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+import pysam
+
+from celescope.tools import utils
+
+
+class ReadParser:
+    """
+    Get (barcode, feature, UMI) of a read.
+    Barcode and UMI are parsed from the query name `{barcode}_{UMI}_...`. Feature is the reference name.
+    Subclasses must be picklable, because they are sent to worker processes.
+    """
+
+    def parse(self, read):
+        """
+        Returns:
+            (barcode, feature, UMI). None if the read is not counted.
+        """
+        attr = read.query_name.split('_', 2)
+        return attr[0], read.reference_name, attr[1]
+
+    def write(self, read, feature):
+        """
+        Called on counted reads of cell barcodes if there is an output BAM. The read can be modified here.
+        Returns:
+            True if the read is written to the output BAM.
+        """
+        return True
+
+
+def get_barcode_dict(barcodes):
+    return {barcode: index for index, barcode in enumerate(barcodes)}
+
+
+def merge_names(name_lists):
+    """
+    Returns:
+        names: unique names in the order they are first seen.
+        index_maps: index of each name in name_lists in names.
+
+    >>> names, index_maps = merge_names([['a', 'b'], ['c', 'a']])
+    >>> names, [index_map.tolist() for index_map in index_maps]
+    (['a', 'b', 'c'], [[0, 1], [2, 0]])
+    """
+    names = []
+    name_dict = {}
+    index_maps = []
+    for name_list in name_lists:
+        index_map = np.empty(len(name_list), dtype=np.int64)
+        for i, name in enumerate(name_list):
+            index = name_dict.get(name)
+            if index is None:
+                index = len(names)
+                name_dict[name] = index
+                names.append(name)
+            index_map[i] = index
+        index_maps.append(index_map)
+    return names, index_maps
+
+
+class UmiCounts:
+    """
+    Read counts of unique (barcode, feature, UMI) rows. Rows are in the order of their first read.
+
+    Attributes:
+        barcodes: cell barcodes. Values in barcode_index refer to this list.
+        features, umis: features and UMIs in the order they are first seen.
+        barcode_index, feature_index, umi_index, read_count: one element per row.
+        first_read: order of the first read of each row among counted reads.
+        feature_read: number of parsed reads of each feature, including reads of other barcodes.
+    """
+
+    def __init__(self, barcodes, features, umis, barcode_index, feature_index, umi_index, read_count, first_read,
+                 feature_read):
+        self.barcodes = barcodes
+        self.features = features
+        self.umis = umis
+        self.barcode_index = barcode_index
+        self.feature_index = feature_index
+        self.umi_index = umi_index
+        self.read_count = read_count
+        self.first_read = first_read
+        self.feature_read = feature_read
+
+    @staticmethod
+    def reduce(barcode_index, feature_index, umi_index, read_count, first_read):
+        """
+        Sum read_count of rows with the same (barcode, feature, UMI), and sort rows by first_read.
+
+        >>> rows = UmiCounts.reduce(*map(np.array, ([1, 0, 1, 1], [0, 0, 0, 0], [2, 3, 2, 5], [1, 1, 2, 1], [0, 1, 2, 3])))
+        >>> [row.tolist() for row in rows]
+        [[1, 0, 1], [0, 0, 0], [2, 3, 5], [3, 1, 1], [0, 1, 3]]
+        """
+        if len(read_count) == 0:
+            return barcode_index, feature_index, umi_index, read_count, first_read
+        order = np.lexsort((first_read, umi_index, feature_index, barcode_index))
+        keys = [barcode_index[order], feature_index[order], umi_index[order]]
+        is_start = np.zeros(len(order), dtype=bool)
+        is_start[0] = True
+        for key in keys:
+            is_start[1:] |= key[1:] != key[:-1]
+        starts = np.flatnonzero(is_start)
+        read_count = np.add.reduceat(read_count[order], starts)
+        first_read = first_read[order][starts]
+        rows = [key[starts] for key in keys] + [read_count, first_read]
+        order = np.argsort(first_read, kind='stable')
+        return tuple(row[order] for row in rows)
+
+    @classmethod
+    def concat(cls, counts_list):
+        """
+        Merge counts of consecutive parts of a BAM file. All parts must have the same barcodes.
+        """
+        features, feature_maps = merge_names([counts.features for counts in counts_list])
+        umis, umi_maps = merge_names([counts.umis for counts in counts_list])
+        feature_read = np.zeros(len(features), dtype=np.int64)
+        rows = [[], [], [], [], []]
+        offset = 0
+        for counts, feature_map, umi_map in zip(counts_list, feature_maps, umi_maps):
+            feature_read[feature_map] += counts.feature_read
+            rows[0].append(counts.barcode_index)
+            rows[1].append(feature_map[counts.feature_index])
+            rows[2].append(umi_map[counts.umi_index])
+            rows[3].append(counts.read_count)
+            rows[4].append(counts.first_read + offset)
+            offset += int(counts.read_count.sum())
+        rows = [np.concatenate(row).astype(np.int64) for row in rows]
+        return cls(counts_list[0].barcodes, features, umis, *cls.reduce(*rows), feature_read)
+
+    def __len__(self):
+        return len(self.read_count)
+
+    @property
+    def n_barcode(self):
+        """number of barcodes with reads"""
+        return len(np.unique(self.barcode_index))
+
+    def to_dict(self):
+        """
+        Returns:
+            {barcode: {feature: {UMI: read_count}}}. Keys are in the order of their first read.
+        """
+        count_dict = utils.genDict(dim=3)
+        for barcode_index, feature_index, umi_index, read_count in zip(
+            self.barcode_index.tolist(), self.feature_index.tolist(), self.umi_index.tolist(), self.read_count.tolist()
+        ):
+            count_dict[self.barcodes[barcode_index]][self.features[feature_index]][self.umis[umi_index]] = read_count
+        return count_dict
+
+    def get_nested_order(self):
+        """
+        Returns:
+            row order that groups rows by barcode, then by feature, in the order of their first read.
+            The same order as iterating `to_dict()`.
+
+        >>> rows = map(np.array, ([1, 0, 1, 1], [0, 0, 1, 0], [0, 0, 0, 1], [1, 1, 1, 1], [0, 1, 2, 3]))
+        >>> counts = UmiCounts(['A', 'B'], ['F', 'G'], ['U', 'V'], *rows, None)
+        >>> counts.get_nested_order().tolist()
+        [0, 3, 2, 1]
+        """
+        n_row = len(self.barcode_index)
+        _, barcode_first, barcode_inverse = np.unique(self.barcode_index, return_index=True, return_inverse=True)
+        pair = self.barcode_index * (int(self.feature_index.max(initial=0)) + 1) + self.feature_index
+        _, pair_first, pair_inverse = np.unique(pair, return_index=True, return_inverse=True)
+        return np.lexsort((np.arange(n_row), pair_first[pair_inverse], barcode_first[barcode_inverse]))
+
+    def to_df(self):
+        """
+        Returns:
+            DataFrame with columns barcode, feature, UMI and read_count. Rows are in the order of `get_nested_order`.
+        """
+        order = self.get_nested_order()
+        return pd.DataFrame({
+            'barcode': np.array(self.barcodes, dtype=object)[self.barcode_index[order]],
+            'feature': np.array(self.features, dtype=object)[self.feature_index[order]],
+            'UMI': np.array(self.umis, dtype=object)[self.umi_index[order]],
+            'read_count': self.read_count[order],
+        })
+
+
+class UmiCounter:
+    """
+    Accumulate reads of cell barcodes as (barcode index, feature index, UMI index) rows.
+    """
+
+    def __init__(self, barcodes, barcode_dict=None):
+        """
+        Args:
+            barcodes: cell barcodes
+            barcode_dict: `get_barcode_dict(barcodes)`. Built from barcodes if None.
+        """
+        self.barcodes = barcodes
+        self.barcode_dict = get_barcode_dict(barcodes) if barcode_dict is None else barcode_dict
+        self.features = []
+        self.feature_dict = {}
+        self.feature_read = []
+        self.umis = []
+        self.umi_dict = {}
+        self.barcode_index = array('i')
+        self.feature_index = array('i')
+        self.umi_index = array('i')
+
+    def add(self, barcode, feature, umi):
+        """
+        Returns:
+            True if barcode is a cell barcode and the read is counted.
+        """
+        feature_index = self.feature_dict.get(feature)
+        if feature_index is None:
+            feature_index = len(self.features)
+            self.feature_dict[feature] = feature_index
+            self.features.append(feature)
+            self.feature_read.append(0)
+        self.feature_read[feature_index] += 1
+
+        barcode_index = self.barcode_dict.get(barcode)
+        if barcode_index is None:
+            return False
+        umi_index = self.umi_dict.get(umi)
+        if umi_index is None:
+            umi_index = len(self.umis)
+            self.umi_dict[umi] = umi_index
+            self.umis.append(umi)
+        self.barcode_index.append(barcode_index)
+        self.feature_index.append(feature_index)
+        self.umi_index.append(umi_index)
+        return True
+
+    def get_counts(self):
+        n_row = len(self.barcode_index)
+        rows = UmiCounts.reduce(
+            np.array(self.barcode_index, dtype=np.int64),
+            np.array(self.feature_index, dtype=np.int64),
+            np.array(self.umi_index, dtype=np.int64),
+            np.ones(n_row, dtype=np.int64),
+            np.arange(n_row, dtype=np.int64),
+        )
+        return UmiCounts(self.barcodes, self.features, self.umis, *rows, np.array(self.feature_read, dtype=np.int64))
+
+
+def fetch_region(samfile, region):
+    """
+    Args:
+        region: None for all reads in file order, a contig name('*' for unmapped reads without coordinate),
+            or (contig, start, end).
+    """
+    if region is None:
+        return samfile.fetch(until_eof=True)
+    if isinstance(region, str):
+        return samfile.fetch(region)
+    contig, start, end = region
+    return samfile.fetch(contig, start, end)
+
+
+def get_region_groups(bam, thread, regions=None):
+    """
+    Returns:
+        list of region groups. Each group is counted by one worker.
+        - regions is None: groups of contigs if bam is indexed, otherwise [[None]], which reads the whole file.
+        - otherwise each region is one group.
+    """
+    if regions is not None:
+        return [[region] for region in regions]
+    with pysam.AlignmentFile(bam, "rb") as samfile:
+        has_index = samfile.has_index()
+    if not has_index:
+        return [[None]]
+    return utils.get_contig_groups(bam, thread)
+
+
+# cell barcodes and read parser of worker processes. Set once by the pool initializer.
+_worker_barcodes = None
+_worker_barcode_dict = None
+_worker_parser = None
+
+
+def _init_count_worker(barcodes, parser):
+    global _worker_barcodes, _worker_barcode_dict, _worker_parser
+    _worker_barcodes = barcodes
+    _worker_barcode_dict = get_barcode_dict(barcodes)
+    _worker_parser = parser
+
+
+def _count_regions(bam, regions, out_bam=None, header=None):
+    """
+    Count reads of regions. If out_bam is not None, counted reads are written to it.
+    Returns:
+        UmiCounts
+    """
+    counter = UmiCounter(_worker_barcodes, _worker_barcode_dict)
+    parser = _worker_parser
+    with pysam.AlignmentFile(bam, "rb") as samfile:
+        out = None
+        if out_bam is not None:
+            out = pysam.AlignmentFile(out_bam, "wb", header=samfile.header if header is None else header)
+        try:
+            for region in regions:
+                for read in fetch_region(samfile, region):
+                    parsed = parser.parse(read)
+                    if parsed is None:
+                        continue
+                    barcode, feature, umi = parsed
+                    if counter.add(barcode, feature, umi) and out is not None and parser.write(read, feature):
+                        out.write(read)
+        finally:
+            if out is not None:
+                out.close()
+    return counter.get_counts()
+
+
+@utils.add_log
+def count_reads(bam, barcodes, parser=None, thread=1, regions=None, out_bam=None, header=None):
+    """
+    Count reads of cell barcodes in bam.
+
+    Args:
+        barcodes: cell barcodes
+        parser: ReadParser. Default is ReadParser().
+        regions: list of fetch regions, see `fetch_region`. Default is all reads.
+        out_bam: if not None, counted reads are written to out_bam in region order.
+        header: header of out_bam. Default is the header of bam.
+    Returns:
+        UmiCounts
+    """
+    if parser is None:
+        parser = ReadParser()
+    barcodes = list(barcodes)
+    region_groups = get_region_groups(bam, thread, regions)
+
+    if thread <= 1 or len(region_groups) <= 1:
+        _init_count_worker(barcodes, parser)
+        regions = [region for region_group in region_groups for region in region_group]
+        counts_list = [_count_regions(bam, regions, out_bam, header)]
+    else:
+        temp_dir = None
+        part_bams = [None] * len(region_groups)
+        if out_bam is not None:
+            temp_dir = f'{out_bam}_parts.temp'
+            utils.check_mkdir(temp_dir)
+            part_bams = [f'{temp_dir}/{i}.bam' for i in range(len(region_groups))]
+        args_list = [(bam, region_group, part_bam, header) for region_group, part_bam in zip(region_groups, part_bams)]
+        with Pool(thread, initializer=_init_count_worker, initargs=(barcodes, parser)) as pool:
+            counts_list = pool.starmap(_count_regions, args_list)
+        if temp_dir is not None:
+            pysam.cat('-o', out_bam, *part_bams)
+            shutil.rmtree(temp_dir)
+
+    counts = UmiCounts.concat(counts_list)
+    count_reads.logger.info(f'{int(counts.read_count.sum())} reads of cell barcodes, {len(counts)} UMIs')
+    return counts
+
+
+class Test_bam_count(unittest.TestCase):
+    def setUp(self):
+        import random
+        import tempfile
+
+        random.seed(0)
+        self.temp_dir = tempfile.mkdtemp()
+        self.bam = f'{self.temp_dir}/test.bam'
+        contigs = ['chr1', 'chr2', 'chr3']
+        header = {'HD': {'VN': '1.0', 'SO': 'coordinate'}, 'SQ': [{'SN': contig, 'LN': 10000} for contig in contigs]}
+        self.barcodes = [f'B{i:03d}' for i in range(0, 60, 2)]
+        segments = []
+        for i in range(3000):
+            segment = pysam.AlignedSegment()
+            umi = ''.join(random.choice('AC') for _ in range(4))
+            segment.query_name = f'B{random.randrange(60):03d}_{umi}_{i}'
+            segment.query_sequence = 'A' * 30
+            reference_id = random.randrange(-1, len(contigs))
+            if reference_id == -1:
+                segment.flag = 4
+            else:
+                segment.reference_id = reference_id
+                segment.reference_start = random.randrange(9000)
+                segment.cigarstring = '30M'
+            segments.append(segment)
+        segments.sort(key=lambda x: (x.reference_id == -1, x.reference_id, x.reference_start))
+        with pysam.AlignmentFile(self.bam, 'wb', header=header) as out:
+            for segment in segments:
+                out.write(segment)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def get_expected(self):
+        count_dict = utils.genDict(dim=3)
+        barcodes = set(self.barcodes)
+        names = []
+        with pysam.AlignmentFile(self.bam, "rb") as samfile:
+            for read in samfile.fetch(until_eof=True):
+                barcode, umi = read.query_name.split('_')[:2]
+                if barcode in barcodes:
+                    count_dict[barcode][read.reference_name][umi] += 1
+                    names.append(read.query_name)
+        return count_dict, names
+
+    def test_count_reads(self):
+        expected, expected_names = self.get_expected()
+        for index in (False, True):
+            if index:
+                pysam.index(self.bam)
+            for thread in (1, 3):
+                out_bam = f'{self.temp_dir}/out_{index}_{thread}.bam'
+                counts = count_reads(self.bam, self.barcodes, thread=thread, out_bam=out_bam)
+                # same keys in the same order
+                self.assertEqual(json.dumps(counts.to_dict()), json.dumps(expected))
+                self.assertEqual(sum(counts.feature_read), 3000)
+                with pysam.AlignmentFile(out_bam, "rb") as samfile:
+                    self.assertEqual([read.query_name for read in samfile.fetch(until_eof=True)], expected_names)
+
+    def test_regions(self):
+        pysam.index(self.bam)
+        regions = [('chr2', 100, 5000), ('chr1', 0, 3000)]
+        counts = count_reads(self.bam, self.barcodes, thread=2, regions=regions)
+        count_dict = utils.genDict(dim=3)
+        with pysam.AlignmentFile(self.bam, "rb") as samfile:
+            for region in regions:
+                for read in samfile.fetch(*region):
+                    barcode, umi = read.query_name.split('_')[:2]
+                    if barcode in self.barcodes:
+                        count_dict[barcode][read.reference_name][umi] += 1
+        self.assertEqual(json.dumps(counts.to_dict()), json.dumps(count_dict))
+        self.assertEqual(counts.n_barcode, len(count_dict))
+        rows = [
+            [barcode, feature, umi, n] for barcode, features in count_dict.items()
+            for feature, umis in features.items() for umi, n in umis.items()
+        ]
+        self.assertEqual(counts.to_df().values.tolist(), rows)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,253 @@
+"""
+Split a BAM file into shards by BGZF virtual offsets.
+
+A virtual offset is `(compressed block offset << 16) | offset in uncompressed block`. Shard boundaries are found
+without reading the whole file: for each target position, seek to the next BGZF block, find the first valid BAM record
+in it, then move forward to the next key(e.g. barcode) boundary. Reads with the same key are always in the same shard,
+so shards of a name-sorted BAM can be processed independently and concatenated in order.
+"""
+
+import os
+import struct
+import unittest
+import zlib
+
+import pysam
+
+from celescope.tools import utils
+
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+BGZF_HEADER_SIZE = 18
+# max BGZF block size
+BGZF_MAX_BLOCK_SIZE = 65536
+# fixed part of a BAM record after block_size
+BAM_RECORD_FIXED = 32
+BAM_RECORD_FORMAT = '<iiiBBHHHiiii'
+# number of consecutive valid records needed to accept a record start
+N_RECORD_CHECK = 3
+
+
+def read_bgzf_block(fh, block_offset):
+    """
+    Returns:
+        block_size: compressed block size
+        data: uncompressed data
+        None if there is no valid BGZF block at block_offset.
+    """
+    fh.seek(block_offset)
+    header = fh.read(BGZF_HEADER_SIZE)
+    if len(header) < BGZF_HEADER_SIZE or header[:4] != BGZF_MAGIC:
+        return None
+    xlen, si1, si2, slen, bsize = struct.unpack('<HBBHH', header[10:18])
+    if xlen != 6 or (si1, si2, slen) != (66, 67, 2):
+        return None
+    block_size = bsize + 1
+    cdata = fh.read(block_size - BGZF_HEADER_SIZE)
+    if len(cdata) != block_size - BGZF_HEADER_SIZE:
+        return None
+    crc, isize = struct.unpack('<II', cdata[-8:])
+    try:
+        data = zlib.decompress(cdata[:-8], wbits=-15)
+    except zlib.error:
+        return None
+    if len(data) != isize or zlib.crc32(data) != crc:
+        return None
+    return block_size, data
+
+
+def find_next_block(fh, offset, file_size):
+    """
+    Returns:
+        block_offset: offset of the first valid BGZF block at or after offset. None if not found.
+    """
+    while offset < file_size:
+        fh.seek(offset)
+        window = fh.read(BGZF_MAX_BLOCK_SIZE * 2)
+        start = 0
+        while True:
+            index = window.find(BGZF_MAGIC, start)
+            if index == -1:
+                break
+            if read_bgzf_block(fh, offset + index):
+                return offset + index
+            start = index + 1
+        # keep overlap in case the magic is split between windows
+        offset += max(len(window) - len(BGZF_MAGIC), 1)
+    return None
+
+
+def is_record(buf, pos, n_ref):
+    """
+    Check if a BAM record starts at buf[pos].
+
+    Returns:
+        record end position if valid, -1 if invalid, 0 if buf is too short to tell.
+    """
+    if pos + 4 + BAM_RECORD_FIXED > len(buf):
+        return 0
+    (block_size, ref_id, ref_pos, l_read_name, _mapq, _bin, n_cigar_op, _flag, l_seq,
+        next_ref_id, next_pos, _tlen) = struct.unpack_from(BAM_RECORD_FORMAT, buf, pos)
+    if not (-1 <= ref_id < n_ref and -1 <= next_ref_id < n_ref and ref_pos >= -1 and next_pos >= -1):
+        return -1
+    if l_read_name < 2 or l_seq < 0:
+        return -1
+    if block_size < BAM_RECORD_FIXED + l_read_name + 4 * n_cigar_op + (l_seq + 1) // 2 + l_seq:
+        return -1
+    name_start = pos + 4 + BAM_RECORD_FIXED
+    name = buf[name_start: name_start + l_read_name]
+    if len(name) < l_read_name:
+        return 0
+    if name[-1] != 0 or any(c < 33 or c > 126 or c == 64 for c in name[:-1]):
+        return -1
+    return pos + 4 + block_size
+
+
+def find_record_start(buf, first_block_len, n_ref):
+    """
+    Find the first offset in the first block where N_RECORD_CHECK consecutive records can be parsed.
+
+    Returns:
+        offset in buf, or None if not found.
+    """
+    for start in range(first_block_len):
+        pos = start
+        for _ in range(N_RECORD_CHECK):
+            end = is_record(buf, pos, n_ref)
+            if end <= 0:
+                break
+            pos = end
+        else:
+            return start
+        if end == 0 and pos != start:
+            # valid until the end of buf
+            return start
+    return None
+
+
+def guess_virtual_offset(fh, offset, file_size, n_ref):
+    """
+    Returns:
+        virtual offset of the first record starting in a BGZF block at or after offset. None if not found.
+    """
+    while True:
+        block_offset = find_next_block(fh, offset, file_size)
+        if block_offset is None:
+            return None
+        block_size, data = read_bgzf_block(fh, block_offset)
+        # records may span blocks
+        buf = data
+        next_offset = block_offset + block_size
+        while len(buf) < len(data) + BGZF_MAX_BLOCK_SIZE:
+            next_block = read_bgzf_block(fh, next_offset)
+            if not next_block:
+                break
+            buf += next_block[1]
+            next_offset += next_block[0]
+        start = find_record_start(buf, len(data), n_ref)
+        if start is not None:
+            return (block_offset << 16) | start
+        offset = block_offset + block_size
+
+
+def iter_shard(samfile, start=None, end=None):
+    """
+    Yield reads in [start, end) virtual offsets. None means from the first read or to the end of file.
+    """
+    if start is not None:
+        samfile.seek(start)
+    while True:
+        if end is not None and samfile.tell() >= end:
+            break
+        try:
+            read = next(samfile)
+        except StopIteration:
+            break
+        yield read
+
+
+@utils.add_log
+def get_shards(bam, n_shard, keyfunc):
+    """
+    Split bam into at most n_shard shards. Reads with the same key are in the same shard.
+
+    Args:
+        keyfunc: read -> key. Reads with the same key must be adjacent in the BAM file.
+    Returns:
+        list of (start, end) virtual offsets. end of the last shard is None.
+    """
+    file_size = os.path.getsize(bam)
+    with pysam.AlignmentFile(bam, 'rb') as samfile, open(bam, 'rb') as fh:
+        n_ref = samfile.nreferences
+        first = samfile.tell()
+        boundaries = [first]
+        for i in range(1, n_shard):
+            virtual_offset = guess_virtual_offset(fh, file_size * i // n_shard, file_size, n_ref)
+            if virtual_offset is None or virtual_offset <= boundaries[-1]:
+                continue
+            samfile.seek(virtual_offset)
+            boundary = None
+            prev_key = None
+            while True:
+                pos = samfile.tell()
+                try:
+                    read = next(samfile)
+                except StopIteration:
+                    break
+                key = keyfunc(read)
+                if prev_key is not None and key != prev_key:
+                    boundary = pos
+                    break
+                prev_key = key
+            if boundary is not None and boundary > boundaries[-1]:
+                boundaries.append(boundary)
+
+    ends = boundaries[1:] + [None]
+    shards = list(zip(boundaries, ends))
+    get_shards.logger.info(f'{len(shards)} shards')
+    return shards
+
+
+class Test_bam_shard(unittest.TestCase):
+    def test_shards(self):
+        import random
+        import tempfile
+
+        random.seed(0)
+        header = {'HD': {'VN': '1.0', 'SO': 'queryname'}, 'SQ': [{'SN': 'chr1', 'LN': 100000}]}
+        with tempfile.TemporaryDirectory() as temp_dir:
+            bam = f'{temp_dir}/test.bam'
+            names = []
+            with pysam.AlignmentFile(bam, 'wb', header=header) as out:
+                for i in range(2000):
+                    barcode = f'{i:08d}'
+                    for j in range(random.randint(1, 30)):
+                        segment = pysam.AlignedSegment()
+                        segment.query_name = f'{barcode}_AAAA_{j}'
+                        segment.query_sequence = 'A' * random.randint(10, 100)
+                        segment.reference_id = 0
+                        segment.reference_start = random.randint(0, 1000)
+                        segment.cigarstring = f'{len(segment.query_sequence)}M'
+                        out.write(segment)
+                        names.append(segment.query_name)
+
+            def keyfunc(read):
+                return read.query_name.split('_', 1)[0]
+
+            shards = get_shards(bam, 8, keyfunc)
+            self.assertGreater(len(shards), 1)
+            shard_names = []
+            shard_key_list = []
+            with pysam.AlignmentFile(bam, 'rb') as samfile:
+                for start, end in shards:
+                    shard_keys = set()
+                    for read in iter_shard(samfile, start, end):
+                        shard_names.append(read.query_name)
+                        shard_keys.add(keyfunc(read))
+                    shard_key_list.append(shard_keys)
+            # reads of one key are in one shard
+            self.assertEqual(sum(len(keys) for keys in shard_key_list), len(set.union(*shard_key_list)))
+            self.assertEqual(names, shard_names)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,18 +2,27 @@ import glob
 import re
 import sys
 import unittest
-from collections import Counter, defaultdict
+from collections import Counter, defaultdict, deque
 from itertools import combinations, product
+from multiprocessing import Pool
 
+import numpy as np
 import pysam
 from xopen import xopen
 
 from celescope.tools import utils
 from celescope.tools.__init__ import PATTERN_DICT
+from celescope.tools.barcode_index import BarcodeIndex
 from celescope.__init__ import ROOT_PATH, HELP_DICT
 from celescope.tools.step import Step, s_common
 
 MIN_T = 10
+# read pairs per chunk when filtering reads
+CHUNK_SIZE = 100000
+# uint8 base -> complement base
+COMPLEMENT = np.arange(256, dtype=np.uint8)
+for _base, _complement_base in zip(b'ACGTN', b'TGCAN'):
+    COMPLEMENT[_base] = _complement_base
 
 
 class Chemistry():
@@ -160,6 +169,9 @@ class Barcode(Step):
 
     - `01.barcode/{sample}_2.fq(.gz)` Demultiplexed R2 reads. Barcode and UMI are contained in the read name. The format of 
     the read name is `{barcode}_{UMI}_{read ID}`.
+
+    If `--thread` is greater than 1, reads are filtered in chunks by `--thread` worker processes. Output order and metrics 
+    are the same as running with a single thread.
     """
 
     def __init__(self, args, display_title=None):
@@ -176,6 +188,7 @@ class Barcode(Step):
         else:
             self.chemistry_list = [args.chemistry] * self.fq_number
         self.barcode_corrected_num = 0
+        self.barcode_ambiguous_num = 0
         self.linker_corrected_num = 0
         self.total_num = 0
         self.clean_num = 0
@@ -413,22 +426,57 @@ class Barcode(Step):
         corrected_seq = ''
         for index, seq in enumerate(seq_list):
             if seq not in correct_set_list[index]:
-                if seq not in mismatch_dict_list[index]:
+                mismatch_seq = mismatch_dict_list[index].get(seq)
+                if mismatch_seq is None:
                     bool_valid = False
                     return bool_valid, bool_corrected, corrected_seq
                 else:
                     bool_corrected = True
-                    corrected_seq += mismatch_dict_list[index][seq]
+                    corrected_seq += mismatch_seq
             else:
                 corrected_seq += seq
         return bool_valid, bool_corrected, corrected_seq
 
+    @staticmethod
+    def check_seq_index(seq_list, correct_set_list, index_list):
+        """
+        Same as check_seq_mismatch, but use BarcodeIndex and also report ambiguous correction.
+
+        Returns:
+            bool_valid, bool_corrected, bool_ambiguous, corrected_seq
+            bool_ambiguous: True if any seq has more than one nearest whitelist seq.
+
+        >>> seq_list = ['ATA', 'AAT']
+        >>> correct_set_list = [{'AAA', 'TTA'}] * 2
+        >>> index_list = [BarcodeIndex(['AAA', 'TTA'])] * 2
+        >>> Barcode.check_seq_index(seq_list, correct_set_list, index_list)
+        (True, True, True, 'TTAAAA')
+        """
+        bool_corrected = False
+        bool_ambiguous = False
+        corrected_seq = ''
+        for index, seq in enumerate(seq_list):
+            if seq in correct_set_list[index]:
+                corrected_seq += seq
+                continue
+            mismatch_seq, _n_mismatch, bool_seq_ambiguous = index_list[index].query(seq)
+            if mismatch_seq is None:
+                return False, False, False, ''
+            bool_corrected = True
+            bool_ambiguous = bool_ambiguous or bool_seq_ambiguous
+            corrected_seq += mismatch_seq
+        return True, bool_corrected, bool_ambiguous, corrected_seq
+
     @staticmethod
     def parse_whitelist_file(whitelist_file, n_mismatch, n_repeat):
+        """
+        Returns:
+            barcode_set_list, barcode_mismatch_list(list of BarcodeIndex)
+        """
         barcode_list, _ = utils.read_one_col(whitelist_file)
         barcode_set = set(barcode_list)
-        barcode_mismatch_dict = Barcode.get_mismatch_dict(barcode_list, n_mismatch)
-        barcode_mismatch_list = [barcode_mismatch_dict] * n_repeat
+        barcode_index = BarcodeIndex(barcode_list, n_mismatch)
+        barcode_mismatch_list = [barcode_index] * n_repeat
         barcode_set_list = [barcode_set] * n_repeat
         return barcode_set_list, barcode_mismatch_list
 
@@ -567,6 +615,13 @@ class Barcode(Step):
             show=False,
         )
 
+        self.add_metric(
+            name='Ambiguous Corrected Barcode Reads',
+            value=self.barcode_ambiguous_num,
+            total=self.total_num,
+            show=False,
+        )
+
         if self.clean_num == 0:
             raise Exception('no valid reads found! please check the --chemistry parameter.' + HELP_DICT['chemistry'])
         
@@ -585,6 +640,93 @@ class Barcode(Step):
             )
 
 
+    @staticmethod
+    def read_chunks(fq1_file, fq2_file, chunk_size=CHUNK_SIZE):
+        """
+        Yield lists of (header1, seq1, qual1, header2, seq2, qual2) with at most chunk_size read pairs.
+        """
+        with pysam.FastxFile(fq1_file, persist=False) as fq1, \
+                pysam.FastxFile(fq2_file, persist=False) as fq2:
+            chunk = []
+            for entry1, entry2 in zip(fq1, fq2):
+                chunk.append((
+                    entry1.name, entry1.sequence, entry1.quality,
+                    entry2.name, entry2.sequence, entry2.quality,
+                ))
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+    def filter_chunks(self, read_filter, chunks):
+        """
+        Yield filter results of chunks in input order.
+        If thread > 1, chunks are filtered in a process pool. At most 2 * thread chunks are in flight.
+        """
+        if self.thread <= 1:
+            for chunk in chunks:
+                yield read_filter.filter_chunk(chunk)
+            return
+
+        max_pending = self.thread * 2
+        with Pool(self.thread, initializer=_init_read_filter, initargs=(read_filter,)) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(_filter_chunk, (chunk,)))
+                if len(pending) >= max_pending:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+
+    def write_chunk_result(self, result):
+        """
+        Merge counters of one filtered chunk and write its reads.
+        Read ID in the read name is the 1-based index of the read among all input fastq files.
+        """
+        chunk_start = self.total_num
+        self.total_num += result['n_read']
+        self.no_polyT_num += result['no_polyT_num']
+        self.lowQual_num += result['lowQual_num']
+        self.no_linker_num += result['no_linker_num']
+        self.linker_corrected_num += result['linker_corrected_num']
+        self.no_barcode_num += result['no_barcode_num']
+        self.barcode_corrected_num += result['barcode_corrected_num']
+        self.barcode_ambiguous_num += result['barcode_ambiguous_num']
+        self.clean_num += len(result['valid'])
+        self.barcode_qual_Counter.update(result['barcode_qual_Counter'])
+        self.umi_qual_Counter.update(result['umi_qual_Counter'])
+
+        if self.nopolyT:
+            for header1, seq1, qual1, header2, seq2, qual2 in result['no_polyT']:
+                self.fh_nopolyT_fq1.write(utils.fastq_line(header1, seq1, qual1))
+                self.fh_nopolyT_fq2.write(utils.fastq_line(header2, seq2, qual2))
+
+        if self.noLinker:
+            for header1, seq1, qual1, header2, seq2, qual2 in result['no_linker']:
+                self.fh_nolinker_fq1.write(utils.fastq_line(header1, seq1, qual1))
+                self.fh_nolinker_fq2.write(utils.fastq_line(header2, seq2, qual2))
+
+        for offset, cb, umi, seq1, qual1, seq2, qual2 in result['valid']:
+            read_index = chunk_start + offset + 1
+            if self.bool_flv:
+                qual1 = 'F' * len(cb + umi)
+                self.barcode_read_Counter.update(cb)
+                if self._assay == 'flv_trust4' and cb in self.match_barcodes:
+                    self.match_num += 1
+                    self.match_cbs.add(cb)
+                    if self.barcode_read_Counter[cb] <= 80000:
+                        self.fh_fq2.write(f'@{cb}_{umi}_{read_index}\n{seq2}\n+\n{qual2}\n')
+                        self.fh_fq1.write(f'@{cb}_{umi}_{read_index}\n{cb}{umi}\n+\n{qual1}\n')
+                elif self._assay == 'flv_CR':
+                    self.fh_fq2.write(f'@{cb}_{umi}_{read_index}\n{seq2}\n+\n{qual2}\n')
+                    self.fh_fq1.write(f'@{cb}_{umi}_{read_index}\n{cb}{umi}\n+\n{qual1}\n')
+
+            else:
+                self.fh_fq2.write(f'@{cb}_{umi}_{read_index}\n{seq2}\n+\n{qual2}\n')
+                if self.output_R1:
+                    self.fh_fq1.write(f'@{cb}_{umi}_{read_index}\n{seq1}\n+\n{qual1}\n')
+
     @utils.add_log
     def run(self):
         """
@@ -597,9 +739,9 @@ class Barcode(Step):
         for every sample
             get chemistry
             get linker_mismatch_dict and barcode_mismatch_dict
-            for every read in read1
-                filter
-                write valid R2 read to file
+            for every chunk of reads in read1 and read2
+                filter(in worker processes if thread > 1)
+                write valid R2 read to file in input order
         """
 
         for i in range(self.fq_number):
@@ -624,105 +766,339 @@ class Barcode(Step):
 
             pattern_dict = self.parse_pattern(bc_pattern)
 
-            bool_T = True if 'T' in pattern_dict else False
             bool_L = True if 'L' in pattern_dict else False
             bool_whitelist = (whitelist_file is not None) and whitelist_file != "None"
-            C_len = sum([item[1] - item[0] for item in pattern_dict['C']])
 
+            barcode_set_list, barcode_mismatch_list = None, None
+            linker_set_list, linker_mismatch_list = None, None
             if bool_whitelist:
                 barcode_set_list, barcode_mismatch_list = Barcode.parse_whitelist_file(whitelist_file,
                                                                                n_mismatch=1, n_repeat=len(pattern_dict['C']))
             if bool_L:
                 linker_set_list, linker_mismatch_list = Barcode.parse_linker_file(linker_file)
 
-            with pysam.FastxFile(self.fq1_list[i], persist=False) as fq1, \
-                    pysam.FastxFile(self.fq2_list[i], persist=False) as fq2:
-                for entry1, entry2 in zip(fq1, fq2):
-                    header1, seq1, qual1 = entry1.name, entry1.sequence, entry1.quality
-                    header2, seq2, qual2 = entry2.name, entry2.sequence, entry2.quality
-                    self.total_num += 1
-
-                    # polyT filter
-                    if bool_T and self.filterNoPolyT:
-                        if not Barcode.check_polyT(seq1, pattern_dict):
-                            self.no_polyT_num += 1
-                            if self.nopolyT:
-                                self.fh_nopolyT_fq1.write(
-                                    '@%s\n%s\n+\n%s\n' % (header1, seq1, qual1))
-                                self.fh_nopolyT_fq2.write(
-                                    '@%s\n%s\n+\n%s\n' % (header2, seq2, qual2))
-                            continue
-
-                    # lowQual filter
-                    C_U_quals_ascii = Barcode.get_seq_str(
-                        qual1, pattern_dict['C'] + pattern_dict['U'])
-                    if lowQual > 0 and Barcode.low_qual(C_U_quals_ascii, lowQual, lowNum):
-                        self.lowQual_num += 1
-                        continue
-
-                    # linker filter
-                    if bool_L and (not self.allowNoLinker):
-                        seq_str = Barcode.get_seq_str(seq1, pattern_dict['L'])
-                        bool_valid, bool_corrected, _ = Barcode.check_seq_mismatch(
-                            [seq_str], linker_set_list, linker_mismatch_list)
-                        if not bool_valid:
-                            self.no_linker_num += 1
-                            if self.noLinker:
-                                self.fh_noLinker_fq1(
-                                    '@%s\n%s\n+\n%s\n' % (header1, seq1, qual1))
-                                self.fh_noLinker_fq2(
-                                    '@%s\n%s\n+\n%s\n' % (header2, seq2, qual2))
-                            continue
-                        elif bool_corrected:
-                            self.linker_corrected_num += 1
-
-                    # barcode filter
-                    seq_list = self.get_seq_list(seq1, pattern_dict, 'C')
-                    if chemistry == 'flv':
-                        seq_list = [utils.reverse_complement(seq) for seq in seq_list[::-1]]
-                    if bool_whitelist:
-                        bool_valid, bool_corrected, corrected_seq = Barcode.check_seq_mismatch(
-                            seq_list, barcode_set_list, barcode_mismatch_list)
-
-                        if not bool_valid:
-                            self.no_barcode_num += 1
-                            continue
-                        elif bool_corrected:
-                            self.barcode_corrected_num += 1
-                        cb = corrected_seq
-                    else:
-                        cb = "".join(seq_list)
-
-                    self.clean_num += 1
-                    self.barcode_qual_Counter.update(C_U_quals_ascii[:C_len])
-                    self.umi_qual_Counter.update(C_U_quals_ascii[C_len:])
-
-                    umi = Barcode.get_seq_str(seq1, pattern_dict['U'])
-
-                    if self.bool_flv:
-                        qual1 = 'F' * len(cb + umi)
-                        self.barcode_read_Counter.update(cb)
-                        if self._assay == 'flv_trust4' and cb in self.match_barcodes:
-                            self.match_num += 1
-                            self.match_cbs.add(cb)
-                            if self.barcode_read_Counter[cb] <= 80000:
-                                self.fh_fq2.write(f'@{cb}_{umi}_{self.total_num}\n{seq2}\n+\n{qual2}\n')
-                                self.fh_fq1.write(f'@{cb}_{umi}_{self.total_num}\n{cb}{umi}\n+\n{qual1}\n')
-                        elif self._assay == 'flv_CR':
-                            self.fh_fq2.write(f'@{cb}_{umi}_{self.total_num}\n{seq2}\n+\n{qual2}\n')
-                            self.fh_fq1.write(f'@{cb}_{umi}_{self.total_num}\n{cb}{umi}\n+\n{qual1}\n')
-
-                    else:
-                        self.fh_fq2.write(f'@{cb}_{umi}_{self.total_num}\n{seq2}\n+\n{qual2}\n')
-                        if self.output_R1:
-                            self.fh_fq1.write(f'@{cb}_{umi}_{self.total_num}\n{seq1}\n+\n{qual1}\n')                   
-            
-                self.run.logger.info(self.fq1_list[i] + ' finished.')
+            read_filter = ReadFilter(
+                chemistry=chemistry,
+                pattern_dict=pattern_dict,
+                lowQual=lowQual,
+                lowNum=lowNum,
+                filterNoPolyT=self.filterNoPolyT,
+                allowNoLinker=self.allowNoLinker,
+                barcode_set_list=barcode_set_list,
+                barcode_mismatch_list=barcode_mismatch_list,
+                linker_set_list=linker_set_list,
+                linker_mismatch_list=linker_mismatch_list,
+            )
+
+            chunks = Barcode.read_chunks(self.fq1_list[i], self.fq2_list[i])
+            for result in self.filter_chunks(read_filter, chunks):
+                self.write_chunk_result(result)
+
+            self.run.logger.info(self.fq1_list[i] + ' finished.')
 
         self.close_files()
         self.add_step_metrics()
 
 
+class ReadFilter():
+    """
+    polyT, quality, linker and barcode filter of R1 reads.
+    Holds no output file handles so that it can be sent to worker processes.
+    """
+
+    def __init__(self, chemistry, pattern_dict, lowQual, lowNum, filterNoPolyT=False, allowNoLinker=False,
+                 barcode_set_list=None, barcode_mismatch_list=None, linker_set_list=None, linker_mismatch_list=None):
+        self.chemistry = chemistry
+        self.pattern_dict = pattern_dict
+        self.lowQual = lowQual
+        self.lowNum = lowNum
+        self.filterNoPolyT = filterNoPolyT
+        self.allowNoLinker = allowNoLinker
+        self.barcode_set_list = barcode_set_list
+        self.barcode_mismatch_list = barcode_mismatch_list
+        self.linker_set_list = linker_set_list
+        self.linker_mismatch_list = linker_mismatch_list
+
+        self.bool_T = True if 'T' in pattern_dict else False
+        self.bool_L = True if 'L' in pattern_dict else False
+        self.bool_whitelist = barcode_set_list is not None
+        self.C_len = sum([item[1] - item[0] for item in pattern_dict['C']])
+        self.C_U_intervals = pattern_dict['C'] + pattern_dict['U']
+
+        # column indices for the array path
+        self.pattern_len = max([item[1] for intervals in pattern_dict.values() for item in intervals], default=0)
+        self.C_cols_list = [np.arange(start, end) for start, end in pattern_dict['C']]
+        self.C_cols = ReadFilter.get_cols(pattern_dict['C'])
+        self.U_cols = ReadFilter.get_cols(pattern_dict['U'])
+        self.L_cols = ReadFilter.get_cols(pattern_dict.get('L', []))
+        self.T_cols = ReadFilter.get_cols(pattern_dict.get('T', []))
+        self.C_U_cols = ReadFilter.get_cols(self.C_U_intervals)
+
+    @staticmethod
+    def get_cols(intervals):
+        """
+        >>> ReadFilter.get_cols([[0, 2], [4, 6]])
+        array([0, 1, 4, 5])
+        """
+        if not intervals:
+            return np.array([], dtype=np.intp)
+        return np.concatenate([np.arange(start, end) for start, end in intervals])
+
+    @staticmethod
+    def to_uint8_matrix(str_list, width):
+        """
+        Truncate str to width and convert to a (len(str_list), width) uint8 matrix.
+
+        >>> ReadFilter.to_uint8_matrix(['ACGT', 'TTTTA'], 4)
+        array([[65, 67, 71, 84],
+               [84, 84, 84, 84]], dtype=uint8)
+        """
+        return np.array(str_list, dtype=f'S{width}').view(np.uint8).reshape(len(str_list), width)
+
+    @staticmethod
+    def to_str_list(mat):
+        """
+        Convert rows of a uint8 matrix to str.
+
+        >>> ReadFilter.to_str_list(np.array([[65, 67], [71, 84]], dtype=np.uint8))
+        ['AC', 'GT']
+        """
+        n_row, width = mat.shape
+        if width == 0:
+            return [''] * n_row
+        return np.ascontiguousarray(mat).view(f'S{width}').ravel().astype(str).tolist()
+
+    @staticmethod
+    def qual_counter(qual_mat):
+        """
+        Counter of quality chars in a uint8 matrix.
+        """
+        counts = np.bincount(qual_mat.ravel(), minlength=256)
+        return Counter({chr(q): int(counts[q]) for q in np.flatnonzero(counts)})
+
+    def filter_chunk(self, chunk):
+        """
+        Use the array path if all R1 reads are long enough for the pattern.
+        Otherwise, use the per-read path, which raises IndexError for short reads.
+        """
+        if self.pattern_len > 0 and min(len(read_pair[1]) for read_pair in chunk) >= self.pattern_len:
+            return self.filter_chunk_array(chunk)
+        return self.filter_chunk_per_read(chunk)
+
+    @staticmethod
+    def init_result(n_read):
+        return {
+            'n_read': n_read,
+            'no_polyT_num': 0,
+            'lowQual_num': 0,
+            'no_linker_num': 0,
+            'linker_corrected_num': 0,
+            'no_barcode_num': 0,
+            'barcode_corrected_num': 0,
+            'barcode_ambiguous_num': 0,
+            'barcode_qual_Counter': Counter(),
+            'umi_qual_Counter': Counter(),
+            'no_polyT': [],
+            'no_linker': [],
+            'valid': [],
+        }
+
+    def filter_chunk_array(self, chunk):
+        """
+        Same result as filter_chunk_per_read. R1 sequences and qualities of the whole chunk are loaded into 
+        uint8 matrices. PolyT counts, low quality masks and C/L/U segments are computed with array operations. 
+        Only linker and barcode whitelist lookup are done per read.
+
+        >>> pattern_dict = Barcode.parse_pattern("C2L2C2U2T10")
+        >>> read_filter = ReadFilter("customized", pattern_dict, lowQual=20, lowNum=1, filterNoPolyT=True,
+        ...     barcode_set_list=[{'AA'}, {'TT'}], barcode_mismatch_list=[BarcodeIndex(['AA']), BarcodeIndex(['TT'])],
+        ...     linker_set_list=[{'GG'}], linker_mismatch_list=[{'GC': 'GG'}])
+        >>> chunk = [
+        ...     ('r1', 'AAGGTTCC' + 'T' * 10, 'F' * 18, 'r1', 'ACGT', 'FFFF'),
+        ...     ('r2', 'ACGCTTCC' + 'T' * 10, 'F' * 18, 'r2', 'ACGT', 'FFFF'),
+        ...     ('r3', 'AAGGTTCC' + 'A' * 10, 'F' * 18, 'r3', 'ACGT', 'FFFF'),
+        ...     ('r4', 'AAGGTTCC' + 'T' * 10, '##' + 'F' * 16, 'r4', 'ACGT', 'FFFF'),
+        ...     ('r5', 'AAGGGGCC' + 'T' * 10, 'F' * 18, 'r5', 'ACGT', 'FFFF'),
+        ... ]
+        >>> result = read_filter.filter_chunk_array(chunk)
+        >>> [read[:3] for read in result['valid']]
+        [(0, 'AATT', 'CC'), (1, 'AATT', 'CC')]
+        >>> result == read_filter.filter_chunk_per_read(chunk)
+        True
+        """
+        pattern_dict = self.pattern_dict
+        n_read = len(chunk)
+        result = ReadFilter.init_result(n_read)
+        width = self.pattern_len
+        seq_mat = ReadFilter.to_uint8_matrix([read_pair[1] for read_pair in chunk], width)
+        qual_mat = ReadFilter.to_uint8_matrix([read_pair[2] for read_pair in chunk], width)
+
+        # polyT filter
+        if self.bool_T and self.filterNoPolyT:
+            bool_polyT = (seq_mat[:, self.T_cols] == ord('T')).sum(axis=1) >= MIN_T
+        else:
+            bool_polyT = np.ones(n_read, dtype=bool)
+
+        # lowQual filter
+        if self.lowQual > 0:
+            n_low = (qual_mat[:, self.C_U_cols].astype(np.int16) - 33 < self.lowQual).sum(axis=1)
+            bool_low_qual = n_low > self.lowNum
+        else:
+            bool_low_qual = np.zeros(n_read, dtype=bool)
+
+        result['no_polyT_num'] = int(np.sum(~bool_polyT))
+        result['no_polyT'] = [chunk[index] for index in np.flatnonzero(~bool_polyT)]
+        result['lowQual_num'] = int(np.sum(bool_polyT & bool_low_qual))
+
+        candidate_index = np.flatnonzero(bool_polyT & ~bool_low_qual)
+        seq_mat = seq_mat[candidate_index]
+
+        check_linker = self.bool_L and (not self.allowNoLinker)
+        if check_linker:
+            linker_list = ReadFilter.to_str_list(seq_mat[:, self.L_cols])
+        if self.chemistry == 'flv':
+            C_mat_list = [COMPLEMENT[seq_mat[:, cols[::-1]]] for cols in self.C_cols_list[::-1]]
+        else:
+            C_mat_list = [seq_mat[:, cols] for cols in self.C_cols_list]
+        C_str_lists = [ReadFilter.to_str_list(C_mat) for C_mat in C_mat_list]
+        umi_list = ReadFilter.to_str_list(seq_mat[:, self.U_cols])
+
+        valid_index = []
+        for i, offset in enumerate(candidate_index.tolist()):
+            # linker filter
+            if check_linker:
+                bool_valid, bool_corrected, _ = Barcode.check_seq_mismatch(
+                    [linker_list[i]], self.linker_set_list, self.linker_mismatch_list)
+                if not bool_valid:
+                    result['no_linker_num'] += 1
+                    result['no_linker'].append(chunk[offset])
+                    continue
+                elif bool_corrected:
+                    result['linker_corrected_num'] += 1
+
+            # barcode filter
+            seq_list = [C_str_list[i] for C_str_list in C_str_lists]
+            if self.bool_whitelist:
+                bool_valid, bool_corrected, bool_ambiguous, corrected_seq = Barcode.check_seq_index(
+                    seq_list, self.barcode_set_list, self.barcode_mismatch_list)
+
+                if not bool_valid:
+                    result['no_barcode_num'] += 1
+                    continue
+                elif bool_corrected:
+                    result['barcode_corrected_num'] += 1
+                    if bool_ambiguous:
+                        result['barcode_ambiguous_num'] += 1
+                cb = corrected_seq
+            else:
+                cb = "".join(seq_list)
+
+            valid_index.append(offset)
+            _header1, seq1, qual1, _header2, seq2, qual2 = chunk[offset]
+            result['valid'].append((offset, cb, umi_list[i], seq1, qual1, seq2, qual2))
+
+        valid_qual_mat = qual_mat[valid_index]
+        result['barcode_qual_Counter'] = ReadFilter.qual_counter(valid_qual_mat[:, self.C_cols])
+        result['umi_qual_Counter'] = ReadFilter.qual_counter(valid_qual_mat[:, self.U_cols])
+
+        return result
+
+    def filter_chunk_per_read(self, chunk):
+        """
+        Args:
+            chunk: list of (header1, seq1, qual1, header2, seq2, qual2)
+
+        Returns:
+            dict with read counters, quality Counters, and
+            - no_polyT, no_linker: list of filtered read pairs
+            - valid: list of (offset in chunk, cb, umi, seq1, qual1, seq2, qual2)
+
+        >>> pattern_dict = Barcode.parse_pattern("C2L2U2T10")
+        >>> read_filter = ReadFilter("customized", pattern_dict, lowQual=0, lowNum=2, filterNoPolyT=True,
+        ...     linker_set_list=[{'GG'}], linker_mismatch_list=[{}])
+        >>> chunk = [
+        ...     ('r1', 'AAGGCC' + 'T' * 10, 'F' * 16, 'r1', 'ACGT', 'FFFF'),
+        ...     ('r2', 'AACCCC' + 'T' * 10, 'F' * 16, 'r2', 'ACGT', 'FFFF'),
+        ...     ('r3', 'AAGGCC' + 'A' * 10, 'F' * 16, 'r3', 'ACGT', 'FFFF'),
+        ... ]
+        >>> result = read_filter.filter_chunk(chunk)
+        >>> result['valid']
+        [(0, 'AA', 'CC', 'AAGGCCTTTTTTTTTT', 'FFFFFFFFFFFFFFFF', 'ACGT', 'FFFF')]
+        >>> result['no_linker_num'], result['no_polyT_num']
+        (1, 1)
+        """
+        pattern_dict = self.pattern_dict
+        result = ReadFilter.init_result(len(chunk))
+
+        for offset, read_pair in enumerate(chunk):
+            _header1, seq1, qual1, _header2, seq2, qual2 = read_pair
+
+            # polyT filter
+            if self.bool_T and self.filterNoPolyT:
+                if not Barcode.check_polyT(seq1, pattern_dict):
+                    result['no_polyT_num'] += 1
+                    result['no_polyT'].append(read_pair)
+                    continue
+
+            # lowQual filter
+            C_U_quals_ascii = Barcode.get_seq_str(qual1, self.C_U_intervals)
+            if self.lowQual > 0 and Barcode.low_qual(C_U_quals_ascii, self.lowQual, self.lowNum):
+                result['lowQual_num'] += 1
+                continue
+
+            # linker filter
+            if self.bool_L and (not self.allowNoLinker):
+                seq_str = Barcode.get_seq_str(seq1, pattern_dict['L'])
+                bool_valid, bool_corrected, _ = Barcode.check_seq_mismatch(
+                    [seq_str], self.linker_set_list, self.linker_mismatch_list)
+                if not bool_valid:
+                    result['no_linker_num'] += 1
+                    result['no_linker'].append(read_pair)
+                    continue
+                elif bool_corrected:
+                    result['linker_corrected_num'] += 1
+
+            # barcode filter
+            seq_list = Barcode.get_seq_list(seq1, pattern_dict, 'C')
+            if self.chemistry == 'flv':
+                seq_list = [utils.reverse_complement(seq) for seq in seq_list[::-1]]
+            if self.bool_whitelist:
+                bool_valid, bool_corrected, bool_ambiguous, corrected_seq = Barcode.check_seq_index(
+                    seq_list, self.barcode_set_list, self.barcode_mismatch_list)
+
+                if not bool_valid:
+                    result['no_barcode_num'] += 1
+                    continue
+                elif bool_corrected:
+                    result['barcode_corrected_num'] += 1
+                    if bool_ambiguous:
+                        result['barcode_ambiguous_num'] += 1
+                cb = corrected_seq
+            else:
+                cb = "".join(seq_list)
+
+            result['barcode_qual_Counter'].update(C_U_quals_ascii[:self.C_len])
+            result['umi_qual_Counter'].update(C_U_quals_ascii[self.C_len:])
+
+            umi = Barcode.get_seq_str(seq1, pattern_dict['U'])
+            result['valid'].append((offset, cb, umi, seq1, qual1, seq2, qual2))
+
+        return result
+
+
+# read filter of worker processes. Set once by the pool initializer to avoid pickling whitelists for every chunk.
+_worker_read_filter = None
+
+
+def _init_read_filter(read_filter):
+    global _worker_read_filter
+    _worker_read_filter = read_filter
+
+
+def _filter_chunk(chunk):
+    return _worker_read_filter.filter_chunk(chunk)
+
+
 @utils.add_log
 def barcode(args):
     with Barcode(args, display_title='Demultiplexing') as runner:
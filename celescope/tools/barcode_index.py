@@ -0,0 +1,220 @@
+"""
+Barcode whitelist index with mismatch lookup.
+"""
+
+import unittest
+from collections import defaultdict
+
+BASE_CODE = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+# N in query sequence is always a mismatch
+N_BASE = 'N'
+# '01' repeated. Long enough for sequences up to 512 bases.
+LOW_BIT_MASK = int('01' * 512, 2)
+
+
+def encode_seq(seq):
+    """
+    Pack seq into an int with 2 bits per base.
+
+    Returns:
+        code: int. N is encoded as A.
+        n_mask: int. '11' at the positions of N.
+        None if seq contains bases other than ACGTN.
+
+    >>> encode_seq('ACGT')
+    (27, 0)
+    >>> encode_seq('ANGT')
+    (11, 48)
+    >>> encode_seq('AXGT') is None
+    True
+    """
+    code = 0
+    n_mask = 0
+    for base in seq:
+        code <<= 2
+        n_mask <<= 2
+        if base in BASE_CODE:
+            code |= BASE_CODE[base]
+        elif base == N_BASE:
+            n_mask |= 3
+        else:
+            return None
+    return code, n_mask
+
+
+class BarcodeIndex:
+    """
+    Find the nearest whitelist sequence within n_mismatch of a query sequence.
+
+    Sequences are packed into ints (2 bits per base). Each sequence is split into n_mismatch + 1 segments, and
+    one sub-index is built for each segment. A whitelist sequence with at most n_mismatch mismatches shares at least
+    one segment with the query(pigeonhole principle), so only sequences in the matching segment buckets are compared.
+
+    A query is ambiguous if more than one whitelist sequence has the minimum number of mismatches. To be compatible
+    with the mismatch dict, which keeps the last written sequence, the one appearing last in seq_list is returned.
+
+    Can be used like the mismatch dict from `Barcode.get_mismatch_dict`: `seq in index`, `index[seq]` and `index.get(seq)`.
+    """
+
+    def __init__(self, seq_list, n_mismatch=1, value_list=None):
+        """
+        Args:
+            seq_list: whitelist sequences. Sequences must consist of ACGT. Empty sequences are skipped.
+            n_mismatch: max mismatch allowed
+            value_list: values returned for each sequence in seq_list. Default is the sequence itself.
+        """
+        self.n_mismatch = n_mismatch
+        self.seq_list = []
+        self.value_list = []
+        self.code_list = []
+        # seq length: [(start, end) of each segment]
+        self.segments = {}
+        # (seq length, segment index, segment code): [seq index]
+        self.sub_index = defaultdict(list)
+
+        if value_list is None:
+            value_list = seq_list
+        for seq, value in zip(seq_list, value_list):
+            seq = seq.strip()
+            if seq == '':
+                continue
+            encoded = encode_seq(seq)
+            if encoded is None or encoded[1]:
+                raise ValueError(f'Invalid base in whitelist sequence: {seq}')
+            seq_len = len(seq)
+            if seq_len not in self.segments:
+                self.segments[seq_len] = BarcodeIndex.split_segments(seq_len, n_mismatch)
+
+            seq_index = len(self.seq_list)
+            self.seq_list.append(seq)
+            self.value_list.append(value)
+            self.code_list.append(encoded[0])
+            for segment_index, segment_code in self.iter_segment_codes(seq_len, encoded[0], 0):
+                self.sub_index[(seq_len, segment_index, segment_code)].append(seq_index)
+
+    @staticmethod
+    def split_segments(seq_len, n_mismatch):
+        """
+        Split seq_len into n_mismatch + 1 segments as even as possible.
+
+        >>> BarcodeIndex.split_segments(8, 1)
+        [(0, 4), (4, 8)]
+        >>> BarcodeIndex.split_segments(15, 2)
+        [(0, 5), (5, 10), (10, 15)]
+        >>> BarcodeIndex.split_segments(3, 4)
+        [(0, 1), (1, 2), (2, 3)]
+        """
+        n_segment = min(n_mismatch + 1, seq_len)
+        return [(seq_len * i // n_segment, seq_len * (i + 1) // n_segment) for i in range(n_segment)]
+
+    def iter_segment_codes(self, seq_len, code, n_mask):
+        """
+        Yield (segment index, segment code) of segments without N.
+        """
+        for segment_index, (start, end) in enumerate(self.segments[seq_len]):
+            shift = 2 * (seq_len - end)
+            segment_mask = (1 << (2 * (end - start))) - 1
+            if (n_mask >> shift) & segment_mask:
+                continue
+            yield segment_index, (code >> shift) & segment_mask
+
+    @staticmethod
+    def count_mismatch(code1, code2, n_mask):
+        """
+        Number of mismatch bases between two codes. Positions in n_mask are mismatches.
+
+        >>> code1, n_mask = encode_seq('ANGT')
+        >>> code2, _ = encode_seq('AAGG')
+        >>> BarcodeIndex.count_mismatch(code1, code2, n_mask)
+        2
+        """
+        diff = code1 ^ code2
+        diff = (diff | (diff >> 1) | n_mask) & LOW_BIT_MASK
+        return bin(diff).count('1')
+
+    def query(self, seq):
+        """
+        Returns:
+            (value, n_mismatch, bool_ambiguous). (None, None, False) if no whitelist sequence within n_mismatch.
+
+        >>> index = BarcodeIndex(['AACC', 'AAGG', 'TTTT'], n_mismatch=2)
+        >>> index.query('AACC')
+        ('AACC', 0, False)
+        >>> index.query('AACG')
+        ('AAGG', 1, True)
+        >>> index.query('TTTA')
+        ('TTTT', 1, False)
+        >>> index.query('CCGA')
+        (None, None, False)
+        """
+        seq_len = len(seq)
+        if seq_len not in self.segments:
+            return None, None, False
+        encoded = encode_seq(seq)
+        if encoded is None:
+            return None, None, False
+        code, n_mask = encoded
+
+        best_index = None
+        best_mismatch = self.n_mismatch + 1
+        bool_ambiguous = False
+        checked = set()
+        for segment_index, segment_code in self.iter_segment_codes(seq_len, code, n_mask):
+            for seq_index in self.sub_index.get((seq_len, segment_index, segment_code), ()):
+                if seq_index in checked:
+                    continue
+                checked.add(seq_index)
+                n_mismatch = BarcodeIndex.count_mismatch(code, self.code_list[seq_index], n_mask)
+                if n_mismatch > self.n_mismatch:
+                    continue
+                if n_mismatch < best_mismatch:
+                    best_index, best_mismatch, bool_ambiguous = seq_index, n_mismatch, False
+                elif n_mismatch == best_mismatch:
+                    bool_ambiguous = True
+                    best_index = max(best_index, seq_index)
+
+        if best_index is None:
+            return None, None, False
+        return self.value_list[best_index], best_mismatch, bool_ambiguous
+
+    def get(self, seq, default=None):
+        value, _, _ = self.query(seq)
+        if value is None:
+            return default
+        return value
+
+    def __contains__(self, seq):
+        return self.get(seq) is not None
+
+    def __getitem__(self, seq):
+        value = self.get(seq)
+        if value is None:
+            raise KeyError(seq)
+        return value
+
+    def __len__(self):
+        return len(self.seq_list)
+
+
+class Test_barcode_index(unittest.TestCase):
+    def test_same_as_mismatch_dict(self):
+        import random
+        from celescope.tools.barcode import Barcode
+
+        random.seed(0)
+        seq_list = [''.join(random.choice('ACGT') for _ in range(8)) for _ in range(50)]
+        for n_mismatch in (1, 2):
+            mismatch_dict = Barcode.get_mismatch_dict(seq_list, n_mismatch)
+            index = BarcodeIndex(seq_list, n_mismatch)
+            for _ in range(5000):
+                seq = ''.join(random.choice('ACGTN') for _ in range(8))
+                self.assertEqual(seq in mismatch_dict, seq in index)
+                value, _, bool_ambiguous = index.query(seq)
+                if not bool_ambiguous and value is not None:
+                    self.assertEqual(value, min(seq_list, key=lambda x: sum(a != b for a, b in zip(x, seq))))
+            for seq in mismatch_dict:
+                self.assertIn(seq, index)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,23 @@
-import json
-
-import pysam
 import numpy as np
 
 from celescope.tools import utils
+from celescope.tools.bam_count import ReadParser, count_reads
+from celescope.tools.capture.read_count import ReadCount, FORMATS
 from celescope.tools.step import Step, s_common
 from celescope.__init__ import HELP_DICT, HELP_INFO_DICT
 
 
 def get_opts_count_bam(parser, sub_program):
     parser.add_argument("--min_query_length", help='Minimum query length.', default=35)
+    parser.add_argument(
+        '--read_count_format',
+        help=(
+            'Format of read count files. `json`: nested barcode-ref-UMI dict. '
+            '`npz`: integer-encoded columns, which are much smaller and use less memory on high-coverage panels.'
+        ),
+        choices=FORMATS,
+        default='json',
+    )
 
     if sub_program:
         parser.add_argument('--match_dir', help=HELP_DICT['match_dir'], required=True)
@@ -17,6 +25,22 @@ def get_opts_count_bam(parser, sub_program):
         s_common(parser)
 
 
+class CaptureReadParser(ReadParser):
+    """
+    Skip unmapped reads and reads shorter than min_query_length.
+    """
+
+    def __init__(self, min_query_length):
+        self.min_query_length = min_query_length
+
+    def parse(self, read):
+        query_length = read.infer_query_length()
+        # unmapped reads have no CIGAR
+        if query_length is None or query_length < self.min_query_length:
+            return None
+        return super().parse(read)
+
+
 class Count_bam(Step):
 
     def __init__(self, args, display_title='Count'):
@@ -38,39 +62,30 @@ class Count_bam(Step):
 
         # data
         self.total_corrected_umi = 0
-        self.count_dict = utils.genDict(dim=3)
+        self.counts = None
 
         # out
-        self.raw_read_count_file = f'{self.out_prefix}_raw_read_count.json'
+        self.raw_read_count_file = f'{self.out_prefix}_raw_read_count.{args.read_count_format}'
 
     @utils.add_log
     def process_bam(self):
-        # process bam
-        samfile = pysam.AlignmentFile(self.args.capture_bam, "rb")
-        for read in samfile:
-            ref = read.reference_name
-            query_length = read.infer_query_length()
-            attr = read.query_name.split('_')
-            barcode = attr[0]
-            umi = attr[1]
-            if (barcode in self.match_barcode) and (query_length >= self.min_query_length):
-                self.count_dict[barcode][ref][umi] += 1
+        self.counts = count_reads(
+            self.capture_bam,
+            self.match_barcode,
+            parser=CaptureReadParser(self.min_query_length),
+            thread=self.thread,
+        )
 
     @utils.add_log
     def add_some_metrics(self):
-        read_count_list = []
-        for barcode in self.count_dict:
-            for ref in self.count_dict[barcode]:
-                for umi in self.count_dict[barcode][ref]:
-                    read_count_list.append(self.count_dict[barcode][ref][umi])
-        mean_read_count_per_umi = round(float(np.mean(read_count_list)), 2)
+        mean_read_count_per_umi = round(float(np.mean(self.counts.read_count)), 2)
         self.add_metric(
             name='Mead Read Count per UMI',
             value=mean_read_count_per_umi,
             help_info='you can use this value to determine `min_support_read`'
         )
 
-        n_positive_cell = len(self.count_dict)
+        n_positive_cell = self.counts.n_barcode
         self.add_metric(
             name='Number of positive cells',
             value=n_positive_cell,
@@ -80,9 +95,7 @@ class Count_bam(Step):
 
     @utils.add_log
     def write_count_file(self):
-
-        with open(self.raw_read_count_file, 'w') as fp:
-            json.dump(self.count_dict, fp, indent=4)
+        ReadCount.from_umi_counts(self.counts).write(self.raw_read_count_file)
 
     @utils.add_log
     def run(self):
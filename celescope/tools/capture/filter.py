@@ -1,11 +1,10 @@
-import json
-
+import numpy as np
 import pandas as pd
 
 from celescope.tools import utils
-from celescope.tools.count import Count
+from celescope.tools.capture.read_count import ReadCount, get_format
 from celescope.tools.step import Step, s_common
-from celescope.tools.capture.threshold import Threshold
+from celescope.tools.capture.threshold import get_thresholds
 from celescope.__init__ import HELP_DICT
 from celescope.tools.capture.__init__ import SUM_UMI_COLNAME
 
@@ -50,7 +49,7 @@ def get_opts_filter(parser, sub_program):
 
     if sub_program:
         parser.add_argument('--match_dir', help=HELP_DICT['match_dir'], required=True)
-        parser.add_argument('--raw_read_count_file', required=True)
+        parser.add_argument('--raw_read_count_file', help='Raw read count file(`.json` or `.npz`).', required=True)
         s_common(parser)
 
 
@@ -68,14 +67,15 @@ class Filter(Step):
     - `{sample}_corrected_read_count.json` Read counts after UMI correction.
     - `{sample}_filtered_read_count.json` Filtered read counts.
     - `{sample}_filtered_UMI.csv` Filtered UMI counts.
+    Read count files are `.npz` instead of `.json` if `raw_read_count_file` is `.npz`.
 
     """
     def __init__(self, args, display_title='Filtering'):
         super().__init__(args, display_title)
 
         # data
-        with open(args.raw_read_count_file) as f:
-            self.count_dict = json.load(f)
+        self.read_count = ReadCount.read(args.raw_read_count_file)
+        read_count_format = get_format(args.raw_read_count_file)
 
         self.raw_umi = 0
         self.total_corrected_umi = 0
@@ -83,27 +83,22 @@ class Filter(Step):
         self.read_threshold_dict = {}
         self.umi_threshold_dict = {}  # if not set explicitly, use 1 as default
 
-        self.barcode_ref_umi_dict = utils.genDict(dim=2)
-        self.ref_barcode_umi_dict = utils.genDict(dim=2)
+        # ref: pd.Series of UMI count per barcode
+        self.ref_barcode_umi_dict = {}
 
         match_dir_dict = utils.parse_match_dir(args.match_dir)
         self.match_barcode = match_dir_dict['match_barcode']
         self.df_filter_umi = pd.DataFrame(index=list(self.match_barcode)).rename_axis('barcode')
 
         # out
-        self.corrected_read_count_file = f'{self.out_prefix}_corrected_read_count.json'
-        self.filter_read_count_file = f'{self.out_prefix}_filtered_read_count.json'
+        self.corrected_read_count_file = f'{self.out_prefix}_corrected_read_count.{read_count_format}'
+        self.filter_read_count_file = f'{self.out_prefix}_filtered_read_count.{read_count_format}'
         self.filter_umi_file = f'{self.out_prefix}_filtered_UMI.csv'
 
     @utils.add_log
     def correct_umi(self):
-        for barcode in self.count_dict:
-            for ref in self.count_dict[barcode]:
-                self.raw_umi += len(self.count_dict[barcode][ref])
-                n_corrected_umi, _n_corrected_read = Count.correct_umi(self.count_dict[barcode][ref])
-                if self.debug:
-                    print(f'{barcode} {ref} {n_corrected_umi}')
-                self.total_corrected_umi += n_corrected_umi
+        self.raw_umi = len(self.read_count)
+        self.total_corrected_umi = self.read_count.correct_umi(debug=self.debug)
 
         self.add_metric(
             name='Number of Raw UMI',
@@ -118,10 +113,8 @@ class Filter(Step):
             help_info='correct sequencing errors in the UMI sequences ',
         )
 
-    @utils.add_log
-    def write_correct_umi_json(self):
-        with open(self.corrected_read_count_file, 'w') as fp:
-            json.dump(self.count_dict, fp, indent=4)
+    def write_corrected_read_count(self):
+        self.read_count.write(self.corrected_read_count_file)
 
     @utils.add_log
     def get_read_threshold(self):
@@ -141,27 +134,22 @@ class Filter(Step):
                 help_info='threshold = top 1% positive cell count / auto_coef',
             )
 
-        read_dict = utils.genDict(dim=1, valType=list)
-
-        for barcode in self.count_dict:
-            for ref in self.count_dict[barcode]:
-                read_dict[ref] += list(self.count_dict[barcode][ref].values())
-
+        refs = self.read_count.refs.tolist()
         if self.debug:
-            print(read_dict)
-
-        for ref in read_dict:              
-            otsu_plot_path = f'{self.out_prefix}_{ref}_read_otsu.png'
-            runner = Threshold(
-                array=read_dict[ref], 
-                threshold_method=self.args.read_threshold_method, 
-                otsu_plot_path=otsu_plot_path,
-                hard_threshold=self.args.read_hard_threshold,
-                coef=self.args.auto_coef,
-                log_base=self.args.otsu_log_base,
-            )
-            read_threshold = runner.run()
-            
+            for ref_index, ref in enumerate(refs):
+                print(ref, self.read_count.get_ref_read_count(ref_index).tolist())
+        read_thresholds = get_thresholds(
+            self.read_count.read_count,
+            self.read_count.ref_index,
+            len(refs),
+            thread=self.thread,
+            threshold_method=self.args.read_threshold_method,
+            otsu_plot_paths=[f'{self.out_prefix}_{ref}_read_otsu.png' for ref in refs],
+            hard_threshold=self.args.read_hard_threshold,
+            coef=self.args.auto_coef,
+            log_base=self.args.otsu_log_base,
+        )
+        for ref, read_threshold in zip(refs, read_thresholds):
             self.read_threshold_dict[ref] = read_threshold
             self.add_metric(
                 f'{ref} Read Threshold', 
@@ -171,13 +159,12 @@ class Filter(Step):
 
     @utils.add_log
     def filter_read(self):
-        for barcode in self.count_dict:
-            for ref in self.count_dict[barcode]:
-                for umi in self.count_dict[barcode][ref]:
-                    read_count = self.count_dict[barcode][ref][umi]
-                    if read_count < self.read_threshold_dict[ref]:
-                        self.del_umi += 1
-                        self.count_dict[barcode][ref][umi] = 0
+        read_threshold = np.array([self.read_threshold_dict[ref] for ref in self.read_count.refs.tolist()])
+        if len(read_threshold) == 0:
+            return
+        bool_filter = self.read_count.read_count < read_threshold[self.read_count.ref_index]
+        self.del_umi += int(bool_filter.sum())
+        self.read_count.read_count[bool_filter] = 0
 
         """
         self.add_metric(
@@ -187,28 +174,26 @@ class Filter(Step):
         )
         """
 
-    def write_filter_read_json(self):
-        with open(self.filter_read_count_file, 'w') as fp:
-            json.dump(self.count_dict, fp, indent=4)
-
-
-    @utils.add_log
-    def set_barcode_ref_umi_dict(self):
-
-        for barcode in self.count_dict:
-            for ref in self.count_dict[barcode]:
-                for umi in self.count_dict[barcode][ref]:
-                    if self.count_dict[barcode][ref][umi] > 0:
-                        self.barcode_ref_umi_dict[barcode][ref] += 1
-        if self.debug:
-            print(dict(self.barcode_ref_umi_dict))
+    def write_filter_read_count(self):
+        self.read_count.write(self.filter_read_count_file)
 
     @utils.add_log
     def set_ref_barcode_umi_dict(self):
-
-        for barcode in self.barcode_ref_umi_dict:
-            for ref in self.barcode_ref_umi_dict[barcode]:
-                self.ref_barcode_umi_dict[ref][barcode] = self.barcode_ref_umi_dict[barcode][ref]
+        """
+        Count UMIs with read_count > 0 of each (ref, barcode). refs are in the order of their first positive UMI.
+        """
+        read_count = self.read_count
+        bool_positive = read_count.read_count > 0
+        df = pd.DataFrame({
+            'ref_index': read_count.ref_index[bool_positive],
+            'barcode_index': read_count.barcode_index[bool_positive],
+        })
+        umi_count = df.groupby(['ref_index', 'barcode_index'], sort=False).size()
+        for ref_index, ref_umi_count in umi_count.groupby(level='ref_index', sort=False):
+            barcodes = read_count.barcodes[ref_umi_count.index.get_level_values('barcode_index')]
+            self.ref_barcode_umi_dict[read_count.refs[ref_index]] = pd.Series(ref_umi_count.values, index=barcodes)
+        if self.debug:
+            print(self.ref_barcode_umi_dict)
 
     def get_umi_threshold(self):
         self.add_metric(
@@ -224,19 +209,20 @@ class Filter(Step):
             help_info='threshold = top 1% positive cell count / auto_coef',
         )
 
-        for ref in self.ref_barcode_umi_dict:
-            umi_array = list(self.ref_barcode_umi_dict[ref].values())
-            otsu_plot_path = f'{self.out_prefix}_{ref}_UMI_otsu.png'
-            runner = Threshold(
-                umi_array, 
-                threshold_method=self.args.umi_threshold_method, 
-                otsu_plot_path=otsu_plot_path,
-                hard_threshold=self.args.umi_hard_threshold,
-                coef=self.args.auto_coef,
-                log_base=self.args.otsu_log_base,
-            )
-            umi_threshold = runner.run()
-            
+        refs = list(self.ref_barcode_umi_dict)
+        umi_arrays = [self.ref_barcode_umi_dict[ref].values for ref in refs]
+        umi_thresholds = get_thresholds(
+            np.concatenate(umi_arrays) if umi_arrays else np.array([], dtype=int),
+            np.repeat(np.arange(len(refs)), [len(umi_array) for umi_array in umi_arrays]),
+            len(refs),
+            thread=self.thread,
+            threshold_method=self.args.umi_threshold_method,
+            otsu_plot_paths=[f'{self.out_prefix}_{ref}_UMI_otsu.png' for ref in refs],
+            hard_threshold=self.args.umi_hard_threshold,
+            coef=self.args.auto_coef,
+            log_base=self.args.otsu_log_base,
+        )
+        for ref, umi_threshold in zip(refs, umi_thresholds):
             umi_threshold = max(1, umi_threshold)
             self.umi_threshold_dict[ref] = umi_threshold
             self.add_metric(f'{ref} UMI Threshold', umi_threshold)
@@ -244,16 +230,13 @@ class Filter(Step):
 
     @utils.add_log
     def filter_umi(self):
-        for ref in self.ref_barcode_umi_dict:
-            for barcode in self.ref_barcode_umi_dict[ref]:
-                if self.ref_barcode_umi_dict[ref][barcode] < self.umi_threshold_dict[ref]:
-                    self.ref_barcode_umi_dict[ref][barcode] = 0
+        for ref, barcode_umi in self.ref_barcode_umi_dict.items():
+            barcode_umi[barcode_umi < self.umi_threshold_dict[ref]] = 0
 
     @utils.add_log
     def add_umi_write_csv(self):
         for ref in self.umi_threshold_dict:
-            self.df_filter_umi[ref] = pd.Series(self.ref_barcode_umi_dict[ref])
-            self.df_filter_umi[ref].fillna(0, inplace=True)
+            self.df_filter_umi[ref] = self.ref_barcode_umi_dict[ref].reindex(self.df_filter_umi.index).fillna(0)
 
         refs = list(self.umi_threshold_dict.keys()) 
         self.df_filter_umi[SUM_UMI_COLNAME] = self.df_filter_umi[refs].sum(axis=1)
@@ -276,13 +259,12 @@ class Filter(Step):
     def run(self):
         if not self.args.not_correct_UMI:
             self.correct_umi()
-            self.write_correct_umi_json()
+            self.write_corrected_read_count()
 
         self.get_read_threshold()
         self.filter_read()
-        self.write_filter_read_json()
+        self.write_filter_read_count()
 
-        self.set_barcode_ref_umi_dict()
         self.set_ref_barcode_umi_dict()
         self.get_umi_threshold()
         self.filter_umi()
@@ -0,0 +1,213 @@
+"""
+Read counts of (barcode, ref, UMI) written by capture count steps and read by capture filter steps.
+
+Two formats are supported
+- json: nested `{barcode: {ref: {UMI: read_count}}}`.
+- npz: compressed integer-encoded columns `barcode_index ref_index umi_index read_count` and the unique
+    `barcodes refs umis` they refer to. Much smaller than json, and loading it does not build any nested dict.
+The format is chosen by the file suffix.
+"""
+
+import json
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from celescope.tools import utils
+from celescope.tools.count import Count
+
+FORMATS = ('json', 'npz')
+
+
+def get_format(read_count_file):
+    """
+    >>> get_format('sample_raw_read_count.npz')
+    'npz'
+    """
+    suffix = read_count_file.rsplit('.', 1)[-1]
+    if suffix not in FORMATS:
+        raise ValueError(f'Unknown read count file format: {read_count_file}. Suffix must be one of {FORMATS}.')
+    return suffix
+
+
+def factorize(index, names):
+    """
+    Returns:
+        unique names in the order of their first appearance in index, and codes of index in them.
+
+    >>> names, codes = factorize(np.array([2, 0, 2]), ['a', 'b', 'c'])
+    >>> names.tolist(), codes.tolist()
+    (['c', 'a'], [0, 1, 0])
+    """
+    codes, uniques = pd.factorize(index)
+    return np.array([names[i] for i in uniques], dtype=str), codes.astype(np.int32)
+
+
+class ReadCount:
+    """
+    Columnar read counts. Rows are grouped by barcode, then by ref, like iterating the nested json dict.
+    refs are in the order of their first row.
+    """
+
+    def __init__(self, barcodes, refs, umis, barcode_index, ref_index, umi_index, read_count):
+        self.barcodes = np.asarray(barcodes, dtype=str)
+        self.refs = np.asarray(refs, dtype=str)
+        self.umis = np.asarray(umis, dtype=str)
+        self.barcode_index = barcode_index
+        self.ref_index = ref_index
+        self.umi_index = umi_index
+        self.read_count = read_count
+
+    @classmethod
+    def from_umi_counts(cls, counts):
+        """
+        Args:
+            counts: `celescope.tools.bam_count.UmiCounts`. Features are refs.
+        """
+        order = counts.get_nested_order()
+        barcodes, barcode_index = factorize(counts.barcode_index[order], counts.barcodes)
+        refs, ref_index = factorize(counts.feature_index[order], counts.features)
+        umis, umi_index = factorize(counts.umi_index[order], counts.umis)
+        return cls(barcodes, refs, umis, barcode_index, ref_index, umi_index, counts.read_count[order])
+
+    @classmethod
+    def from_dict(cls, count_dict):
+        names = ([], [], [])
+        name_dicts = ({}, {}, {})
+        columns = ([], [], [], [])
+        for barcode, ref_dict in count_dict.items():
+            for ref, umi_dict in ref_dict.items():
+                for umi, read_count in umi_dict.items():
+                    for i, name in enumerate((barcode, ref, umi)):
+                        index = name_dicts[i].get(name)
+                        if index is None:
+                            index = len(names[i])
+                            name_dicts[i][name] = index
+                            names[i].append(name)
+                        columns[i].append(index)
+                    columns[3].append(read_count)
+        index_columns = [np.array(column, dtype=np.int32) for column in columns[:3]]
+        return cls(*names, *index_columns, np.array(columns[3], dtype=np.int64))
+
+    @classmethod
+    @utils.add_log
+    def read(cls, read_count_file):
+        if get_format(read_count_file) == 'json':
+            with open(read_count_file) as f:
+                return cls.from_dict(json.load(f))
+        with np.load(read_count_file) as data:
+            return cls(*(data[key] for key in (
+                'barcodes', 'refs', 'umis', 'barcode_index', 'ref_index', 'umi_index', 'read_count')))
+
+    @utils.add_log
+    def write(self, read_count_file):
+        if get_format(read_count_file) == 'json':
+            with open(read_count_file, 'w') as fp:
+                json.dump(self.to_dict(), fp, indent=4)
+            return
+        np.savez_compressed(
+            read_count_file,
+            barcodes=self.barcodes,
+            refs=self.refs,
+            umis=self.umis,
+            barcode_index=self.barcode_index,
+            ref_index=self.ref_index,
+            umi_index=self.umi_index,
+            read_count=self.read_count,
+        )
+
+    def __len__(self):
+        return len(self.read_count)
+
+    def to_dict(self):
+        count_dict = utils.genDict(dim=3)
+        barcodes, refs, umis = self.barcodes.tolist(), self.refs.tolist(), self.umis.tolist()
+        for barcode_index, ref_index, umi_index, read_count in zip(
+            self.barcode_index.tolist(), self.ref_index.tolist(), self.umi_index.tolist(), self.read_count.tolist()
+        ):
+            count_dict[barcodes[barcode_index]][refs[ref_index]][umis[umi_index]] = read_count
+        return count_dict
+
+    def iter_groups(self):
+        """
+        Yield:
+            barcode, ref, start, end. Rows in [start, end) are the UMIs of (barcode, ref).
+        """
+        n_row = len(self)
+        if n_row == 0:
+            return
+        is_start = np.ones(n_row, dtype=bool)
+        is_start[1:] = (self.barcode_index[1:] != self.barcode_index[:-1]) | (self.ref_index[1:] != self.ref_index[:-1])
+        starts = np.flatnonzero(is_start).tolist()
+        for start, end in zip(starts, starts[1:] + [n_row]):
+            yield self.barcodes[self.barcode_index[start]], self.refs[self.ref_index[start]], start, end
+
+    def correct_umi(self, debug=False):
+        """
+        Correct UMIs of each (barcode, ref) with `Count.correct_umi`. Rows of merged UMIs are removed.
+        Returns:
+            number of corrected UMI
+        """
+        keep = np.ones(len(self), dtype=bool)
+        total_corrected_umi = 0
+        for barcode, ref, start, end in self.iter_groups():
+            umi_dict = dict(zip(self.umis[self.umi_index[start:end]].tolist(), self.read_count[start:end].tolist()))
+            n_corrected_umi, _n_corrected_read = Count.correct_umi(umi_dict)
+            if debug:
+                print(f'{barcode} {ref} {n_corrected_umi}')
+            total_corrected_umi += n_corrected_umi
+            if n_corrected_umi:
+                for row, umi in enumerate(self.umis[self.umi_index[start:end]].tolist(), start=start):
+                    if umi in umi_dict:
+                        self.read_count[row] = umi_dict[umi]
+                    else:
+                        keep[row] = False
+
+        self.barcode_index = self.barcode_index[keep]
+        self.ref_index = self.ref_index[keep]
+        self.umi_index = self.umi_index[keep]
+        self.read_count = self.read_count[keep]
+        return total_corrected_umi
+
+    def get_ref_read_count(self, ref_index):
+        """read counts of all UMIs of a ref"""
+        return self.read_count[self.ref_index == ref_index]
+
+
+class Test_read_count(unittest.TestCase):
+    def setUp(self):
+        import random
+
+        random.seed(0)
+        self.count_dict = utils.genDict(dim=3)
+        for _ in range(3000):
+            barcode = f'B{random.randrange(50)}'
+            ref = random.choice(['virus1', 'virus2', 'virus3'])
+            umi = ''.join(random.choice('ACGT') for _ in range(4))
+            self.count_dict[barcode][ref][umi] += random.choice([1, 1, 1, 20])
+
+    def test_formats(self):
+        import tempfile
+
+        read_count = ReadCount.from_dict(self.count_dict)
+        self.assertEqual(json.dumps(read_count.to_dict()), json.dumps(self.count_dict))
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for suffix in FORMATS:
+                read_count_file = f'{temp_dir}/raw_read_count.{suffix}'
+                read_count.write(read_count_file)
+                self.assertEqual(json.dumps(ReadCount.read(read_count_file).to_dict()), json.dumps(self.count_dict))
+
+    def test_correct_umi(self):
+        read_count = ReadCount.from_dict(self.count_dict)
+        total_corrected_umi = 0
+        for barcode in self.count_dict:
+            for ref in self.count_dict[barcode]:
+                total_corrected_umi += Count.correct_umi(self.count_dict[barcode][ref])[0]
+        self.assertGreater(total_corrected_umi, 0)
+        self.assertEqual(read_count.correct_umi(), total_corrected_umi)
+        self.assertEqual(json.dumps(read_count.to_dict()), json.dumps(self.count_dict))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,7 @@
    
 import math
+import unittest
+from multiprocessing import Pool
 
 import matplotlib.pyplot as plt
 import matplotlib
@@ -9,6 +11,18 @@ import celescope.tools.utils as utils
 
 matplotlib.use('Agg')
 
+# Otsu histogram bin width of log transformed counts
+OTSU_BIN_WIDTH = 0.2
+
+
+def plot_otsu(counts, bins, threshold, log_base, otsu_plot_path):
+    plt.hist(x=bins[:-1], bins=bins, weights=counts)
+    plt.axvline(threshold, color='r')
+    plt.xlabel(f'log{log_base} observed read/UMI counts')
+    plt.ylabel('Frequency')
+    plt.savefig(otsu_plot_path)
+    plt.close()
+
 
 class Otsu():
     """
@@ -67,19 +81,14 @@ class Otsu():
         idx = np.nanargmax(variance12)
         self.threshold = bin_centers[idx]
 
-    def _array2hist(self, binWidth=0.2):
+    def _array2hist(self, binWidth=OTSU_BIN_WIDTH):
         self.counts, self.bins = np.histogram(self.array, bins=np.arange(0, max(self.array)+binWidth, binWidth))
 
     @utils.add_log
     def _make_plot(self):
         if not self.otsu_plot_path:
             return 
-        plt.hist(x=self.bins[:-1], bins=self.bins, weights=self.counts)
-        plt.axvline(self.threshold, color='r')
-        plt.xlabel(f'log{self.log_base} observed read/UMI counts')
-        plt.ylabel('Frequency')
-        plt.savefig(self.otsu_plot_path)
-        plt.close()
+        plot_otsu(self.counts, self.bins, self.threshold, self.log_base, self.otsu_plot_path)
 
     def run(self):
         """
@@ -174,4 +183,194 @@ class Threshold():
         else:
             raise ValueError(f'Unknown threshold method: {self.threshold_method}')
 
-        return threshold
\ No newline at end of file
+        return threshold
+
+
+class BatchThreshold():
+    """
+    Thresholds of all features at once. The same as running `Threshold` on the values of each feature.
+
+    Values are sorted by feature once. Otsu histograms of all features are counted into one matrix with shared bin
+    edges: `np.arange` edges only differ in length, so the edges of each feature are a prefix of the longest edges.
+    Cumulative sums and between-class variances are then computed row by row with 2D numpy operations.
+
+    Args:
+        values: count of each (barcode, feature), e.g. the data of a sparse barcode x feature matrix.
+        feature_index: feature of each value.
+        n_feature: number of features.
+        threshold_method: ['otsu', 'auto', 'hard', 'none']
+        otsu_plot_paths: None or a list with the Otsu plot path of each feature.
+        kwargs: the same as `Threshold`, `Otsu` and `Auto`.
+    """
+
+    def __init__(self, values, feature_index, n_feature, threshold_method='auto', otsu_plot_paths=None,
+                 hard_threshold=None, log_base=10, otsu_min_len=50, percentile=99, coef=3, expected_cell_num=None,
+                 **kwargs):
+        values = np.asarray(values)
+        feature_index = np.asarray(feature_index)
+        bool_positive = values > 0
+        values = values[bool_positive]
+        feature_index = feature_index[bool_positive]
+        order = np.lexsort((values, feature_index))
+        # ascending in each feature
+        self.values = values[order]
+        self.n_value = np.bincount(feature_index, minlength=n_feature)
+        self.ends = np.cumsum(self.n_value)
+        self.starts = self.ends - self.n_value
+        self.n_feature = n_feature
+
+        self.threshold_method = threshold_method
+        self.otsu_plot_paths = otsu_plot_paths
+        self.hard_threshold = hard_threshold
+        self.log_base = int(log_base)
+        self.otsu_min_len = otsu_min_len
+        self.percentile = percentile
+        self.coef = int(coef)
+        self.expected_cell_num = expected_cell_num
+        self.kwargs = kwargs
+
+    def get_auto_threshold(self, feature):
+        """Same as `Auto.run`"""
+        n_value = int(self.n_value[feature])
+        expected_cell_num = n_value
+        if self.expected_cell_num:
+            expected_cell_num = self.expected_cell_num
+            if expected_cell_num > n_value:
+                print('Warning: expected_cell_num > len(array)')
+                expected_cell_num = n_value
+        top_values = self.values[self.ends[feature] - expected_cell_num: self.ends[feature]]
+        count_cell_percentile = np.percentile(top_values, self.percentile)
+        return int(count_cell_percentile / self.coef)
+
+    def get_otsu_thresholds(self, features):
+        """Same as `Otsu.run` of each feature"""
+        thresholds = {}
+        features = [feature for feature in features if self.n_value[feature] >= self.otsu_min_len]
+        if not features:
+            return thresholds
+
+        rows = np.repeat(np.arange(len(features)), self.n_value[features])
+        feature_values = np.concatenate([self.values[self.starts[feature]: self.ends[feature]] for feature in features])
+        log_values = np.log(feature_values) / np.log(self.log_base)
+        # values are sorted, so the last value of each feature is the max
+        max_log_values = log_values[np.cumsum(self.n_value[features]) - 1]
+        n_edges = np.array([len(np.arange(0, max_log_value + OTSU_BIN_WIDTH, OTSU_BIN_WIDTH)) for max_log_value in max_log_values])
+        edges = np.arange(0, max(max_log_values) + OTSU_BIN_WIDTH, OTSU_BIN_WIDTH)
+        n_bin = max(len(edges) - 1, 1)
+
+        # np.histogram: bins are [left, right) except that the last bin is [left, right]
+        bin_index = np.searchsorted(edges, log_values, side='right') - 1
+        last_edge = n_edges[rows] - 1
+        on_last_edge = (bin_index >= last_edge) & (log_values == edges[last_edge])
+        bin_index[on_last_edge] = last_edge[on_last_edge] - 1
+        bool_in_bin = (bin_index >= 0) & (bin_index < last_edge)
+        counts = np.bincount(
+            rows[bool_in_bin] * n_bin + bin_index[bool_in_bin],
+            minlength=len(features) * n_bin,
+        ).reshape(len(features), n_bin)
+
+        bin_centers = edges[:n_bin]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weight1 = np.cumsum(counts, axis=1)
+            weight2 = np.cumsum(counts[:, ::-1], axis=1)[:, ::-1]
+            mean1 = np.cumsum(counts * bin_centers, axis=1) / weight1
+            mean2 = (np.cumsum((counts * bin_centers)[:, ::-1], axis=1) / weight2[:, ::-1])[:, ::-1]
+            variance12 = weight1[:, :-1] * weight2[:, 1:] * (mean1[:, :-1] - mean2[:, 1:]) ** 2
+        # each feature has n_edges - 1 bins and n_edges - 2 variances
+        n_variance = n_edges - 2
+        variance12[np.arange(n_bin - 1) >= n_variance[:, None]] = np.nan
+
+        for row, feature in enumerate(features):
+            exponent = 1
+            if n_variance[row] > 0:
+                exponent = bin_centers[np.nanargmax(variance12[row, :n_variance[row]])]
+            if self.otsu_plot_paths and self.otsu_plot_paths[feature]:
+                n_feature_bin = max(n_edges[row] - 1, 0)
+                plot_otsu(counts[row, :n_feature_bin], edges[:n_edges[row]], exponent, self.log_base,
+                          self.otsu_plot_paths[feature])
+            thresholds[feature] = math.ceil(self.log_base ** exponent)
+        return thresholds
+
+    def run(self, features=None):
+        """
+        Args:
+            features: compute thresholds of these features. Default is all features.
+        Returns:
+            list of thresholds of features
+        """
+        if features is None:
+            features = range(self.n_feature)
+        features = list(features)
+        # empty features
+        thresholds = {feature: 1 for feature in features}
+        features = [feature for feature in features if self.n_value[feature] > 0]
+
+        if self.threshold_method == 'otsu':
+            thresholds.update(self.get_otsu_thresholds(features))
+        elif self.threshold_method == 'auto':
+            for feature in features:
+                thresholds[feature] = self.get_auto_threshold(feature)
+        elif self.threshold_method == 'hard':
+            if features and not self.hard_threshold:
+                raise Exception('hard_threshold must be set')
+            for feature in features:
+                thresholds[feature] = int(self.hard_threshold)
+        elif self.threshold_method != 'none':
+            raise ValueError(f'Unknown threshold method: {self.threshold_method}')
+
+        return list(thresholds.values())
+
+
+def _run_batch_threshold(batch_threshold, features):
+    return batch_threshold.run(features)
+
+
+@utils.add_log
+def get_thresholds(values, feature_index, n_feature, thread=1, **kwargs):
+    """
+    Thresholds of all features. If thread > 1, features are split into chunks and computed(and plotted) in parallel.
+    Args and kwargs are the same as `BatchThreshold`.
+    Returns:
+        list of thresholds of features
+    """
+    batch_threshold = BatchThreshold(values, feature_index, n_feature, **kwargs)
+    if thread <= 1 or n_feature <= 1:
+        return batch_threshold.run()
+
+    chunks = [chunk.tolist() for chunk in np.array_split(np.arange(n_feature), min(thread, n_feature))]
+    with Pool(thread) as pool:
+        results = pool.starmap(_run_batch_threshold, [(batch_threshold, chunk) for chunk in chunks])
+    return [threshold for result in results for threshold in result]
+
+
+class Test_threshold(unittest.TestCase):
+    def test_batch_same_as_threshold(self):
+        import random
+
+        random.seed(0)
+        n_feature = 40
+        feature_values = []
+        for feature in range(n_feature):
+            n_value = random.choice([0, 10, 49, 50, 51, 300, 1000])
+            high = random.choice([1, 2, 10, 100, 10000])
+            values = [random.randint(0, high) for _ in range(n_value)]
+            if feature % 7 == 0:
+                values = [1] * n_value
+            elif feature % 11 == 0:
+                # some values are on the last bin edge
+                values = [1, 10, 100] * n_value
+            feature_values.append(values)
+        values = [value for values in feature_values for value in values]
+        feature_index = [feature for feature, values in enumerate(feature_values) for _ in values]
+
+        for threshold_method in ('otsu', 'auto', 'hard', 'none'):
+            for log_base in (2, 10):
+                kwargs = {'hard_threshold': 5, 'coef': 3, 'log_base': log_base}
+                expected = [
+                    Threshold(values, threshold_method=threshold_method, **kwargs).run() for values in feature_values
+                ]
+                for thread in (1, 3):
+                    thresholds = get_thresholds(
+                        values, feature_index, n_feature, thread=thread, threshold_method=threshold_method, **kwargs)
+                    self.assertEqual(thresholds, expected)
+
@@ -0,0 +1,264 @@
+"""
+Lazy registry of celescope subcommands.
+
+`celescope <assay> <step>` only imports the module of the requested step. The other steps get empty subparsers.
+Help output of a step is built from the option manifest(celescope/data/cli_manifest.json) without importing the step
+module. Steps missing from the manifest fall back to importing the module.
+
+This module must stay cheap to import: do not import celescope.tools.utils or any third-party package here.
+Regenerate the manifest after changing any `get_opts_*` function:
+
+    python -m celescope.tools.cli_registry
+"""
+
+import argparse
+import importlib
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+from celescope.__init__ import ASSAY_LIST, ROOT_PATH
+
+MANIFEST_FILE = f'{ROOT_PATH}/data/cli_manifest.json'
+HELP_FLAGS = ('-h', '--help')
+ACTION_NAMES = {
+    '_StoreAction': 'store',
+    '_StoreConstAction': 'store_const',
+    '_StoreTrueAction': 'store_true',
+    '_StoreFalseAction': 'store_false',
+    '_AppendAction': 'append',
+    '_AppendConstAction': 'append_const',
+    '_CountAction': 'count',
+}
+# modules that `celescope <assay> <step> --help` should not import
+HEAVY_MODULES = ('pandas', 'pysam', 'scanpy', 'plotly', 'matplotlib', 'scipy', 'Bio')
+
+
+class ArgFormatter(argparse.ArgumentDefaultsHelpFormatter, argparse.RawTextHelpFormatter):
+    pass
+
+
+def get_assay_text(assay):
+    """
+    add sinlge cell prefix
+    """
+    return 'Single-cell ' + assay
+
+
+def get_steps(assay):
+    init_module = importlib.import_module(f"celescope.{assay}.__init__")
+    return init_module.__STEPS__
+
+
+def get_step_module_name(assay, step):
+    """
+    Returns:
+        module name of step. Search celescope/{assay}, then IMPORT_DICT of the assay, then celescope/tools.
+    """
+    if os.path.exists(f'{ROOT_PATH}/{assay}/{step}.py'):
+        return f"celescope.{assay}.{step}"
+    init_module = importlib.import_module(f"celescope.{assay}.__init__")
+    if hasattr(init_module, 'IMPORT_DICT') and step in init_module.IMPORT_DICT:
+        return f"{init_module.IMPORT_DICT[step]}.{step}"
+    if os.path.exists(f'{ROOT_PATH}/tools/{step}.py'):
+        return f"celescope.tools.{step}"
+    raise ModuleNotFoundError(f"No module found for {assay}.{step}")
+
+
+def get_requested(argv):
+    """
+    Returns:
+        (assay, step) from command line arguments. None if not given.
+
+    >>> get_requested(['rna', 'barcode', '--help'])
+    ('rna', 'barcode')
+    >>> get_requested(['rna'])
+    ('rna', None)
+    >>> get_requested(['-v'])
+    (None, None)
+    """
+    assay = argv[0] if argv and argv[0] in ASSAY_LIST else None
+    step = argv[1] if assay and len(argv) > 1 and not argv[1].startswith('-') else None
+    return assay, step
+
+
+def action_to_dict(action):
+    """
+    Returns:
+        JSON serializable option spec of an argparse action. None if the action can not be rebuilt(e.g. help).
+    """
+    action_name = ACTION_NAMES.get(type(action).__name__)
+    if action_name is None:
+        return None
+    choices = action.choices
+    if isinstance(choices, (set, frozenset)):
+        choices = sorted(choices)
+    elif choices is not None:
+        choices = list(choices)
+    default = action.default
+    try:
+        json.dumps(default)
+    except TypeError:
+        default = str(default)
+    option = {
+        'option_strings': list(action.option_strings),
+        'dest': action.dest,
+        'action': action_name,
+        'nargs': action.nargs,
+        'const': action.const,
+        'default': default,
+        'choices': choices,
+        'required': action.required,
+        'help': action.help,
+        'metavar': action.metavar,
+    }
+    if action_name in ('store_true', 'store_false', 'count'):
+        option['nargs'] = option['const'] = None
+    if not action.required:
+        option['required'] = None
+    # keep the manifest small
+    return {key: value for key, value in option.items() if value is not None}
+
+
+def add_manifest_options(parser, options):
+    """
+    Add options from manifest to parser. Option types are not kept, so the parser is only good for help output.
+    """
+    for option in options:
+        kwargs = {
+            'action': option['action'],
+            'default': option.get('default'),
+            'help': option.get('help'),
+        }
+        if option['option_strings']:
+            args = option['option_strings']
+            kwargs['dest'] = option['dest']
+            kwargs['required'] = option.get('required', False)
+        else:
+            args = [option['dest']]
+        if option['action'] in ('store', 'append'):
+            for key in ('nargs', 'choices', 'metavar', 'const'):
+                if key in option:
+                    kwargs[key] = option[key]
+        elif option['action'] in ('store_const', 'append_const'):
+            kwargs['const'] = option['const']
+        parser.add_argument(*args, **kwargs)
+
+
+def load_step(assay, step):
+    """
+    Returns:
+        (step function, get_opts function)
+    """
+    step_module = importlib.import_module(get_step_module_name(assay, step))
+    return getattr(step_module, step), getattr(step_module, f"get_opts_{step}")
+
+
+def get_step_options(assay, step):
+    """
+    Returns:
+        option specs of step, in the order of `get_opts_{step}(parser, sub_program=True)`.
+    """
+    _func, func_opts = load_step(assay, step)
+    parser = argparse.ArgumentParser(formatter_class=ArgFormatter)
+    func_opts(parser, sub_program=True)
+    options = [action_to_dict(action) for action in parser._actions]
+    return [option for option in options if option is not None]
+
+
+def read_manifest(manifest_file=MANIFEST_FILE):
+    """
+    Returns:
+        {assay: {step: options}}. Empty dict if manifest_file does not exist.
+    """
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as fh:
+        return json.load(fh)
+
+
+def write_manifest(manifest_file=MANIFEST_FILE):
+    """
+    Write the option manifest of all steps. All step modules must be importable, so run it in a full environment.
+    """
+    manifest = {}
+    for assay in ASSAY_LIST:
+        manifest[assay] = {}
+        for step in get_steps(assay):
+            try:
+                manifest[assay][step] = get_step_options(assay, step)
+            except ImportError as e:
+                raise ImportError(
+                    f'Can not import {assay}.{step}: {e}. The manifest must be written in a full environment.'
+                ) from e
+    with open(manifest_file, 'w') as fh:
+        json.dump(manifest, fh, indent=1)
+        fh.write('\n')
+
+
+def add_step_parser(subparser_2nd, assay, step, help_only=False, manifest=None):
+    """
+    Add the parser of step. If help_only and step is in manifest, options are added from manifest.
+    """
+    parser_step = subparser_2nd.add_parser(step, formatter_class=ArgFormatter)
+    if help_only:
+        if manifest is None:
+            manifest = read_manifest()
+        options = manifest.get(assay, {}).get(step)
+        if options is not None:
+            add_manifest_options(parser_step, options)
+            return parser_step
+    func, func_opts = load_step(assay, step)
+    func_opts(parser_step, sub_program=True)
+    parser_step.set_defaults(func=func)
+    return parser_step
+
+
+class Test_cli_registry(unittest.TestCase):
+    @staticmethod
+    def normalize(options):
+        """
+        choices may come from a set(e.g. snp PANEL), whose order changes between runs
+        """
+        return [dict(option, choices=sorted(option['choices'])) if 'choices' in option else option
+                for option in options]
+
+    def test_manifest_up_to_date(self):
+        manifest = read_manifest()
+        for assay in ASSAY_LIST:
+            for step in get_steps(assay):
+                self.assertIn(
+                    step, manifest.get(assay, {}),
+                    f'{assay}.{step} not in manifest. Run `python -m celescope.tools.cli_registry`.'
+                )
+                # options can only be compared if the step module can be imported in this environment
+                try:
+                    options = get_step_options(assay, step)
+                except ImportError:
+                    continue
+                self.assertEqual(
+                    self.normalize(json.loads(json.dumps(options))), self.normalize(manifest[assay][step]),
+                    f'{assay}.{step} options changed. Run `python -m celescope.tools.cli_registry`.'
+                )
+
+    def test_help_imports(self):
+        code = (
+            'import sys\n'
+            'from celescope.celescope import main\n'
+            'try:\n'
+            '    main(["rna", "barcode", "--help"])\n'
+            'except SystemExit:\n'
+            '    pass\n'
+            'sys.stderr.write(",".join(m for m in sys.modules if m.split(".")[0] in %r))\n' % (HEAVY_MODULES,)
+        )
+        result = subprocess.run(
+            [sys.executable, '-c', code], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(ROOT_PATH))
+        self.assertIn('--chemistry', result.stdout)
+        self.assertEqual(result.stderr, '')
+
+
+if __name__ == '__main__':
+    write_manifest()
@@ -1,7 +1,12 @@
-import subprocess
+import heapq
+import math
+import os
+import shutil
 import unittest
+import zlib
 from collections import defaultdict
 from itertools import groupby
+from multiprocessing import Pool
 
 import numpy as np
 import pysam
@@ -10,6 +15,10 @@ from xopen import xopen
 from celescope.tools import utils
 from celescope.tools.step import Step, s_common
 
+# padding of packed reads in dumb_consensus
+PAD = 0
+N_SYMBOL = 256
+
 
 class Consensus(Step):
     """
@@ -32,18 +41,20 @@ class Consensus(Step):
         self.min_consensus_read = int(self.args.min_consensus_read)
 
         # out files
-        self.fq_tmp_file = f'{self.out_prefix}_sorted.fq.tmp'
+        self.tmp_dir = f'{self.outdir}/tmp'
         self.consensus_fq = f'{self.out_prefix}_consensus.fq'
 
     @utils.add_log
     def run(self):
 
-        sort_fastq(self.args.fq, self.fq_tmp_file, self.outdir)
-        n, total_ambiguous_base_n, length_list = sorted_dumb_consensus(
-            fq=self.fq_tmp_file,
+        n, total_ambiguous_base_n, length_list = partitioned_dumb_consensus(
+            fq=self.args.fq,
             outfile=self.consensus_fq,
+            tmp_dir=self.tmp_dir,
             threshold=self.args.threshold,
             min_consensus_read=self.min_consensus_read,
+            thread=self.thread,
+            partition_mb=self.args.partition_mb,
         )
 
         self.add_metric(
@@ -64,53 +75,121 @@ class Consensus(Step):
         )
 
 
-@utils.add_log
-def sort_fastq(fq, fq_tmp_file, outdir):
-    tmp_dir = f'{outdir}/tmp'
-    cmd = (
-        f'mkdir {tmp_dir};'
-        f'less {fq} | paste - - - - | sort -T {tmp_dir} -k1,1 -t " " | tr "\t" "\n" > {fq_tmp_file};'
-    )
-    subprocess.check_call(cmd, shell=True)
+def get_group_key(name_line):
+    """
+    (barcode, UMI) of a fastq name line
 
+    >>> get_group_key('@ACGT_TTTT_12 comment')
+    ('ACGT', 'TTTT')
+    """
+    attr = name_line[1:].split(maxsplit=1)[0].split('_')
+    return (attr[0], attr[1])
 
-@utils.add_log
-def sorted_dumb_consensus(fq, outfile, threshold, min_consensus_read):
-    '''
-    consensus read in name-sorted fastq
-    output (barcode,umi) consensus fastq
-    '''
-    read_list = []
-    n_umi = 0
-    total_ambiguous_base_n = 0
-    length_list = []
-    out_h = xopen(outfile, 'w')
 
-    def keyfunc(read):
-        attr = read.name.split('_')
-        return (attr[0], attr[1])
+def get_n_partition(fq, thread, partition_mb):
+    """
+    At least one partition per thread. Gzipped fastq is assumed to be 4 times larger after decompression.
+    """
+    fq_bytes = os.path.getsize(fq) * (4 if fq.endswith('.gz') else 1)
+    return max(thread, math.ceil(fq_bytes / (partition_mb * 1024 ** 2)))
+
 
-    with pysam.FastxFile(fq) as fh:
-        for (barcode, umi), g in groupby(fh, key=keyfunc):
+@utils.add_log
+def partition_fastq(fq, tmp_dir, n_partition):
+    """
+    Spill reads to n_partition plain fastq files. Reads of the same (barcode, UMI) are in the same partition.
+    Returns:
+        partition files
+    """
+    partition_files = [f'{tmp_dir}/partition_{i}.fq' for i in range(n_partition)]
+    handles = [open(partition_file, 'w') for partition_file in partition_files]
+    with xopen(fq) as fh:
+        for name_line in fh:
+            record = name_line + fh.readline() + fh.readline() + fh.readline()
+            barcode, umi = get_group_key(name_line)
+            handles[zlib.crc32(f'{barcode}_{umi}'.encode()) % n_partition].write(record)
+    for handle in handles:
+        handle.close()
+    return partition_files
+
+
+def consensus_partition(partition_file, out_file, threshold, min_consensus_read):
+    """
+    Sort reads in one partition and consensus each (barcode, UMI).
+    Reads are sorted as `paste - - - - | LC_ALL=C sort`: by the 4 fastq lines joined with tab.
+    Each line of out_file is one UMI: barcode, UMI, consensus sequence, quality, ambiguous base number, consensus length
+    and the first sorted read, which is used to merge partitions in the same order as sorting all reads.
+    """
+    with open(partition_file) as fh:
+        lines = fh.read().split('\n')
+    records = sorted('\t'.join(lines[i:i + 4]) for i in range(0, len(lines) - 3, 4))
+
+    with open(out_file, 'w') as out_h:
+        for (barcode, umi), g in groupby(records, key=get_group_key):
             read_list = []
-            for read in g:
-                read_list.append([read.sequence, read.quality])
+            first_record = None
+            for record in g:
+                if first_record is None:
+                    first_record = record
+                _name, sequence, _plus, quality = record.split('\t')
+                read_list.append([sequence, quality])
             consensus_seq, consensus_qual, ambiguous_base_n, con_len = dumb_consensus(
                 read_list,
                 threshold=threshold,
                 min_consensus_read=min_consensus_read,
                 ambiguous="N"
             )
+            out_h.write(
+                f'{barcode}\t{umi}\t{consensus_seq}\t{consensus_qual}\t{ambiguous_base_n}\t{con_len}\t{first_record}\n')
+    os.remove(partition_file)
+
+
+def read_partition_result(out_file):
+    with open(out_file) as fh:
+        for line in fh:
+            barcode, umi, consensus_seq, consensus_qual, ambiguous_base_n, con_len, first_record = \
+                line.rstrip('\n').split('\t', 6)
+            yield first_record, barcode, umi, consensus_seq, consensus_qual, int(ambiguous_base_n), int(con_len)
+
+
+@utils.add_log
+def partitioned_dumb_consensus(fq, outfile, tmp_dir, threshold, min_consensus_read, thread=1, partition_mb=256):
+    '''
+    output (barcode,umi) consensus fastq.
+    Reads are hash partitioned by (barcode, UMI) into spill files of about partition_mb, which are sorted and
+    consensused by `thread` processes. The UMI order and names are the same as consensus on the whole sorted fastq.
+    '''
+    utils.check_mkdir(tmp_dir)
+    n_partition = get_n_partition(fq, thread, partition_mb)
+    partition_files = partition_fastq(fq, tmp_dir, n_partition)
+    out_files = [f'{partition_file}.consensus' for partition_file in partition_files]
+    args_list = [
+        (partition_file, out_file, threshold, min_consensus_read)
+        for partition_file, out_file in zip(partition_files, out_files)
+    ]
+    if thread <= 1:
+        for args in args_list:
+            consensus_partition(*args)
+    else:
+        with Pool(thread) as pool:
+            pool.starmap(consensus_partition, args_list)
+
+    n_umi = 0
+    total_ambiguous_base_n = 0
+    length_list = []
+    with xopen(outfile, 'w') as out_h:
+        results = heapq.merge(*[read_partition_result(out_file) for out_file in out_files])
+        for _first_record, barcode, umi, consensus_seq, consensus_qual, ambiguous_base_n, con_len in results:
             n_umi += 1
             prefix = "_".join([barcode, umi])
             read_name = f'{prefix}_{n_umi}'
             out_h.write(utils.fastq_line(read_name, consensus_seq, consensus_qual))
             if n_umi % 10000 == 0:
-                sorted_dumb_consensus.logger.info(f'{n_umi} UMI done.')
+                partitioned_dumb_consensus.logger.info(f'{n_umi} UMI done.')
             total_ambiguous_base_n += ambiguous_base_n
             length_list.append(con_len)
+    shutil.rmtree(tmp_dir)
 
-    out_h.close()
     return n_umi, total_ambiguous_base_n, length_list
 
 
@@ -125,6 +204,87 @@ def dumb_consensus(read_list, threshold=0.5, min_consensus_read=1, ambiguous='N'
     then we will add that residue type,
     otherwise an ambiguous character will be added.
     elements of read_list: [entry.sequence,entry.quality]
+
+    Reads are packed into padded uint8 base and quality matrices and all positions are counted at once. If more than one
+    residue passes(threshold < 0.5) or more than one quality is the most common, the one that first appears in read
+    order is used, as in `dumb_consensus_by_dict`.
+    '''
+    con_len = get_read_length(read_list, threshold=threshold)
+    n_read = len(read_list)
+    if n_read == 1 and threshold < 1 and min_consensus_read <= 1:
+        sequence, quality = read_list[0]
+        return sequence, quality[:con_len], sequence.count(ambiguous), con_len
+    if con_len == 0:
+        return '', '', 0, con_len
+
+    seqs = pack_reads([read[0] for read in read_list], con_len)
+    quals = pack_reads([read[1] for read in read_list], con_len)
+    covered = seqs != PAD
+    num_atoms = covered.sum(axis=0)
+
+    atoms, atom_counts, atom_first_read = count_by_position(seqs, covered)
+    passing = (
+        (atom_counts > (num_atoms * threshold)[:, np.newaxis]) &
+        (atom_counts >= min_consensus_read) &
+        (atom_counts > 0)
+    )
+    consensus_seq = get_first_passing(atoms, passing, atom_first_read, ambiguous)
+
+    base_quals, qual_counts, qual_first_read = count_by_position(quals, covered)
+    passing = (qual_counts == qual_counts.max(axis=1, keepdims=True)) & (qual_counts > 0)
+    consensus_qual = get_first_passing(base_quals, passing, qual_first_read, default_qual)
+
+    ambiguous_base_n = consensus_seq.count(ambiguous)
+    return consensus_seq, consensus_qual, ambiguous_base_n, con_len
+
+
+def pack_reads(strings, con_len):
+    """
+    Returns:
+        uint8 matrix of shape (len(strings), con_len). Strings are truncated or padded with PAD.
+
+    >>> pack_reads(['ACG', 'A'], 2).tolist()
+    [[65, 67], [65, 0]]
+    """
+    pad = chr(PAD) * con_len
+    packed = ''.join((string + pad)[:con_len] for string in strings).encode('latin-1')
+    return np.frombuffer(packed, dtype=np.uint8).reshape(len(strings), con_len)
+
+
+def count_by_position(values, covered):
+    """
+    Args:
+        values: uint8 matrix of shape (n_read, con_len)
+        covered: bool matrix. Positions of each read that are counted.
+    Returns:
+        symbols: sorted distinct byte values
+        counts: shape (con_len, len(symbols)). Number of reads with each symbol at each position.
+        first_read: shape (con_len, len(symbols)). Index of the first read with each symbol at each position. n_read if
+            none.
+    """
+    n_read = values.shape[0]
+    symbols = np.flatnonzero(np.bincount(values.ravel(), minlength=N_SYMBOL)).astype(np.uint8)
+    one_hot = (values[:, :, np.newaxis] == symbols) & covered[:, :, np.newaxis]
+    counts = one_hot.sum(axis=0)
+    first_read = np.where(counts > 0, one_hot.argmax(axis=0), n_read)
+    return symbols, counts, first_read
+
+
+def get_first_passing(symbols, passing, first_read, default):
+    """
+    Returns:
+        string of the passing symbol that appears first at each position. default if none passes.
+    """
+    order = np.where(passing, first_read, np.iinfo(np.int64).max)
+    chars = symbols[order.argmin(axis=1)]
+    chars[~passing.any(axis=1)] = ord(default)
+    return chars.tobytes().decode('latin-1')
+
+
+def dumb_consensus_by_dict(read_list, threshold=0.5, min_consensus_read=1, ambiguous='N', default_qual='F'):
+    '''
+    Same as `dumb_consensus`, but counts residues and qualities of each position in dicts. Used to test
+    `dumb_consensus`.
     '''
 
     con_len = get_read_length(read_list, threshold=threshold)
@@ -206,6 +366,13 @@ def get_opts_consensus(parser, sub_program):
     parser.add_argument("--threshold", help='Default 0.5. Valid base threshold. ', type=float, default=0.5)
     parser.add_argument("--not_consensus", help="Skip the consensus step. ", action='store_true')
     parser.add_argument("--min_consensus_read", help="Minimum number of reads to support a base. ", default=1)
+    parser.add_argument(
+        "--partition_mb",
+        help="Default 256. Reads are split by (barcode, UMI) into partitions of about this size(MB). "
+        "Each thread sorts one partition in memory.",
+        type=int,
+        default=256,
+    )
     if sub_program:
         parser.add_argument("--fq", help="Required. Fastq file.", required=True)
         s_common(parser)
@@ -226,6 +393,59 @@ class Consensus_unittest(unittest.TestCase):
         consensus_seq, _consensus_qual, _ambiguous_base_n, _con_len = dumb_consensus(read_list, 0.5)
         self.assertEqual(consensus_seq, 'NNNN')
 
+    def test_dumb_consensus_same_as_dict(self):
+        import random
+
+        random.seed(0)
+        for _ in range(2000):
+            read_list = []
+            for _ in range(random.choice([1, 1, 2, 3, 5, 20])):
+                length = random.randint(0, 12)
+                read_list.append([
+                    ''.join(random.choice('ACGTN') for _ in range(length)),
+                    ''.join(random.choice('F:#') for _ in range(length)),
+                ])
+            # threshold 1 only works for one read, because fractions in get_read_length may not add up to 1
+            threshold = random.choice([0.2, 0.5, 0.7, 0.99]) if len(read_list) > 1 else random.choice([0.5, 1])
+            min_consensus_read = random.choice([0, 1, 2, 3])
+            self.assertEqual(
+                dumb_consensus(read_list, threshold, min_consensus_read),
+                dumb_consensus_by_dict(read_list, threshold, min_consensus_read),
+            )
+
+    def test_partitioned_dumb_consensus(self):
+        import random
+        import tempfile
+
+        random.seed(0)
+        records = []
+        for read_id in range(3000):
+            barcode = random.choice(['AAC', 'AACG', 'TTG'])
+            umi = ''.join(random.choice('ACGT') for _ in range(3))
+            length = random.randint(3, 8)
+            seq = ''.join(random.choice('ACGT') for _ in range(length))
+            qual = ''.join(random.choice('F:#') for _ in range(length))
+            records.append((f'{barcode}_{umi}_{read_id}', seq, qual))
+
+        # consensus on all reads sorted as `paste - - - - | LC_ALL=C sort`
+        sorted_records = sorted(records, key=lambda record: f'@{record[0]}\t{record[1]}\t+\t{record[2]}')
+        expected = []
+        for (barcode, umi), g in groupby(sorted_records, key=lambda record: tuple(record[0].split('_')[:2])):
+            consensus_seq, consensus_qual, _, _ = dumb_consensus([[seq, qual] for _, seq, qual in g], threshold=0.4)
+            expected.append(utils.fastq_line(f'{barcode}_{umi}_{len(expected) + 1}', consensus_seq, consensus_qual))
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            fq = f'{temp_dir}/in.fq'
+            with open(fq, 'w') as fh:
+                for name, seq, qual in records:
+                    fh.write(utils.fastq_line(name, seq, qual))
+            for thread in (1, 3):
+                outfile = f'{temp_dir}/out_{thread}.fq'
+                n_umi, _, _ = partitioned_dumb_consensus(fq, outfile, f'{temp_dir}/tmp', 0.4, 1, thread=thread)
+                self.assertEqual(n_umi, len(expected))
+                with open(outfile) as fh:
+                    self.assertEqual(fh.read(), ''.join(expected))
+
 
 if __name__ == '__main__':
     unittest.main()
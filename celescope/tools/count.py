@@ -7,7 +7,9 @@ import random
 import sys
 import unittest
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from itertools import groupby
+from multiprocessing import Pool
 
 import numpy as np
 import pandas as pd
@@ -15,24 +17,33 @@ import pysam
 
 from celescope.tools import utils
 from celescope.__init__ import HELP_DICT
-from celescope.tools.__init__ import (FILTERED_MATRIX_DIR_SUFFIX, RAW_MATRIX_DIR_SUFFIX)
+from celescope.tools.__init__ import (FILTERED_MATRIX_DIR_SUFFIX, RAW_MATRIX_DIR_SUFFIX, H5_SUFFIX)
 from celescope.tools.emptydrop_cr import get_plot_elements
 from celescope.tools.emptydrop_cr.cell_calling_3 import cell_calling_3
 from celescope.tools.step import Step, s_common
-from celescope.rna.mkref import Mkref_rna
 from celescope.tools.plotly_plot import Line_plot
 from celescope.tools.matrix import CountMatrix
-from celescope.tools import reference
+from celescope.tools.count_detail import CountDetail, CountDetailTxtWriter, CountDetailNpzWriter
+from celescope.tools.gtf_index import load_annotation
+from celescope.tools import bam_shard
 
 TOOLS_DIR = os.path.dirname(__file__)
 random.seed(0)
 np.random.seed(0)
 
+# bam2table splits the BAM into thread * SHARDS_PER_THREAD shards to balance load
+SHARDS_PER_THREAD = 4
+# correct_umi scans directly if the number of UMIs is smaller than this, as building the index costs more
+MIN_UMI_INDEX = 20
+# reads per chunk when inverting the read shuffle in get_read_ranks
+RANK_CHUNK_SIZE = 1 << 22
+
 # downsample.csv
 READ_FRACTION = 'read_fraction'
 MEDIAN_GENE_NUMBER = 'median_gene_number'
 READ_SATURATION = 'read_saturation'
 UMI_SATURATION = 'umi_saturation'
+MEAN_READS_PER_CELL = 'mean_reads_per_cell'
 
 # Plot axis title in HTML
 X_TITLE = 'Read Fraction'
@@ -49,11 +60,15 @@ class Count(Step):
     - `{sample}_raw_feature_bc_matrix` The expression matrix of all detected barcodes in [Matrix Market Exchange Formats](
         https://math.nist.gov/MatrixMarket/formats.html). 
     - `{sample}_filtered_feature_bc_matrix` The expression matrix of cell barcodes in Matrix Market Exchange Formats. 
+    - `{sample}_raw_feature_bc_matrix.h5`, `{sample}_filtered_feature_bc_matrix.h5` If `--matrix_h5`. 
+        The same matrices in 10X HDF5 format.
     - `{sample}_count_detail.txt.gz` 4 columns: 
         - barcode  
         - gene ID  
         - UMI count  
         - read_count  
+    - `{sample}_count_detail/` If `--count_detail_format npz`. The same content as `{sample}_count_detail.txt` 
+        in integer-encoded chunks: barcode index, gene index, UMI 2-bit code and read count.
     - `{sample}_counts.txt` 6 columns:
         - Barcode: barcode sequence
         - readcount: read count of each barcode
@@ -63,7 +78,8 @@ class Count(Step):
         - mark: cell barcode or backgound barcode.
             `CB` cell  
             `UB` background  
-    - `{sample}_downsample.tsv` Subset a fraction of reads and calculate median gene number and sequencing saturation.
+    - `{sample}_downsample.tsv` Subset a fraction of reads and calculate median gene number, sequencing saturation and 
+    mean reads per cell. The number of fractions is set by `--saturation_points`.
     """
 
     def __init__(self, args, display_title=None):
@@ -72,16 +88,18 @@ class Count(Step):
         self.cell_calling_method = args.cell_calling_method
         self.expected_cell_num = int(args.expected_cell_num)
         self.bam = args.bam
+        self.count_detail_format = args.count_detail_format
+        self.gzip_matrix = args.gzip_matrix
+        self.matrix_h5 = args.matrix_h5
+        self.saturation_points = int(args.saturation_points)
 
         # set
-        gtf_file = Mkref_rna.parse_genomeDir(args.genomeDir)['gtf']
-        gp = reference.GtfParser(gtf_file)
-        gp.get_id_name()
-        self.features = gp.get_features()
+        self.features = load_annotation(args.genomeDir).get_features()
         self.downsample_dict = {}
 
         # output files
         self.count_detail_file = f'{self.outdir}/{self.sample}_count_detail.txt'
+        self.count_detail_dir = f'{self.outdir}/{self.sample}_count_detail'
         self.marked_count_file = f'{self.outdir}/{self.sample}_counts.txt'
         self.raw_matrix_dir = f'{self.outdir}/{self.sample}_{RAW_MATRIX_DIR_SUFFIX[0]}'
         self.cell_matrix_dir = f'{self.outdir}/{self.sample}_{FILTERED_MATRIX_DIR_SUFFIX[0]}'
@@ -99,29 +117,32 @@ class Count(Step):
 
     def run(self):
         self.bam2table()
-        df = pd.read_table(self.count_detail_file, header=0)
+        count_detail = self.get_count_detail()
 
         # df_sum
-        df_sum = Count.get_df_sum(df)
+        df_sum = count_detail.get_df_sum()
 
-        # export all matrix
-        self.write_sparse_matrix(df, self.raw_matrix_dir)
+        # export all matrix while calling cells on the in-memory matrix
+        raw_matrix = count_detail.to_count_matrix(self.features)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            write_raw_matrix = executor.submit(self.write_matrix, raw_matrix, self.raw_matrix_dir)
 
-        # call cells
-        cell_bc, _threshold = self.cell_calling(df_sum)
+            # call cells
+            cell_bc, _threshold = self.cell_calling(df_sum, raw_matrix)
+            write_raw_matrix.result()
 
         # get cell stats
         CB_describe = self.get_cell_stats(df_sum, cell_bc)
 
         # export cell matrix
-        df_cell = df.loc[df['Barcode'].isin(cell_bc), :]
-        self.write_sparse_matrix(df_cell, self.cell_matrix_dir)
-        (CB_total_Genes, CB_reads_count, reads_mapped_to_transcriptome) = self.cell_summary(
-            df, cell_bc)
+        cell_detail = count_detail.subset_barcodes(cell_bc)
+        self.write_matrix(cell_detail.to_count_matrix(self.features), self.cell_matrix_dir)
+        CB_total_Genes = cell_detail.n_gene()
+        CB_reads_count = cell_detail.total_read()
+        reads_mapped_to_transcriptome = count_detail.total_read()
 
         # downsampling
-        cell_bc = set(cell_bc)
-        self.downsample(df_cell)
+        self.downsample_count_detail(cell_detail)
 
         # summary
         self.get_summary(CB_describe, CB_total_Genes,
@@ -149,6 +170,70 @@ class Count(Step):
         Returns:
             n_corrected_umi: int
             n_corrected_read: int
+
+        UMIs are indexed by their first and second halves. UMIs with hamming distance 1 share one half, so each
+        low-count UMI only compares with UMIs in the same half buckets instead of all higher-count UMIs.
+        The merges are the same as `Count.correct_umi_by_scan`.
+        """
+        if len(umi_dict) < MIN_UMI_INDEX or len(set(map(len, umi_dict))) > 1:
+            return Count.correct_umi_by_scan(umi_dict, percent)
+
+        n_corrected_umi = 0
+        n_corrected_read = 0
+
+        # sort by value(UMI count) first, then key(UMI sequence)
+        umi_arr = sorted(
+            umi_dict.items(), key=lambda kv: (kv[1], kv[0]), reverse=True)
+
+        # {(half, umi_seq half): [index in umi_arr]}
+        half_dict = defaultdict(list)
+        for index, (seq, _count) in enumerate(umi_arr):
+            for half_key in Count.get_umi_half_keys(seq):
+                half_dict[half_key].append(index)
+
+        # the lowest UMI is popped first; the highest UMI is never merged
+        for low_index in range(len(umi_arr) - 1, 0, -1):
+            low_seq, low_count = umi_arr[low_index]
+            # UMIs before low_index are not popped yet. Counts are sorted in descending order, so the first
+            # UMI passing the percent check and hamming distance check is the one with the smallest index.
+            high_index = None
+            for half_key in Count.get_umi_half_keys(low_seq):
+                for index in half_dict[half_key]:
+                    if index >= low_index:
+                        break
+                    if high_index is not None and index >= high_index:
+                        break
+                    if float(low_count / umi_arr[index][1]) > percent:
+                        break
+                    if utils.hamming_distance(low_seq, umi_arr[index][0]) == 1:
+                        high_index = index
+                        break
+            if high_index is None:
+                continue
+
+            high_seq = umi_arr[high_index][0]
+            n_low = umi_dict[low_seq]
+            n_corrected_umi += 1
+            n_corrected_read += n_low
+            # merge
+            umi_dict[high_seq] += n_low
+            del (umi_dict[low_seq])
+        return n_corrected_umi, n_corrected_read
+
+    @staticmethod
+    def get_umi_half_keys(seq):
+        """
+        >>> Count.get_umi_half_keys('ACGTA')
+        [(0, 'AC'), (1, 'GTA')]
+        """
+        half = len(seq) // 2
+        return [(0, seq[:half]), (1, seq[half:])]
+
+    @staticmethod
+    def correct_umi_by_scan(umi_dict, percent=0.1):
+        """
+        Correct umi_dict in place by scanning higher-count UMIs for each low-count UMI.
+        Args and Returns are the same as `Count.correct_umi`.
         """
         n_corrected_umi = 0
         n_corrected_read = 0
@@ -207,19 +292,46 @@ class Count(Step):
 
         return discard_umi, umi_gene_dict
 
+    def get_count_detail_writer(self):
+        if self.count_detail_format == 'npz':
+            return CountDetailNpzWriter(self.count_detail_dir, self.features.gene_id)
+        return CountDetailTxtWriter(self.count_detail_file)
+
+    def get_shard_writer_args(self, shard_index):
+        """
+        Returns:
+            writer_class, writer_kwargs. Shard outputs are sorted by shard_index.
+        """
+        if self.count_detail_format == 'npz':
+            return CountDetailNpzWriter, {
+                'count_detail_dir': self.count_detail_dir,
+                'gene_ids': self.features.gene_id,
+                'chunk_prefix': f'chunk_{shard_index:05d}',
+                'init_dir': False,
+            }
+        return CountDetailTxtWriter, {
+            'count_detail_file': f'{self.count_detail_file}.part{shard_index:05d}',
+            'header': False,
+        }
+
     @utils.add_log
-    def bam2table(self):
+    def get_count_detail(self):
+        if self.count_detail_format == 'npz':
+            return CountDetail.from_npz_dir(self.count_detail_dir)
+        return CountDetail.from_txt(self.count_detail_file, self.features.gene_id)
+
+    @staticmethod
+    def get_read_barcode(seg):
+        return seg.query_name.split('_', maxsplit=1)[0]
+
+    @staticmethod
+    def write_count_detail(bam, writer, start=None, end=None):
         """
-        bam to detail table
+        Correct UMI and write count detail of reads in [start, end) BGZF virtual offsets.
         must be used on name_sorted bam
         """
-        samfile = pysam.AlignmentFile(self.bam, "rb")
-        with open(self.count_detail_file, 'wt') as fh1:
-            fh1.write('\t'.join(['Barcode', 'geneID', 'UMI', 'count']) + '\n')
-
-            def keyfunc(x):
-                return x.query_name.split('_', maxsplit=1)[0]
-            for _, g in groupby(samfile, keyfunc):
+        with pysam.AlignmentFile(bam, "rb") as samfile:
+            for _, g in groupby(bam_shard.iter_shard(samfile, start, end), Count.get_read_barcode):
                 gene_umi_dict = defaultdict(lambda: defaultdict(int))
                 for seg in g:
                     (barcode, umi) = seg.query_name.split('_')[:2]
@@ -233,15 +345,50 @@ class Count(Step):
                 discard_umi, umi_gene_dict = Count.discard_read(gene_umi_dict)
 
                 # output
+                rows = []
                 for umi in umi_gene_dict:
                     if umi not in discard_umi:
                         for gene_id in umi_gene_dict[umi]:
-                            fh1.write('%s\t%s\t%s\t%s\n' % (barcode, gene_id, umi,
-                                                            umi_gene_dict[umi][gene_id]))
-        samfile.close()
+                            rows.append((gene_id, umi, umi_gene_dict[umi][gene_id]))
+                writer.write_barcode(barcode, rows)
 
     @utils.add_log
-    def cell_calling(self, df_sum):
+    def bam2table(self):
+        """
+        bam to detail table
+        must be used on name_sorted bam
+
+        If thread > 1, the BAM is split at barcode boundaries and shards are processed in parallel.
+        Shard outputs are concatenated in order, so the result is the same as the serial one.
+        """
+        shards = []
+        if self.thread > 1:
+            shards = bam_shard.get_shards(self.bam, self.thread * SHARDS_PER_THREAD, Count.get_read_barcode)
+
+        if len(shards) <= 1:
+            with self.get_count_detail_writer() as writer:
+                Count.write_count_detail(self.bam, writer)
+            return
+
+        if self.count_detail_format == 'npz':
+            CountDetailNpzWriter.init_dir(self.count_detail_dir, self.features.gene_id)
+        args_list = []
+        for shard_index, (start, end) in enumerate(shards):
+            writer_class, writer_kwargs = self.get_shard_writer_args(shard_index)
+            args_list.append((self.bam, start, end, writer_class, writer_kwargs))
+        with Pool(self.thread) as pool:
+            pool.starmap(_write_count_detail_shard, args_list)
+
+        if self.count_detail_format == 'txt':
+            part_files = [writer_kwargs['count_detail_file'] for _bam, _start, _end, _class, writer_kwargs in args_list]
+            CountDetailTxtWriter.merge_parts(self.count_detail_file, part_files)
+
+    @utils.add_log
+    def cell_calling(self, df_sum, raw_matrix=None):
+        """
+        Args:
+            raw_matrix: CountMatrix of all barcodes. If None, EmptyDrops_CR reads it from self.raw_matrix_dir.
+        """
         cell_calling_method = self.cell_calling_method
 
         if (self.force_cell_num is not None) and (self.force_cell_num != 'None'):
@@ -249,7 +396,7 @@ class Count(Step):
         elif cell_calling_method == 'auto':
             cell_bc, UMI_threshold = self.auto_cell(df_sum)
         elif cell_calling_method == 'EmptyDrops_CR':
-            cell_bc, UMI_threshold = self.emptydrop_cr_cell(df_sum)
+            cell_bc, UMI_threshold = self.emptydrop_cr_cell(df_sum, raw_matrix)
         return cell_bc, UMI_threshold
 
     @utils.add_log
@@ -297,8 +444,10 @@ class Count(Step):
         return cell_bc, threshold
 
     @utils.add_log
-    def emptydrop_cr_cell(self, df_sum):
-        cell_bc, initial_cell_num = cell_calling_3(self.raw_matrix_dir, self.expected_cell_num)
+    def emptydrop_cr_cell(self, df_sum, raw_matrix=None):
+        if raw_matrix is None:
+            raw_matrix = self.raw_matrix_dir
+        cell_bc, initial_cell_num = cell_calling_3(raw_matrix, self.expected_cell_num, n_jobs=self.thread)
         threshold = Count.find_threshold(df_sum, initial_cell_num)
         return cell_bc, threshold
 
@@ -329,6 +478,13 @@ class Count(Step):
         count_matrix = CountMatrix.from_dataframe(df, self.features, value="UMI")
         count_matrix.to_matrix_dir(matrix_dir)
 
+    @utils.add_log
+    def write_matrix(self, count_matrix, matrix_dir):
+
+        count_matrix.to_matrix_dir(matrix_dir, gzip=self.gzip_matrix)
+        if self.matrix_h5:
+            count_matrix.to_h5(f'{matrix_dir}{H5_SUFFIX}')
+
     @utils.add_log
     def cell_summary(self, df, cell_bc):
 
@@ -408,7 +564,60 @@ class Count(Step):
         )
 
     @staticmethod
-    def sub_sample(fraction, df_cell, cell_read_index):
+    def get_fractions(n_point):
+        """
+        Read fractions of the saturation curve. The same floats as `np.arange(0.1, 1.1, 0.1)` when n_point is 10.
+
+        >>> Count.get_fractions(4).tolist()
+        [0.25, 0.5, 0.75, 1.0]
+        >>> np.array_equal(Count.get_fractions(10), np.arange(0.1, 1.1, 0.1))
+        True
+        """
+        step = 1 / n_point
+        fractions = step + np.arange(n_point) * step
+        fractions[-1] = 1.0
+        return fractions
+
+    @staticmethod
+    def get_read_ranks(read_count):
+        """
+        Shuffle all reads once. The position of a read after the shuffle is its rank; subsampling a fraction of reads
+        keeps the reads with rank < n_read * fraction.
+        The shuffle only depends on the number of reads, so it is the same as shuffling the repeated row index.
+
+        Args:
+            read_count: read count of each row(barcode, gene, UMI)
+        Returns:
+            first, second: rank of the first and second read of each row. The total number of reads if the row has
+                fewer reads.
+        """
+        n_read = int(read_count.sum())
+        dtype = np.int32 if n_read < np.iinfo(np.int32).max else np.int64
+        # perm[position] = read. Reads of the same row are consecutive.
+        perm = np.arange(n_read, dtype=dtype)
+        np.random.shuffle(perm)
+        # read_rank[read] = position of read after the shuffle. Built in chunks to avoid another n_read temp array.
+        read_rank = np.empty(n_read, dtype=dtype)
+        for start in range(0, n_read, RANK_CHUNK_SIZE):
+            end = min(start + RANK_CHUNK_SIZE, n_read)
+            read_rank[perm[start:end]] = np.arange(start, end, dtype=dtype)
+
+        has_read = read_count > 0
+        starts = np.zeros(len(read_count), dtype=np.int64)
+        np.cumsum(read_count[:-1], out=starts[1:])
+        first = np.full(len(read_count), n_read, dtype=np.int64)
+        second = np.full(len(read_count), n_read, dtype=np.int64)
+        if n_read == 0:
+            return first, second
+        first[has_read] = np.minimum.reduceat(read_rank, starts[has_read])
+        # mask the first read of each row, then the minimum is the second read
+        read_rank[perm[first[has_read]]] = n_read
+        del perm
+        second[has_read] = np.minimum.reduceat(read_rank, starts[has_read])
+        return first, second
+
+    @staticmethod
+    def get_saturation_curve(read_count, barcode_index, gene_index, fractions):
         """
         umi_saturation = 1 - n_deduped_reads / n_umis
         read_saturation = 1 - n_deduped_reads / n_reads
@@ -417,53 +626,81 @@ class Count(Step):
         n_deduped_reads = Number of unique (valid cell-barcode, valid UMI, gene) combinations among confidently mapped reads.
         n_umis = Total number of (confidently mapped, valid cell-barcode, valid UMI) UMIs.
         n_reads = Total number of (confidently mapped, valid cell-barcode, valid UMI) reads.
+
+        At a subsample of n reads, a UMI is observed if its first rank < n, and observed once if also its second rank >= n.
+        A gene is detected in a barcode if the smallest first rank of its UMIs < n. All fractions are computed from
+        these ranks, without subsampling reads again.
+
         Args:
-            fration: subsmaple fration
-            df_cell: in cell df with (Barcode geneID UMI count) 
-            cell_read_index: df_cell repeat index
+            read_count, barcode_index, gene_index: of each row(barcode, gene, UMI) of cell barcodes
+            fractions: read fractions
+        Returns:
+            list of (umi_saturation, read_saturation, geneNum_median, mean_reads_per_cell), one for each fraction
         """
-        cell_read = df_cell['count'].sum()
-        frac_n_read = int(cell_read * fraction)
-        subsample_read_index = cell_read_index[:frac_n_read]
-        index_dedup, counts = np.unique(subsample_read_index, return_counts=True)
-        n_count_once = np.sum(counts == 1)
-        # total = UMI
-        umi_total = len(index_dedup)
-        umi_saturation = round((1 - n_count_once / umi_total) * 100, 2)
-        read_total = frac_n_read
-        read_saturation = round((1 - n_count_once / read_total) * 100, 2)
-
-        # gene median
-        df_cell_subsample = df_cell.loc[index_dedup, ]
-        geneNum_median = float(df_cell_subsample.groupby(
-            'Barcode').agg({'geneID': 'nunique'}).median())
-
-        return umi_saturation, read_saturation, geneNum_median
-
-    @utils.add_log
-    def downsample(self, df_cell):
-        """saturation and median gene
+        first, second = Count.get_read_ranks(read_count)
+        first_sorted = np.sort(first)
+        second_sorted = np.sort(second)
+
+        # first rank of each (barcode, gene), sorted
+        n_gene = int(gene_index.max()) + 1 if len(gene_index) else 1
+        barcode_gene = barcode_index.astype(np.int64) * n_gene + gene_index
+        order = np.lexsort((first, barcode_gene))
+        barcode_gene, gene_first = barcode_gene[order], first[order]
+        is_new = np.ones(len(barcode_gene), dtype=bool)
+        is_new[1:] = barcode_gene[1:] != barcode_gene[:-1]
+        gene_first = gene_first[is_new]
+        gene_order = np.argsort(gene_first, kind='stable')
+        gene_first = gene_first[gene_order]
+        gene_barcode = (barcode_gene[is_new] // n_gene)[gene_order]
+
+        cell_read = int(read_count.sum())
+        n_barcode = int(barcode_index.max()) + 1 if len(barcode_index) else 0
+        n_cell = len(np.unique(barcode_index))
+        gene_num = np.zeros(n_barcode, dtype=np.int64)
+        n_detected = 0
+        curve = []
+        for fraction in fractions:
+            frac_n_read = int(cell_read * fraction)
+            umi_total = np.searchsorted(first_sorted, frac_n_read)
+            n_count_once = umi_total - np.searchsorted(second_sorted, frac_n_read)
+            umi_saturation = round((1 - n_count_once / umi_total) * 100, 2)
+            read_total = frac_n_read
+            read_saturation = round((1 - n_count_once / read_total) * 100, 2)
+
+            # gene median
+            n_gene_detected = np.searchsorted(gene_first, frac_n_read)
+            gene_num += np.bincount(gene_barcode[n_detected:n_gene_detected], minlength=n_barcode)
+            n_detected = n_gene_detected
+            geneNum_median = float(np.median(gene_num[gene_num > 0]))
+
+            mean_reads_per_cell = round(frac_n_read / n_cell, 2) if n_cell else 0
+            curve.append((umi_saturation, read_saturation, geneNum_median, mean_reads_per_cell))
+        return curve
+
+    def add_downsample(self, read_count, barcode_index, gene_index):
+        """
+        Args:
+            read_count, barcode_index, gene_index: of each row(barcode, gene, UMI) of cell barcodes
         """
-        cell_read_index = np.array(df_cell.index.repeat(df_cell['count']), dtype='int32')
-        np.random.shuffle(cell_read_index)
-
         downsample_dict = {
             READ_FRACTION: [0],
             UMI_SATURATION: [0],
             READ_SATURATION: [0],
             MEDIAN_GENE_NUMBER: [0],
+            MEAN_READS_PER_CELL: [0],
         }
 
-        for fraction in np.arange(0.1, 1.1, 0.1):
-            umi_saturation, read_saturation, geneNum_median = Count.sub_sample(
-                fraction, df_cell, cell_read_index)
-            fraction = round(fraction,1)
+        fractions = Count.get_fractions(self.saturation_points)
+        curve = Count.get_saturation_curve(read_count, barcode_index, gene_index, fractions)
+        for fraction, (umi_saturation, read_saturation, geneNum_median, mean_reads_per_cell) in zip(fractions, curve):
+            fraction = round(fraction, 3)
             umi_saturation = round(umi_saturation, 2)
             read_saturation = round(read_saturation, 2)
             downsample_dict[READ_FRACTION].append(fraction)
             downsample_dict[UMI_SATURATION].append(umi_saturation)
             downsample_dict[READ_SATURATION].append(read_saturation)
             downsample_dict[MEDIAN_GENE_NUMBER].append(geneNum_median)
+            downsample_dict[MEAN_READS_PER_CELL].append(mean_reads_per_cell)
         
             self.add_metric(
                 name=f'Read Fraction {fraction} read_saturation',
@@ -477,10 +714,34 @@ class Count(Step):
                 show=False,
             )
 
-        df_downsample = pd.DataFrame(downsample_dict, columns=[READ_FRACTION, MEDIAN_GENE_NUMBER, UMI_SATURATION, READ_SATURATION])
+        df_downsample = pd.DataFrame(downsample_dict, columns=[
+            READ_FRACTION, MEDIAN_GENE_NUMBER, UMI_SATURATION, READ_SATURATION, MEAN_READS_PER_CELL])
         df_downsample.to_csv(self.downsample_file, index=False, sep='\t')
         self.downsample_dict = downsample_dict
 
+    @utils.add_log
+    def downsample(self, df_cell):
+        """saturation and median gene
+        Args:
+            df_cell: in cell df with (Barcode geneID UMI count)
+        """
+        barcode_index, _ = pd.factorize(df_cell['Barcode'])
+        gene_index, _ = pd.factorize(df_cell['geneID'])
+        self.add_downsample(df_cell['count'].to_numpy(), barcode_index, gene_index)
+
+    @utils.add_log
+    def downsample_count_detail(self, cell_detail):
+        """saturation and median gene. Same as `downsample`.
+        Args:
+            cell_detail: CountDetail of cell barcodes
+        """
+        self.add_downsample(cell_detail.read_count, cell_detail.barcode_index, cell_detail.gene_index)
+
+
+def _write_count_detail_shard(bam, start, end, writer_class, writer_kwargs):
+    with writer_class(**writer_kwargs) as writer:
+        Count.write_count_detail(bam, writer, start, end)
+
 
 @utils.add_log
 def count(args):
@@ -497,6 +758,31 @@ def get_opts_count(parser, sub_program):
         choices=['auto', 'EmptyDrops_CR'],
         default='EmptyDrops_CR',
     )
+    parser.add_argument(
+        '--count_detail_format',
+        help=(
+            'Default `txt`. `txt`: write tab-delimited `{sample}_count_detail.txt`. '
+            '`npz`: write integer-encoded `{sample}_count_detail/` chunks, which use less memory on large samples.'
+        ),
+        choices=['txt', 'npz'],
+        default='txt',
+    )
+    parser.add_argument(
+        '--gzip_matrix',
+        help='Write gzipped matrix files(`matrix.mtx.gz`, `features.tsv.gz`, `barcodes.tsv.gz`).',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--matrix_h5',
+        help='Also write raw and filtered matrix in 10X HDF5 format(`.h5`).',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--saturation_points',
+        help='Number of read fractions in the saturation curve of `{sample}_downsample.tsv`.',
+        default=10,
+        type=int,
+    )
     if sub_program:
         parser = s_common(parser)
         parser.add_argument('--bam', help='Required. BAM file from featureCounts.', required=True)
@@ -528,6 +814,41 @@ class Count_test(unittest.TestCase):
         self.assertEqual(n_corrected_umi, 3)
         self.assertEqual(n_corrected_read, 2 + 5 + 10)
 
+    def test_correct_umi_same_as_scan(self):
+        random.seed(0)
+        for _ in range(200):
+            umi_list = [''.join(random.choice('ACGT') for _ in range(5)) for _ in range(random.randint(MIN_UMI_INDEX, 300))]
+            dic = {umi: random.choice([1, 1, 2, 5, 10, 30, 100]) for umi in umi_list}
+            dic_scan = dict(dic)
+            result = Count.correct_umi(dic)
+            result_scan = Count.correct_umi_by_scan(dic_scan)
+            self.assertEqual(dic, dic_scan)
+            self.assertEqual(result, result_scan)
+
+    def test_saturation_curve(self):
+        rng = np.random.RandomState(1)
+        n_row = 5000
+        read_count = rng.choice([1, 1, 1, 2, 3, 10], n_row)
+        barcode_index = np.sort(rng.randint(0, 50, n_row))
+        gene_index = rng.randint(0, 300, n_row)
+        fractions = Count.get_fractions(10)
+
+        state = np.random.get_state()
+        curve = Count.get_saturation_curve(read_count, barcode_index, gene_index, fractions)
+
+        # subsample the shuffled read index for each fraction
+        np.random.set_state(state)
+        cell_read_index = np.arange(n_row, dtype='int32').repeat(read_count)
+        np.random.shuffle(cell_read_index)
+        for fraction, (umi_saturation, read_saturation, geneNum_median, _) in zip(fractions, curve):
+            frac_n_read = int(read_count.sum() * fraction)
+            index_dedup, counts = np.unique(cell_read_index[:frac_n_read], return_counts=True)
+            n_count_once = np.sum(counts == 1)
+            self.assertEqual(umi_saturation, round((1 - n_count_once / len(index_dedup)) * 100, 2))
+            self.assertEqual(read_saturation, round((1 - n_count_once / frac_n_read) * 100, 2))
+            df = pd.DataFrame({'Barcode': barcode_index[index_dedup], 'geneID': gene_index[index_dedup]})
+            self.assertEqual(geneNum_median, float(df.groupby('Barcode')['geneID'].nunique().median()))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,399 @@
+"""
+Count detail: one row per (barcode, gene, UMI) with read count.
+
+Two formats are supported
+- txt: `{sample}_count_detail.txt`, tab-delimited text with columns `Barcode geneID UMI count`.
+- npz: `{sample}_count_detail/` directory of chunked `.npz` files. Each chunk contains the integer-encoded columns
+    `barcode_index gene_index umi_code read_count` and the `barcodes` of the chunk. `gene_index` is the index in
+    `genes.npy`. UMI is encoded with 2 bits per base, N positions are marked in the higher bits. See `encode_umi`.
+    Chunks are split at barcode boundaries.
+"""
+
+import glob
+import os
+import shutil
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from celescope.tools import utils
+from celescope.tools.barcode_index import BASE_CODE, N_BASE, encode_seq
+from celescope.tools.matrix import CountMatrix
+
+# rows per npz chunk. Each writer keeps one chunk in preallocated arrays(~24 bytes per row).
+CHUNK_SIZE = 1000000
+# npz format
+GENE_FILE = 'genes.npy'
+CHUNK_PATTERN = 'chunk_*.npz'
+# max UMI length that can be encoded in uint64 with N mask
+MAX_UMI_LENGTH = 16
+# ascii -> 2-bit code, N -> 4, others -> 5
+UMI_BASE_TABLE = np.full(256, 5, dtype=np.uint64)
+for _base, _code in BASE_CODE.items():
+    UMI_BASE_TABLE[ord(_base)] = _code
+UMI_BASE_TABLE[ord(N_BASE)] = 4
+
+
+def encode_umi(umi):
+    """
+    Encode UMI to int. 2 bits per base in the lower bits, '11' at N positions in the higher bits.
+
+    >>> encode_umi('ACGT')
+    27
+    >>> encode_umi('ANGT') == (48 << 8) | 11
+    True
+    """
+    umi_len = len(umi)
+    if umi_len > MAX_UMI_LENGTH:
+        raise ValueError(f'UMI longer than {MAX_UMI_LENGTH} can not be encoded: {umi}. Use `--count_detail_format txt`.')
+    encoded = encode_seq(umi)
+    if encoded is None:
+        raise ValueError(f'Invalid base in UMI: {umi}')
+    code, n_mask = encoded
+    return (n_mask << (2 * umi_len)) | code
+
+
+def encode_umi_list(umi_list):
+    """
+    Encode a list of UMI to uint64 array. Same as `encode_umi`; vectorized if all UMI have the same length.
+
+    >>> encode_umi_list(['ACGT', 'ANGT', 'TTTT']).tolist() == [encode_umi('ACGT'), encode_umi('ANGT'), encode_umi('TTTT')]
+    True
+    """
+    umi_lens = set(map(len, umi_list))
+    if len(umi_lens) != 1 or max(umi_lens) > MAX_UMI_LENGTH:
+        return np.array([encode_umi(umi) for umi in umi_list], dtype=np.uint64)
+
+    umi_len = umi_lens.pop()
+    base_code = UMI_BASE_TABLE[np.array(umi_list, dtype=f'S{umi_len}').view(np.uint8).reshape(-1, umi_len)]
+    if (base_code == 5).any():
+        invalid = umi_list[int(np.flatnonzero((base_code == 5).any(axis=1))[0])]
+        raise ValueError(f'Invalid base in UMI: {invalid}')
+    is_n = base_code == 4
+    base_code[is_n] = 0
+    shift = np.arange(2 * (umi_len - 1), -1, -2, dtype=np.uint64)
+    code = np.bitwise_or.reduce(base_code << shift, axis=1)
+    n_mask = np.bitwise_or.reduce(is_n.astype(np.uint64) * np.uint64(3) << shift, axis=1)
+    return (n_mask << np.uint64(2 * umi_len)) | code
+
+
+class CountDetailTxtWriter:
+    """
+    Write count detail text file.
+    """
+
+    def __init__(self, count_detail_file, header=True):
+        """
+        Args:
+            header: False for part files which will be merged by `merge_parts`.
+        """
+        self.fh = open(count_detail_file, 'wt')
+        if header:
+            self.fh.write('\t'.join(['Barcode', 'geneID', 'UMI', 'count']) + '\n')
+
+    @staticmethod
+    def merge_parts(count_detail_file, part_files):
+        """
+        Concatenate part files in order and remove them.
+        """
+        with CountDetailTxtWriter(count_detail_file) as writer:
+            for part_file in part_files:
+                with open(part_file, 'rt') as fh:
+                    shutil.copyfileobj(fh, writer.fh)
+                os.remove(part_file)
+
+    def write_barcode(self, barcode, rows):
+        """
+        Args:
+            rows: list of (gene_id, umi, read_count)
+        """
+        for gene_id, umi, read_count in rows:
+            self.fh.write('%s\t%s\t%s\t%s\n' % (barcode, gene_id, umi, read_count))
+
+    def close(self):
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+
+class CountDetailNpzWriter:
+    """
+    Stream count detail into integer-encoded arrays and write them as npz chunks.
+    Rows are encoded when written into preallocated arrays of chunk_size rows, so no Python object is kept per row.
+    """
+
+    def __init__(self, count_detail_dir, gene_ids, chunk_prefix='chunk', chunk_size=CHUNK_SIZE, init_dir=True):
+        """
+        Args:
+            gene_ids: list of gene_id. gene_index is the index in this list.
+            chunk_prefix: chunk file prefix. Chunks are sorted by file name when reading.
+            init_dir: False if several writers write to the same dir. `init_dir` must be called before.
+        """
+        self.count_detail_dir = count_detail_dir
+        self.chunk_prefix = chunk_prefix
+        self.chunk_size = chunk_size
+        self.gene_index_dict = {gene_id: index for index, gene_id in enumerate(gene_ids)}
+        if init_dir:
+            CountDetailNpzWriter.init_dir(count_detail_dir, gene_ids)
+
+        self.n_chunk = 0
+        self._init_buffer()
+
+    @staticmethod
+    def init_dir(count_detail_dir, gene_ids):
+        """
+        Remove chunks from previous runs and write gene_ids.
+        """
+        utils.check_mkdir(count_detail_dir)
+        for chunk_file in glob.glob(f'{count_detail_dir}/{CHUNK_PATTERN}'):
+            os.remove(chunk_file)
+        np.save(f'{count_detail_dir}/{GENE_FILE}', np.array(gene_ids, dtype=str))
+
+    def _init_buffer(self, n_row=None):
+        n_row = max(n_row or 0, self.chunk_size)
+        self.barcodes = []
+        self.n_row = 0
+        self.barcode_index = np.empty(n_row, dtype=np.int32)
+        self.gene_index = np.empty(n_row, dtype=np.int32)
+        self.umi_code = np.empty(n_row, dtype=np.uint64)
+        self.read_count = np.empty(n_row, dtype=np.int64)
+
+    def write_barcode(self, barcode, rows):
+        """
+        Args:
+            rows: list of (gene_id, umi, read_count). Rows of one barcode must be written in one call.
+        """
+        if not rows:
+            return
+        n_row = len(rows)
+        if self.n_row + n_row > len(self.read_count):
+            self.flush()
+            if n_row > len(self.read_count):
+                self._init_buffer(n_row)
+        gene_ids, umis, read_counts = zip(*rows)
+        start, end = self.n_row, self.n_row + n_row
+        self.barcode_index[start:end] = len(self.barcodes)
+        self.gene_index[start:end] = [self.gene_index_dict[gene_id] for gene_id in gene_ids]
+        self.umi_code[start:end] = encode_umi_list(umis)
+        self.read_count[start:end] = read_counts
+        self.barcodes.append(barcode)
+        self.n_row = end
+        if self.n_row >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.barcodes:
+            return
+        np.savez(
+            f'{self.count_detail_dir}/{self.chunk_prefix}_{self.n_chunk:05d}.npz',
+            barcodes=np.array(self.barcodes, dtype=str),
+            barcode_index=self.barcode_index[:self.n_row],
+            gene_index=self.gene_index[:self.n_row],
+            umi_code=self.umi_code[:self.n_row],
+            read_count=self.read_count[:self.n_row],
+        )
+        self.n_chunk += 1
+        self.barcodes = []
+        self.n_row = 0
+        if len(self.read_count) > self.chunk_size:
+            self._init_buffer()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+
+class CountDetail:
+    """
+    Integer-encoded count detail. Row order is the same as in the count detail file.
+    """
+
+    def __init__(self, barcodes, gene_ids, barcode_index, gene_index, read_count, umi_code=None):
+        """
+        Args:
+            barcodes: np.array of barcode str
+            gene_ids: np.array of gene_id str
+            barcode_index, gene_index: np.array. Index in barcodes and gene_ids.
+            read_count: np.array
+            umi_code: np.array or None. Not needed for aggregations.
+        """
+        self.barcodes = np.asarray(barcodes, dtype=str)
+        self.gene_ids = np.asarray(gene_ids, dtype=str)
+        self.barcode_index = barcode_index
+        self.gene_index = gene_index
+        self.read_count = read_count
+        self.umi_code = umi_code
+
+    @classmethod
+    @utils.add_log
+    def from_txt(cls, count_detail_file, gene_ids):
+        df = pd.read_table(count_detail_file, header=0, usecols=['Barcode', 'geneID', 'count'])
+        barcode_index, barcodes = pd.factorize(df['Barcode'])
+        gene_index = pd.Index(gene_ids).get_indexer(df['geneID'])
+        if (gene_index == -1).any():
+            unknown = df['geneID'].iloc[int(np.flatnonzero(gene_index == -1)[0])]
+            raise KeyError(f'geneID {unknown} in {count_detail_file} not found in features.')
+        gene_index = gene_index.astype(np.int32)
+        return cls(
+            barcodes=np.asarray(barcodes, dtype=str),
+            gene_ids=gene_ids,
+            barcode_index=barcode_index.astype(np.int32),
+            gene_index=gene_index,
+            read_count=df['count'].to_numpy(dtype=np.int64),
+        )
+
+    @classmethod
+    @utils.add_log
+    def from_npz_dir(cls, count_detail_dir):
+        gene_ids = np.load(f'{count_detail_dir}/{GENE_FILE}')
+        barcodes, barcode_index, gene_index, umi_code, read_count = [], [], [], [], []
+        n_barcode = 0
+        for chunk_file in sorted(glob.glob(f'{count_detail_dir}/{CHUNK_PATTERN}')):
+            with np.load(chunk_file) as chunk:
+                barcodes.append(chunk['barcodes'])
+                barcode_index.append(chunk['barcode_index'] + n_barcode)
+                gene_index.append(chunk['gene_index'])
+                umi_code.append(chunk['umi_code'])
+                read_count.append(chunk['read_count'])
+                n_barcode += len(chunk['barcodes'])
+
+        def concat(arr_list, dtype):
+            if not arr_list:
+                return np.array([], dtype=dtype)
+            return np.concatenate(arr_list)
+
+        return cls(
+            barcodes=concat(barcodes, str),
+            gene_ids=gene_ids,
+            barcode_index=concat(barcode_index, np.int32),
+            gene_index=concat(gene_index, np.int32),
+            read_count=concat(read_count, np.int64),
+            umi_code=concat(umi_code, np.uint64),
+        )
+
+    def __len__(self):
+        return len(self.read_count)
+
+    def get_sorted_barcodes(self):
+        """
+        Returns:
+            sorted_barcodes: sorted barcodes which have at least one row
+            barcode_rank: index of each row's barcode in sorted_barcodes
+        """
+        used = np.unique(self.barcode_index)
+        used_barcodes = self.barcodes[used]
+        order = np.argsort(used_barcodes, kind='stable')
+        rank = np.empty(len(self.barcodes), dtype=np.int64)
+        rank[used[order]] = np.arange(len(used))
+        return used_barcodes[order], rank[self.barcode_index]
+
+    def get_df_sum(self):
+        """
+        Same as `Count.get_df_sum(df)`.
+        Returns:
+            df_sum with index Barcode and columns ['readcount', 'UMI2', 'UMI', 'geneID'], sorted by UMI.
+        """
+        sorted_barcodes, barcode_rank = self.get_sorted_barcodes()
+        n_barcode = len(sorted_barcodes)
+        read_count = self.read_count
+        readcount = np.bincount(barcode_rank, weights=read_count, minlength=n_barcode)
+        umi2 = np.bincount(barcode_rank, weights=np.where(read_count > 1, read_count, 0), minlength=n_barcode)
+        umi = np.bincount(barcode_rank, minlength=n_barcode)
+        barcode_gene = np.unique(barcode_rank * len(self.gene_ids) + self.gene_index)
+        gene = np.bincount(barcode_gene // len(self.gene_ids), minlength=n_barcode)
+
+        df_sum = pd.DataFrame({
+            'readcount': readcount.astype(np.int64),
+            'UMI2': umi2.astype(np.int64),
+            'UMI': umi.astype(np.int64),
+            'geneID': gene.astype(np.int64),
+        }, index=pd.Index(sorted_barcodes, name='Barcode'))
+        df_sum = df_sum.sort_values('UMI', ascending=False)
+        return df_sum
+
+    def subset_barcodes(self, barcodes):
+        """
+        Returns:
+            CountDetail with rows of barcodes. Row order and barcode index are kept.
+        """
+        bool_barcode = np.isin(self.barcodes, np.asarray(barcodes, dtype=str))
+        row_index = np.flatnonzero(bool_barcode[self.barcode_index])
+        umi_code = None if self.umi_code is None else self.umi_code[row_index]
+        count_detail = CountDetail(
+            barcodes=self.barcodes,
+            gene_ids=self.gene_ids,
+            barcode_index=self.barcode_index[row_index],
+            gene_index=self.gene_index[row_index],
+            read_count=self.read_count[row_index],
+            umi_code=umi_code,
+        )
+        return count_detail
+
+    def to_count_matrix(self, features):
+        """
+        Same as `CountMatrix.from_dataframe(df, features, value='UMI')`. Value is the number of UMI.
+        """
+        gene_to_feature = pd.Index(features.gene_id).get_indexer(self.gene_ids)
+        sorted_barcodes, barcode_rank = self.get_sorted_barcodes()
+        return CountMatrix.from_arrays(features, sorted_barcodes.tolist(), gene_to_feature[self.gene_index], barcode_rank)
+
+    def n_gene(self):
+        """number of genes with at least one row"""
+        return len(np.unique(self.gene_index))
+
+    def total_read(self):
+        return int(self.read_count.sum())
+
+
+class Test_count_detail(unittest.TestCase):
+    def test_same_as_dataframe(self):
+        import random
+        import tempfile
+        from celescope.tools.count import Count
+        from celescope.tools.matrix import Features
+
+        random.seed(0)
+        gene_ids = [f'gene{i}' for i in range(30)]
+        rows = []
+        for _ in range(300):
+            barcode = ''.join(random.choice('ACGT') for _ in range(6))
+            for _ in range(random.randint(1, 20)):
+                umi = ''.join(random.choice('ACGTN') for _ in range(8))
+                rows.append((barcode, random.choice(gene_ids), umi, random.randint(1, 5)))
+        rows.sort(key=lambda x: x[0])
+        features = Features(gene_ids)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            txt_file = f'{temp_dir}/count_detail.txt'
+            npz_dir = f'{temp_dir}/count_detail'
+            with CountDetailTxtWriter(txt_file) as txt_writer, \
+                    CountDetailNpzWriter(npz_dir, gene_ids, chunk_size=10) as npz_writer:
+                for barcode, group in pd.DataFrame(rows).groupby(0, sort=False):
+                    barcode_rows = list(group[[1, 2, 3]].itertuples(index=False, name=None))
+                    txt_writer.write_barcode(barcode, barcode_rows)
+                    npz_writer.write_barcode(barcode, barcode_rows)
+
+            df = pd.read_table(txt_file, header=0)
+            df_sum = Count.get_df_sum(df)
+            matrix = CountMatrix.from_dataframe(df, features, value='UMI')
+            # barcodes with more than chunk_size rows are written in one chunk
+            self.assertEqual(CountDetail.from_npz_dir(npz_dir).umi_code.tolist(), encode_umi_list(df['UMI']).tolist())
+            for count_detail in (CountDetail.from_txt(txt_file, gene_ids), CountDetail.from_npz_dir(npz_dir)):
+                pd.testing.assert_frame_equal(df_sum, count_detail.get_df_sum())
+                count_matrix = count_detail.to_count_matrix(features)
+                self.assertEqual(matrix.get_barcodes(), count_matrix.get_barcodes())
+                self.assertEqual((matrix.get_matrix() != count_matrix.get_matrix()).nnz, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
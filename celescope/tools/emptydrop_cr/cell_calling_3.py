@@ -93,11 +93,13 @@ def est_background_profile_sgt(matrix, use_bcs):
 def find_nonambient_barcodes(raw_mat, recovered_cells,
                              min_umi_frac_of_median=MIN_UMI_FRAC_OF_MEDIAN,
                              min_umis_nonambient=MIN_UMIS,
-                             max_adj_pvalue=MAX_ADJ_PVALUE,):
+                             max_adj_pvalue=MAX_ADJ_PVALUE,
+                             n_jobs=1):
     """ Call barcodes as being sufficiently distinct from the ambient profile
     Args:
-      raw_mat: raw matrix of UMI counts
+      raw_mat: raw matrix of UMI counts. Converted to CSC once and reused.
       recovered_cells: expected number of recovered cells
+      n_jobs: number of processes to simulate log likelihoods. Results do not depend on it.
     Returns:
     TBD
     """
@@ -109,6 +111,8 @@ def find_nonambient_barcodes(raw_mat, recovered_cells,
                                           'is_nonambient',  # Boolean nonambient calls (n)
                                           ])
 
+    raw_mat = raw_mat.tocsc()
+
     # Estimate an ambient RNA profile
     umis_per_bc = np.squeeze(np.asarray(raw_mat.sum(axis=0)))
     # get the index of sorted umis_per_bc (ascending, bc_order[0] is the index of the smallest element in umis_per_bc)
@@ -129,7 +133,7 @@ def find_nonambient_barcodes(raw_mat, recovered_cells,
         try:
             # Get used "Gene" features (eval_features)
             # and the smoothed prob profile per "Gene" (ambient_profile_p)
-            eval_features, ambient_profile_p = est_background_profile_sgt(raw_mat.tocsc(), use_bcs)
+            eval_features, ambient_profile_p = est_background_profile_sgt(raw_mat, use_bcs)
         except cr_sgt.SimpleGoodTuringError as e:
             print(str(e))
     else:
@@ -145,8 +149,9 @@ def find_nonambient_barcodes(raw_mat, recovered_cells,
     print('\n'.join(list(map(lambda x: '{}: {}'.format(*x), list(gg_filtered_metrics.items())))))
     print('==============================')
 
-    orig_cell_bc_set = set(gg_filtered_indices)
-    orig_cells = np.flatnonzero(np.fromiter((bc in orig_cell_bc_set for bc in range(raw_mat.shape[1])), dtype=bool))
+    is_orig_cell = np.zeros(raw_mat.shape[1], dtype=bool)
+    is_orig_cell[np.asarray(gg_filtered_indices, dtype=int)] = True
+    orig_cells = np.flatnonzero(is_orig_cell)
 
     # No good incoming cell calls
     if orig_cells.sum() == 0:
@@ -180,7 +185,7 @@ def find_nonambient_barcodes(raw_mat, recovered_cells,
         print('Number of candidate bcs: {}'.format(len(eval_bcs)))
         print('Range candidate bc umis: {}, {}'.format(umis_per_bc[eval_bcs].min(), umis_per_bc[eval_bcs].max()))
 
-        eval_mat = raw_mat.tocsc()[eval_features, :][:, eval_bcs]
+        eval_mat = raw_mat[eval_features, :][:, eval_bcs]
 
         if len(ambient_profile_p) == 0:
             obs_loglk = np.repeat(np.nan, len(eval_bcs))
@@ -191,8 +196,8 @@ def find_nonambient_barcodes(raw_mat, recovered_cells,
         obs_loglk = cr_stats.eval_multinomial_loglikelihoods(eval_mat, ambient_profile_p)
 
         # Simulate log likelihoods
-        distinct_ns, sim_loglk = cr_stats.simulate_multinomial_loglikelihoods(ambient_profile_p, umis_per_bc[eval_bcs],
-                                                                              num_sims=10000, verbose=True)
+        distinct_ns, sim_loglk = cr_stats.simulate_multinomial_loglikelihoods_batched(
+            ambient_profile_p, umis_per_bc[eval_bcs], num_sims=10000, verbose=True, n_jobs=n_jobs)
 
         # Compute p-values
         pvalues = cr_stats.compute_ambient_pvalues(umis_per_bc[eval_bcs], obs_loglk, distinct_ns, sim_loglk)
@@ -218,13 +223,20 @@ def find_nonambient_barcodes(raw_mat, recovered_cells,
         )
 
 
-def cell_calling_3(all_matrix_10X_dir, expected_cell_num):
-
-    count_matrix = CountMatrix.from_matrix_dir(matrix_dir=all_matrix_10X_dir)
+def cell_calling_3(all_matrix_10X, expected_cell_num, n_jobs=1):
+    """
+    Args:
+        all_matrix_10X: raw CountMatrix, or raw matrix dir(or .h5 file) to read from.
+        n_jobs: number of processes to simulate log likelihoods.
+    """
+    if isinstance(all_matrix_10X, CountMatrix):
+        count_matrix = all_matrix_10X
+    else:
+        count_matrix = CountMatrix.from_matrix_dir(matrix_dir=all_matrix_10X)
 
     # Run cell calling
     filtered_bc_indices, round_1_filtered_metrics, _non_ambient_barcode_result = find_nonambient_barcodes(
-        raw_mat=count_matrix.get_matrix(), recovered_cells=expected_cell_num)
+        raw_mat=count_matrix.get_matrix(), recovered_cells=expected_cell_num, n_jobs=n_jobs)
 
     raw_barcodes = np.array(count_matrix.get_barcodes())
     cell_bc = raw_barcodes[filtered_bc_indices]
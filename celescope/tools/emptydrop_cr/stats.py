@@ -4,6 +4,9 @@
 #
 
 import sys
+import unittest
+from collections import deque
+from multiprocessing import Pool
 
 import numpy as np
 import scipy.stats as sp_stats
@@ -429,6 +432,205 @@ def simulate_multinomial_loglikelihoods(profile_p, umis_per_bc,
     return distinct_n, loglk
 
 
+class _FeatureStream:
+    """Feature samples drawn in blocks from the global numpy RNG.
+       Draws are made at the same points as in simulate_multinomial_loglikelihoods.
+    """
+
+    def __init__(self, profile_p, n_sample_feature_block):
+        self.profile_p = profile_p
+        self.block_size = n_sample_feature_block
+        self.block = self._draw()
+        self.k = 0
+
+    def _draw(self):
+        return np.random.choice(len(self.profile_p), size=self.block_size, p=self.profile_p, replace=True)
+
+    def take(self, size):
+        parts = []
+        while size > 0:
+            n_take = min(size, self.block_size - self.k)
+            parts.append(self.block[self.k:self.k + n_take])
+            self.k += n_take
+            size -= n_take
+            if self.k >= self.block_size:
+                self.block = self._draw()
+                self.k = 0
+        return np.concatenate(parts)
+
+
+def get_simulation_plan(distinct_n, jump):
+    """Group the steps between distinct Ns into jumps and runs of single-UMI increments.
+    Args:
+      distinct_n (np.ndarray(int)): Sorted distinct N values.
+      jump (int): Gap between two distinct Ns to sample all at once.
+    Returns:
+      plan (list): ('jump', i) or ('run', [i, ...]) in order. i is the index in distinct_n.
+
+    >>> get_simulation_plan(np.array([1, 2, 4, 10, 11]), 5)
+    [('run', [1, 2]), ('jump', 3), ('run', [4])]
+    """
+    plan = []
+    for i in range(1, len(distinct_n)):
+        if distinct_n[i] - distinct_n[i-1] >= jump:
+            plan.append(('jump', i))
+        elif plan and plan[-1][0] == 'run':
+            plan[-1][1].append(i)
+        else:
+            plan.append(('run', [i]))
+    return plan
+
+
+def draw_simulation_batch(profile_p, distinct_n, plan, feature_stream, num_sims):
+    """Draw random numbers of num_sims simulations. The order of draws is the same as in
+       simulate_multinomial_loglikelihoods, so the global numpy RNG ends in the same state.
+    Returns:
+      batch (dict): 'init_counts' of shape (num_sims, n_feature) and one array per plan item:
+        counts of shape (num_sims, n_feature) for a jump, sampled features of shape (num_sims, run length) for a run.
+    """
+    init_counts = []
+    draws = [[] for _ in plan]
+    for _sim_idx in range(num_sims):
+        init_counts.append(np.ravel(sp_stats.multinomial.rvs(distinct_n[0], profile_p, size=1)))
+        for plan_idx, (kind, value) in enumerate(plan):
+            if kind == 'jump':
+                step = distinct_n[value] - distinct_n[value-1]
+                draws[plan_idx].append(np.ravel(sp_stats.multinomial.rvs(step, profile_p, size=1)))
+            else:
+                run_size = distinct_n[value[-1]] - distinct_n[value[0]-1]
+                draws[plan_idx].append(feature_stream.take(run_size))
+    return {
+        'init_counts': np.array(init_counts),
+        'draws': [np.array(x) for x in draws],
+    }
+
+
+def eval_simulation_batch(profile_p, distinct_n, plan, batch):
+    """Compute simulated log likelihoods from the draws of draw_simulation_batch.
+       Single-UMI increments are accumulated with np.cumsum, which adds in the same order as the serial loop.
+    Returns:
+      log_likelihoods (np.ndarray(float)): len(distinct_n) x num_sims
+    """
+    log_profile_p = np.log(profile_p)
+    curr_counts = batch['init_counts'].copy()
+    num_sims, n_feature = curr_counts.shape
+    loglk = np.zeros((len(distinct_n), num_sims), dtype=float)
+    curr_loglk = np.array([sp_stats.multinomial.logpmf(x, distinct_n[0], p=profile_p) for x in curr_counts])
+    loglk[0] = curr_loglk
+    sim_offset = np.arange(num_sims)[:, None] * n_feature
+
+    for (kind, value), draw in zip(plan, batch['draws']):
+        if kind == 'jump':
+            curr_counts += draw
+            curr_loglk = np.array([
+                sp_stats.multinomial.logpmf(x, distinct_n[value], p=profile_p) for x in curr_counts])
+            assert not np.any(np.isnan(curr_loglk))
+            loglk[value] = curr_loglk
+            continue
+
+        # count of the sampled feature after each increment = count before the run + rank among the same features
+        keys = (draw + sim_offset).ravel()
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        is_first = np.ones(len(keys), dtype=bool)
+        is_first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+        positions = np.arange(len(keys))
+        group_start = np.maximum.accumulate(np.where(is_first, positions, 0))
+        rank = np.empty(len(keys), dtype=np.int64)
+        rank[order] = positions - group_start + 1
+        counts = curr_counts.ravel()[keys] + rank
+
+        n = np.arange(distinct_n[value[0]-1] + 1, distinct_n[value[-1]] + 1)
+        increments = log_profile_p[draw] + np.log(np.tile(n.astype(float), num_sims) / counts).reshape(draw.shape)
+        run_loglk = np.cumsum(np.column_stack([curr_loglk, increments]), axis=1)
+        ends = distinct_n[value] - distinct_n[value[0]-1]
+        loglk[value] = run_loglk[:, ends].T
+        curr_loglk = run_loglk[:, -1]
+        curr_counts += np.bincount(keys, minlength=curr_counts.size).reshape(curr_counts.shape)
+
+    return loglk
+
+
+# (profile_p, distinct_n, plan) of worker processes. Set once by the pool initializer.
+_worker_simulation = None
+
+
+def _init_simulation(profile_p, distinct_n, plan):
+    global _worker_simulation
+    _worker_simulation = (profile_p, distinct_n, plan)
+
+
+def _eval_simulation_batch(batch):
+    return eval_simulation_batch(*_worker_simulation, batch)
+
+
+def simulate_multinomial_loglikelihoods_batched(profile_p, umis_per_bc,
+                                                num_sims=1000, jump=1000,
+                                                n_sample_feature_block=1000000, verbose=False,
+                                                n_jobs=1, max_mem_gb=0.1):
+    """Same as simulate_multinomial_loglikelihoods, but the log likelihoods of a batch of simulations are computed
+       with numpy instead of a python loop over each N.
+       Random numbers are drawn from the global numpy RNG in the same order as simulate_multinomial_loglikelihoods,
+       so the results are the same with the same seed, regardless of n_jobs.
+    Args:
+      n_jobs (int): Number of processes to compute log likelihoods of batches.
+      max_mem_gb (float): Try to bound memory usage of one batch.
+    Returns:
+      (distinct_ns (np.ndarray(int)), log_likelihoods (np.ndarray(float)): see simulate_multinomial_loglikelihoods.
+    """
+    distinct_n = np.flatnonzero(np.bincount(umis_per_bc))
+
+    loglk = np.zeros((len(distinct_n), num_sims), dtype=float)
+    num_all_n = np.max(distinct_n) - np.min(distinct_n)
+    if verbose:
+        print('Number of distinct N supplied: %d' % len(distinct_n))
+        print('Range of N: %d' % num_all_n)
+        print('Number of features: %d' % len(profile_p))
+
+    plan = get_simulation_plan(distinct_n, jump)
+    n_jump = sum(1 for kind, _value in plan if kind == 'jump')
+    # int64 counts, features and float increments of one simulation, with some room for temporary arrays
+    gb_per_sim = float((2 + n_jump) * len(profile_p) + 6 * num_all_n) * 8 / (1024**3)
+    sims_per_batch = max(1, min(num_sims, int(max_mem_gb / gb_per_sim)))
+
+    feature_stream = _FeatureStream(profile_p, n_sample_feature_block)
+
+    def batches():
+        for start in range(0, num_sims, sims_per_batch):
+            if verbose:
+                sys.stdout.write('.')
+                sys.stdout.flush()
+            batch = draw_simulation_batch(
+                profile_p, distinct_n, plan, feature_stream, min(sims_per_batch, num_sims - start))
+            yield start, batch
+
+    if n_jobs <= 1:
+        for start, batch in batches():
+            result = eval_simulation_batch(profile_p, distinct_n, plan, batch)
+            loglk[:, start:start + result.shape[1]] = result
+    else:
+        max_pending = n_jobs * 2
+        with Pool(n_jobs, initializer=_init_simulation, initargs=(profile_p, distinct_n, plan)) as pool:
+            pending = deque()
+
+            def collect():
+                start, async_result = pending.popleft()
+                result = async_result.get()
+                loglk[:, start:start + result.shape[1]] = result
+
+            for start, batch in batches():
+                pending.append((start, pool.apply_async(_eval_simulation_batch, (batch,))))
+                if len(pending) >= max_pending:
+                    collect()
+            while pending:
+                collect()
+
+    if verbose:
+        sys.stdout.write('\n')
+
+    return distinct_n, loglk
+
+
 def compute_ambient_pvalues(umis_per_bc, obs_loglk, sim_n, sim_loglk):
     """Compute p-values for observed multinomial log-likelihoods
     Args:
@@ -454,3 +656,29 @@ def compute_ambient_pvalues(umis_per_bc, obs_loglk, sim_n, sim_loglk):
         num_lower_loglk = np.sum(sim_loglk[sim_n_idx[i], :] < obs_loglk[i])
         pvalues[i] = float(1 + num_lower_loglk) / (1 + num_sims)
     return pvalues
+
+
+class Test_simulate(unittest.TestCase):
+    def test_batched_same_as_serial(self):
+        rng = np.random.RandomState(1)
+        profile_p = rng.dirichlet(np.ones(200))
+        umis_per_bc = np.concatenate([rng.randint(50, 300, 50), [2000]])
+        results = []
+        for func, kwargs in (
+            (simulate_multinomial_loglikelihoods, {}),
+            (simulate_multinomial_loglikelihoods_batched, {'max_mem_gb': 1e-5}),
+            (simulate_multinomial_loglikelihoods_batched, {'n_jobs': 2}),
+        ):
+            np.random.seed(0)
+            distinct_n, loglk = func(profile_p, umis_per_bc, num_sims=20, jump=500,
+                                     n_sample_feature_block=1000, **kwargs)
+            # the global RNG ends in the same state
+            results.append((distinct_n, loglk, np.random.rand()))
+        for distinct_n, loglk, next_random in results[1:]:
+            np.testing.assert_array_equal(distinct_n, results[0][0])
+            np.testing.assert_array_equal(loglk, results[0][1])
+            self.assertEqual(next_random, results[0][2])
+
+
+if __name__ == '__main__':
+    unittest.main()
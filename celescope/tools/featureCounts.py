@@ -5,10 +5,12 @@ import pathlib
 from collections import defaultdict
 
 import pandas as pd
+import pysam
 
 from celescope.rna.mkref import Mkref_rna
 from celescope.tools.step import Step, s_common
 from celescope.tools import utils
+from celescope.tools.gtf_index import CLASSIFIED_STATUS, ReadClassifier, load_annotation
 from celescope.__init__ import HELP_DICT
 
 
@@ -36,10 +38,14 @@ class FeatureCounts(Step):
 
         # set
         self.gtf = Mkref_rna.parse_genomeDir(self.args.genomeDir)['gtf']
+        self.annotation = load_annotation(self.args.genomeDir)
         self.featureCounts_param = args.featureCounts_param
 
         #gtf_type
         self.gtf_types = ['exon','gene']
+        # with --single_pass, featureCounts only runs at gtf_type. Reads are classified at the other type while tagging.
+        if args.single_pass:
+            self.gtf_types = [args.gtf_type]
 
         #stats
         self.feature_log_dict = defaultdict(dict)
@@ -89,24 +95,47 @@ class FeatureCounts(Step):
             log_file = f'{outdir}/{self.sample}.summary'
 
             self.run_featureCounts(outdir,gtf_type)
+            self.feature_log_dict[gtf_type] = FeatureCounts.read_log(log_file)
             if gtf_type == self.args.gtf_type:
+                classifier = self.get_classifier(featureCounts_bam) if self.args.single_pass else None
                 samtools_runner = utils.Samtools(
                     in_bam=featureCounts_bam,
                     out_bam=featureCounts_bam,
                     threads=self.thread,
                     debug=self.debug
                 )
-                samtools_runner.add_tag(self.gtf)
-                samtools_runner.temp_sam2bam(by='coord')
-                samtools_runner.samtools_sort(
-                    in_file=featureCounts_bam,
-                    out_file=name_sorted_bam,
-                    by='name',
+                samtools_runner.add_tag_sorted(
+                    self.gtf,
+                    name_sorted_bam=name_sorted_bam,
+                    classifier=classifier,
+                    gtf_dict=self.annotation.get_gtf_dict(),
                 )
-            self.feature_log_dict[gtf_type] = FeatureCounts.read_log(log_file)
+                if classifier is not None:
+                    self.add_classified_log(classifier.get_counts())
         self.add_metrics()
         self.clean_tmp()
 
+    @utils.add_log
+    def get_classifier(self, featureCounts_bam):
+        """
+        Returns:
+            ReadClassifier at the gtf type not used by featureCounts
+        """
+        other_type = 'exon' if self.args.gtf_type == 'gene' else 'gene'
+        gtf_index = self.annotation.get_interval_index(other_type)
+        with pysam.AlignmentFile(featureCounts_bam, "rb") as bam:
+            references = bam.references
+        return ReadClassifier(gtf_index, references)
+
+    def add_classified_log(self, counts):
+        """
+        The log of the other gtf type is the same as the featureCounts log, except the status that depend on features.
+        """
+        other_type = 'exon' if self.args.gtf_type == 'gene' else 'gene'
+        log_dict = dict(self.feature_log_dict[self.args.gtf_type])
+        for status in CLASSIFIED_STATUS:
+            log_dict[status] = counts[status]
+        self.feature_log_dict[other_type] = log_dict
 
     @utils.add_log
     def add_metrics(self):
@@ -178,6 +207,13 @@ def get_opts_featureCounts(parser, sub_program):
     )
     parser.add_argument('--genomeDir', help=HELP_DICT['genomeDir'])
     parser.add_argument('--featureCounts_param', help=HELP_DICT['additional_param'], default="")
+    parser.add_argument(
+        '--single_pass',
+        help='Run featureCounts only once at `--gtf_type`. Exonic, intronic and intergenic reads are counted '
+        'with an interval index of the GTF while adding tags, instead of a second featureCounts run. '
+        'Should not be used with `--featureCounts_param` that changes read assignment, such as `-O` or `--fracOverlap`.',
+        action='store_true',
+    )
 
     if sub_program:
         parser.add_argument('--input', help='Required. BAM file path.', required=True)
@@ -0,0 +1,642 @@
+"""
+Strand-aware interval index of GTF features, used to classify reads the way featureCounts does(`-s 1`, no `-O`).
+
+A read is
+- Assigned if its aligned blocks overlap features of exactly one gene,
+- Unassigned_Ambiguity if they overlap features of two or more genes,
+- Unassigned_NoFeatures if they overlap no feature.
+
+Features of the same gene are merged. The genome is then cut into segments at all feature boundaries. For each segment,
+the number of covering genes and the covering gene(if only one) are stored, so that reads can be classified with numpy
+range reductions instead of per-read interval queries.
+
+The compiled annotation of a genomeDir(`Annotation`) holds the gene id/name maps, gene biotypes and the exon and gene
+GtfIndex. It is built once and saved as .npy files in `{genomeDir}/celescope_gtf_index`, which are memory mapped when
+loaded. It is rebuilt when the content of the GTF changes.
+Samples of a batch may load it at the same time. `{genomeDir}/celescope_gtf_index.lock` is locked shared while the index
+is read and exclusive while it is built, so that it is built once and never read while it is replaced.
+"""
+
+import fcntl
+import json
+import os
+import re
+import shutil
+import unittest
+from collections import Counter
+
+import numpy as np
+
+from celescope.tools import utils
+from celescope.tools.__init__ import GTF_INDEX_DIR
+from celescope.tools.matrix import Features
+from celescope.tools.mkref import Mkref
+from celescope.tools.reference import GtfParser
+from celescope.tools.step_cache import get_digest
+
+ASSIGNED = 'Assigned'
+AMBIGUITY = 'Unassigned_Ambiguity'
+NO_FEATURES = 'Unassigned_NoFeatures'
+# featureCounts status of reads that are classified again at the other feature level
+CLASSIFIED_STATUS = (NO_FEATURES, ASSIGNED, AMBIGUITY)
+STRANDS = ('+', '-')
+GENE_ID_PATTERN = re.compile(r'gene_id "(\S+)";')
+# increase when the content of the compiled annotation changes
+ANNOTATION_VERSION = 2
+ANNOTATION_META = 'meta.json'
+INTERVAL_TYPES = ('exon', 'gene')
+
+
+class GtfIndex:
+    """
+    Args:
+        gtf_file: GTF file
+        feature_type: 3rd column of GTF, such as exon or gene
+    """
+
+    def __init__(self, gtf_file, feature_type, parse=True):
+        """
+        Args:
+            parse: parse gtf_file. If False, lines are added by add_feature and set_segments is called by the caller.
+        """
+        self.gtf_file = gtf_file
+        self.feature_type = feature_type
+        self.gene_ids = []
+        # (chrom, strand): offset in global coordinate
+        self.offsets = {}
+        # sorted offsets of (chrom, strand) and their max feature end in global coordinate
+        self.key_offsets = np.zeros(0, dtype=np.int64)
+        self.key_ends = np.zeros(0, dtype=np.int64)
+        # segment k is [boundaries[k], boundaries[k+1]) in global coordinate
+        self.boundaries = np.zeros(1, dtype=np.int64)
+        self.seg_count = np.zeros(1, dtype=np.int64)
+        self.seg_gene_min = np.zeros(1, dtype=np.int64)
+        self.seg_gene_max = np.zeros(1, dtype=np.int64)
+        # features added so far. Cleared by set_segments
+        self.gene_index = {}
+        self.chrom_strand_end = {}
+        self.key_index = {}
+        self.keys, self.starts, self.ends, self.genes = [], [], [], []
+        if parse:
+            self.load_gtf()
+
+    @utils.add_log
+    def load_gtf(self):
+        with utils.generic_open(self.gtf_file, mode='rt') as f:
+            for line in f:
+                if not line.strip() or line.startswith('#'):
+                    continue
+                tabs = line.split('\t')
+                if tabs[2] == self.feature_type:
+                    self.add_feature(tabs)
+        self.set_segments()
+
+    def add_feature(self, tabs):
+        """
+        Args:
+            tabs: columns of a GTF line of feature_type
+        """
+        gene_id = GENE_ID_PATTERN.findall(tabs[8])[-1]
+        if gene_id not in self.gene_index:
+            self.gene_index[gene_id] = len(self.gene_ids)
+            self.gene_ids.append(gene_id)
+        key = (tabs[0], tabs[6])
+        if key not in self.key_index:
+            self.key_index[key] = len(self.key_index)
+        start, end = int(tabs[3]) - 1, int(tabs[4])
+        self.chrom_strand_end[key] = max(self.chrom_strand_end.get(key, 0), end)
+        self.keys.append(self.key_index[key])
+        self.starts.append(start)
+        self.ends.append(end)
+        self.genes.append(self.gene_index[gene_id])
+
+    def set_segments(self):
+        chrom_strand_end, key_index = self.chrom_strand_end, self.key_index
+        keys, starts, ends, genes = self.keys, self.starts, self.ends, self.genes
+        self.gene_index, self.chrom_strand_end, self.key_index = {}, {}, {}
+        self.keys, self.starts, self.ends, self.genes = [], [], [], []
+
+        offset = 0
+        key_offsets = np.zeros(len(key_index), dtype=np.int64)
+        key_ends = np.zeros(len(key_index), dtype=np.int64)
+        for key, index in key_index.items():
+            self.offsets[key] = offset
+            key_offsets[index] = offset
+            key_ends[index] = offset + chrom_strand_end[key]
+            # keep a gap between chrom-strand pairs. Blocks are clipped to key_ends, so they never span two pairs.
+            offset += chrom_strand_end[key] + 1
+        self.key_offsets, self.key_ends = key_offsets, key_ends
+        if not keys:
+            return
+
+        genes = np.array(genes, dtype=np.int64)
+        starts = key_offsets[keys] + np.array(starts, dtype=np.int64)
+        ends = key_offsets[keys] + np.array(ends, dtype=np.int64)
+
+        # merge overlapping features of the same gene
+        order = np.lexsort((starts, genes))
+        genes, starts, ends = genes[order], starts[order], ends[order]
+        total = offset + 1
+        running_end = np.maximum.accumulate(genes * total + ends)
+        is_new = np.ones(len(genes), dtype=bool)
+        is_new[1:] = genes[1:] * total + starts[1:] > running_end[:-1]
+        group = np.cumsum(is_new) - 1
+        merged_genes = genes[is_new]
+        merged_starts = starts[is_new]
+        merged_ends = np.zeros(len(merged_genes), dtype=np.int64)
+        np.maximum.at(merged_ends, group, ends)
+
+        self.boundaries = np.unique(np.concatenate([merged_starts, merged_ends]))
+        start_index = np.searchsorted(self.boundaries, merged_starts)
+        end_index = np.searchsorted(self.boundaries, merged_ends)
+        count_diff = np.zeros(len(self.boundaries) + 1, dtype=np.int64)
+        gene_diff = np.zeros(len(self.boundaries) + 1, dtype=np.int64)
+        np.add.at(count_diff, start_index, 1)
+        np.add.at(count_diff, end_index, -1)
+        np.add.at(gene_diff, start_index, merged_genes)
+        np.add.at(gene_diff, end_index, -merged_genes)
+        # one more segment after the last boundary, also used as the end sentinel of reduceat
+        self.seg_count = np.cumsum(count_diff)
+        seg_gene = np.cumsum(gene_diff)
+        self.seg_gene_min = np.where(self.seg_count == 1, seg_gene, len(self.gene_ids))
+        self.seg_gene_max = np.where(self.seg_count == 1, seg_gene, -1)
+
+    # arrays saved in the compiled annotation
+    ARRAY_NAMES = ('boundaries', 'seg_count', 'seg_gene_min', 'seg_gene_max', 'key_offsets', 'key_ends')
+
+    def to_arrays(self):
+        arrays = {name: getattr(self, name) for name in GtfIndex.ARRAY_NAMES}
+        # offsets are in the same order as key_offsets
+        arrays['key_chrom'] = np.array([key[0] for key in self.offsets], dtype=str)
+        arrays['key_strand'] = np.array([key[1] for key in self.offsets], dtype=str)
+        arrays['gene_ids'] = np.array(self.gene_ids, dtype=str)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, gtf_file, feature_type, arrays):
+        """
+        Load a GtfIndex from to_arrays() output without parsing gtf_file.
+        """
+        gtf_index = cls.__new__(cls)
+        gtf_index.gtf_file = gtf_file
+        gtf_index.feature_type = feature_type
+        for name in GtfIndex.ARRAY_NAMES:
+            setattr(gtf_index, name, arrays[name])
+        gtf_index.gene_ids = arrays['gene_ids'].tolist()
+        keys = zip(arrays['key_chrom'].tolist(), arrays['key_strand'].tolist())
+        gtf_index.offsets = dict(zip(keys, arrays['key_offsets'].tolist()))
+        return gtf_index
+
+    def get_offsets(self, chroms):
+        """
+        Returns:
+            array of shape (len(chroms), 2). Offsets of (chrom, '+') and (chrom, '-'). -1 if chrom has no feature.
+        """
+        return np.array([[self.offsets.get((chrom, strand), -1) for strand in STRANDS] for chrom in chroms],
+                        dtype=np.int64).reshape(-1, 2)
+
+    def classify(self, read_index, block_offsets, block_starts, block_ends, n_read):
+        """
+        Args:
+            read_index: read index of each aligned block
+            block_offsets: offset of (chrom, strand) of each block from get_offsets. -1 if no feature.
+            block_starts, block_ends: 0-based half open block coordinates
+            n_read: number of reads
+        Returns:
+            array of status index in CLASSIFIED_STATUS for each read
+        """
+        if not len(self.key_offsets):
+            return np.zeros(n_read, dtype=np.int64)
+        read_index = np.asarray(read_index, dtype=np.int64)
+        block_offsets = np.asarray(block_offsets, dtype=np.int64)
+        has_feature = block_offsets >= 0
+        key_ends = self.key_ends[np.maximum(np.searchsorted(self.key_offsets, block_offsets, side='right') - 1, 0)]
+        starts = np.minimum(np.asarray(block_starts, dtype=np.int64) + block_offsets, key_ends)
+        ends = np.minimum(np.asarray(block_ends, dtype=np.int64) + block_offsets, key_ends)
+        has_feature &= starts < ends
+        n_segment = len(self.boundaries) - 1
+        first = np.maximum(np.searchsorted(self.boundaries, starts, side='right') - 1, 0)
+        last = np.minimum(np.searchsorted(self.boundaries, ends, side='left') - 1, n_segment - 1)
+        has_feature &= first <= last
+        first, last = first[has_feature], last[has_feature]
+        read_index = read_index[has_feature]
+
+        max_count = np.zeros(n_read, dtype=np.int64)
+        gene_min = np.full(n_read, len(self.gene_ids), dtype=np.int64)
+        gene_max = np.full(n_read, -1, dtype=np.int64)
+        if len(first):
+            # reduce over segments [first, last] of each block
+            indices = np.column_stack([first, last + 1]).ravel()
+            block_count = np.maximum.reduceat(self.seg_count, indices)[::2]
+            block_gene_min = np.minimum.reduceat(self.seg_gene_min, indices)[::2]
+            block_gene_max = np.maximum.reduceat(self.seg_gene_max, indices)[::2]
+            np.maximum.at(max_count, read_index, block_count)
+            np.minimum.at(gene_min, read_index, block_gene_min)
+            np.maximum.at(gene_max, read_index, block_gene_max)
+
+        status = np.zeros(n_read, dtype=np.int64)
+        status[max_count > 0] = CLASSIFIED_STATUS.index(AMBIGUITY)
+        status[(max_count == 1) & (gene_min == gene_max)] = CLASSIFIED_STATUS.index(ASSIGNED)
+        return status
+
+
+class ReadClassifier:
+    """
+    Count featureCounts status of reads at the feature level of gtf_index, from reads of a featureCounts BAM of the
+    other level. Only reads with status in CLASSIFIED_STATUS are classified again; other status(e.g.
+    Unassigned_MultiMapping) do not depend on the feature level.
+
+    Args:
+        gtf_index: GtfIndex
+        references: reference names of the BAM header
+    """
+
+    def __init__(self, gtf_index, references, chunk_size=1000000):
+        self.gtf_index = gtf_index
+        self.ref_offsets = gtf_index.get_offsets(references)
+        self.chunk_size = chunk_size
+        self.counts = Counter()
+        self.n_read = 0
+        self.read_index = []
+        self.block_offsets = []
+        self.block_starts = []
+        self.block_ends = []
+
+    def add(self, read):
+        status = read.get_tag('XS') if read.has_tag('XS') else None
+        if status not in CLASSIFIED_STATUS:
+            self.counts[status] += 1
+            return
+        offset = self.ref_offsets[read.reference_id, int(read.is_reverse)]
+        for start, end in read.get_blocks():
+            self.read_index.append(self.n_read)
+            self.block_offsets.append(offset)
+            self.block_starts.append(start)
+            self.block_ends.append(end)
+        self.n_read += 1
+        if self.n_read >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.n_read:
+            status = self.gtf_index.classify(
+                self.read_index, self.block_offsets, self.block_starts, self.block_ends, self.n_read)
+            for status_index, count in enumerate(np.bincount(status, minlength=len(CLASSIFIED_STATUS))):
+                self.counts[CLASSIFIED_STATUS[status_index]] += int(count)
+        self.n_read = 0
+        self.read_index, self.block_offsets, self.block_starts, self.block_ends = [], [], [], []
+
+    def get_counts(self):
+        """
+        Returns:
+            Counter {status: read count}
+        """
+        self.flush()
+        return self.counts
+
+    def pop_counts(self):
+        """
+        Return counts and reset them. Used by worker processes that classify one region at a time.
+        """
+        counts = self.get_counts()
+        self.counts = Counter()
+        return counts
+
+    def add_counts(self, counts):
+        """
+        Merge counts of a worker process.
+        """
+        self.counts.update(counts)
+
+
+class Annotation:
+    """
+    Compiled annotation of a GTF file.
+
+    Attributes:
+        gene_id, gene_name, gene_biotype: gene lines in GTF order, as parsed by reference.GtfParser.
+    """
+
+    def __init__(self, gtf_file, arrays):
+        self.gtf_file = gtf_file
+        self.arrays = arrays
+
+    @staticmethod
+    @utils.add_log
+    def build_arrays(gtf_file):
+        """
+        Parse gtf_file once for the gene lists of reference.GtfParser, the id->name map of utils.Gtf_dict and the
+        GtfIndex of INTERVAL_TYPES.
+        """
+        gp = GtfParser(gtf_file)
+        gtf_dict = utils.Gtf_dict(gtf_file, id_name={})
+        gene_name_count = Counter()
+        interval_index = {feature_type: GtfIndex(gtf_file, feature_type, parse=False) for feature_type in INTERVAL_TYPES}
+        for row, is_comment, annotation, properties in gp.gtf_reader_iter():
+            if is_comment:
+                continue
+            if annotation == 'gene':
+                gp.add_gene(properties)
+                gtf_dict.add_gene(row[8], gene_name_count)
+            if annotation in interval_index:
+                interval_index[annotation].add_feature(row)
+
+        arrays = {
+            'gene_id': np.array(gp.gene_id, dtype=str),
+            'gene_name': np.array(gp.gene_name, dtype=str),
+            'gene_biotype': np.array(gp.gene_biotype, dtype=str),
+            'gtf_dict_id': np.array(list(gtf_dict.keys()), dtype=str),
+            'gtf_dict_name': np.array(list(gtf_dict.values()), dtype=str),
+        }
+        for feature_type, gtf_index in interval_index.items():
+            gtf_index.set_segments()
+            for name, array in gtf_index.to_arrays().items():
+                arrays[f'{feature_type}.{name}'] = array
+        return arrays
+
+    @property
+    def gene_id(self):
+        return self.arrays['gene_id'].tolist()
+
+    @property
+    def gene_name(self):
+        return self.arrays['gene_name'].tolist()
+
+    @property
+    def gene_biotype(self):
+        return self.arrays['gene_biotype'].tolist()
+
+    def get_features(self):
+        """
+        Returns:
+            Features object, the same as reference.GtfParser.get_features
+        """
+        return Features(self.gene_id, self.gene_name)
+
+    def get_gtf_dict(self):
+        """
+        Returns:
+            utils.Gtf_dict
+        """
+        id_name = dict(zip(self.arrays['gtf_dict_id'].tolist(), self.arrays['gtf_dict_name'].tolist()))
+        return utils.Gtf_dict(self.gtf_file, id_name=id_name)
+
+    def get_interval_index(self, feature_type):
+        """
+        Returns:
+            GtfIndex of feature_type(exon or gene)
+        """
+        prefix = f'{feature_type}.'
+        arrays = {name[len(prefix):]: array for name, array in self.arrays.items() if name.startswith(prefix)}
+        return GtfIndex.from_arrays(self.gtf_file, feature_type, arrays)
+
+
+def get_file_meta(path):
+    """
+    Returns:
+        size, mtime and digest of path.
+    """
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'digest': get_digest(path)}
+
+
+def is_same_file(path, meta):
+    """
+    The digest is only computed when size or mtime changed.
+    """
+    stat = os.stat(path)
+    if stat.st_size == meta['size'] and stat.st_mtime_ns == meta['mtime_ns']:
+        return True
+    return get_digest(path) == meta['digest']
+
+
+def read_annotation(index_dir, gtf_file):
+    """
+    Returns:
+        Annotation with memory mapped arrays. None if index_dir does not exist, is incomplete or is out of date.
+    """
+    try:
+        with open(f'{index_dir}/{ANNOTATION_META}') as fh:
+            meta = json.load(fh)
+        if meta['version'] != ANNOTATION_VERSION:
+            return None
+        if not is_same_file(gtf_file, meta['gtf']):
+            return None
+        arrays = {name: np.load(f'{index_dir}/{name}.npy', mmap_mode='r') for name in meta['arrays']}
+    except (OSError, ValueError, KeyError):
+        return None
+    return Annotation(gtf_file, arrays)
+
+
+@utils.add_log
+def write_annotation(index_dir, annotation):
+    """
+    Write to a temp dir first, so that an interrupted build never leaves a partial index.
+    The caller holds the exclusive lock of index_dir, so no reader is loading the replaced index.
+    """
+    temp_dir = f'{index_dir}.{os.getpid()}.temp'
+    try:
+        utils.check_mkdir(temp_dir)
+        for name, array in annotation.arrays.items():
+            np.save(f'{temp_dir}/{name}.npy', array)
+        meta = {
+            'version': ANNOTATION_VERSION,
+            'gtf': get_file_meta(annotation.gtf_file),
+            'arrays': sorted(annotation.arrays),
+        }
+        with open(f'{temp_dir}/{ANNOTATION_META}', 'w') as fh:
+            json.dump(meta, fh, indent=1)
+        # arrays memory mapped by finished readers stay valid after their files are removed
+        if os.path.exists(index_dir):
+            shutil.rmtree(index_dir)
+        os.rename(temp_dir, index_dir)
+    except OSError as error:
+        # e.g. genomeDir is not writable
+        write_annotation.logger.warning(f'Can not write compiled annotation to {index_dir}: {error}')
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def lock_index(lock, operation):
+    """
+    fcntl.flock the lock file of an index dir. Nothing to do if the lock file can not be opened.
+    """
+    if lock is not None:
+        fcntl.flock(lock, operation)
+
+
+@utils.add_log
+def get_annotation(gtf_file, index_dir):
+    """
+    Load the compiled annotation from index_dir. Build and save it if it does not exist or is out of date.
+    """
+    lock_file = f'{index_dir}.lock'
+    try:
+        lock = open(lock_file, 'a')
+    except OSError as error:
+        # e.g. genomeDir is not writable, so the index can not be replaced by others either
+        get_annotation.logger.warning(f'Can not open {lock_file}: {error}')
+        lock = None
+    try:
+        lock_index(lock, fcntl.LOCK_SH)
+        annotation = read_annotation(index_dir, gtf_file)
+        if annotation is not None:
+            return annotation
+        # the shared lock is released before the exclusive lock is taken. Check again in case another sample built
+        # the index in between.
+        lock_index(lock, fcntl.LOCK_EX)
+        annotation = read_annotation(index_dir, gtf_file)
+        if annotation is not None:
+            return annotation
+        get_annotation.logger.info(f'Building compiled annotation of {gtf_file} in {index_dir}')
+        annotation = Annotation(gtf_file, Annotation.build_arrays(gtf_file))
+        write_annotation(index_dir, annotation)
+        return annotation
+    finally:
+        if lock is not None:
+            lock.close()
+
+
+def load_annotation(genomeDir):
+    """
+    Returns:
+        Annotation of the GTF in genomeDir. Stored in `{genomeDir}/celescope_gtf_index`.
+    """
+    genome = Mkref.parse_genomeDir(genomeDir, files=('gtf',))
+    return get_annotation(genome['gtf'], f'{genomeDir}/{GTF_INDEX_DIR}')
+
+
+def load_gtf_annotation(gtf_file):
+    """
+    Returns:
+        Annotation of a GTF file outside a genomeDir. Stored next to it in `{gtf_file}.celescope_gtf_index`.
+    """
+    return get_annotation(gtf_file, f'{gtf_file}.{GTF_INDEX_DIR}')
+
+
+class Test_gtf_index(unittest.TestCase):
+    def test_classify(self):
+        import random
+        import tempfile
+
+        random.seed(0)
+        features = []
+        for gene in range(200):
+            chrom = random.choice(['chr1', 'chr2'])
+            strand = random.choice(STRANDS)
+            start = random.randint(1, 100000)
+            for _ in range(random.randint(1, 4)):
+                exon_start = start + random.randint(0, 3000)
+                features.append((chrom, exon_start, exon_start + random.randint(0, 500), strand, f'G{gene}'))
+
+        reads = []
+        for _ in range(3000):
+            chrom = random.choice(['chr1', 'chr2', 'chr3'])
+            strand = random.choice(STRANDS)
+            start = random.randint(0, 105000)
+            blocks = [(start, start + random.randint(1, 100))]
+            if random.random() < 0.3:
+                intron_end = blocks[0][1] + random.randint(1, 2000)
+                blocks.append((intron_end, intron_end + random.randint(1, 100)))
+            reads.append((chrom, strand, blocks))
+
+        def brute_force(chrom, strand, blocks):
+            genes = set()
+            for f_chrom, f_start, f_end, f_strand, gene in features:
+                if f_chrom == chrom and f_strand == strand:
+                    if any(start < f_end and end > f_start - 1 for start, end in blocks):
+                        genes.add(gene)
+            return min(len(genes), 2)
+
+        with tempfile.NamedTemporaryFile('w', suffix='.gtf') as gtf:
+            for chrom, start, end, strand, gene in features:
+                gtf.write(f'{chrom}\tt\texon\t{start}\t{end}\t.\t{strand}\t.\tgene_id "{gene}";\n')
+            gtf.write('chr1\tt\tgene\t1\t10\t.\t+\t.\tgene_id "G0";\n')
+            gtf.flush()
+            gtf_index = GtfIndex(gtf.name, 'exon')
+
+        chrom_offsets = gtf_index.get_offsets(['chr1', 'chr2', 'chr3'])
+        read_index, block_offsets, block_starts, block_ends = [], [], [], []
+        for i, (chrom, strand, blocks) in enumerate(reads):
+            for start, end in blocks:
+                read_index.append(i)
+                block_offsets.append(chrom_offsets[int(chrom[-1]) - 1, STRANDS.index(strand)])
+                block_starts.append(start)
+                block_ends.append(end)
+        status = gtf_index.classify(read_index, block_offsets, block_starts, block_ends, len(reads))
+        expected = [brute_force(*read) for read in reads]
+        # status index: 0 NoFeatures, 1 Assigned, 2 Ambiguity
+        self.assertEqual(list(status), expected)
+        self.assertEqual(set(expected), {0, 1, 2})
+
+        # compiled annotation classifies the same way
+        with tempfile.TemporaryDirectory() as temp_dir:
+            gtf_file = f'{temp_dir}/genes.gtf'
+            with open(gtf_file, 'w') as gtf:
+                for chrom, start, end, strand, gene in features:
+                    gtf.write(f'{chrom}\tt\texon\t{start}\t{end}\t.\t{strand}\t.\tgene_id "{gene}";\n')
+            get_annotation(gtf_file, f'{temp_dir}/{GTF_INDEX_DIR}')
+            # loaded from the saved index
+            gtf_index = get_annotation(gtf_file, f'{temp_dir}/{GTF_INDEX_DIR}').get_interval_index('exon')
+            self.assertIsInstance(gtf_index.boundaries, np.memmap)
+            status = gtf_index.classify(read_index, block_offsets, block_starts, block_ends, len(reads))
+            self.assertEqual(list(status), expected)
+
+    def test_annotation(self):
+        import tempfile
+
+        lines = [
+            'c1\tt\tgene\t1\t100\t.\t+\t.\tgene_id "G1"; gene_name "MT-A"; gene_biotype "protein_coding";',
+            'c1\tt\texon\t1\t50\t.\t+\t.\tgene_id "G1"; gene_name "MT-A";',
+            'c1\tt\tgene\t1\t100\t.\t-\t.\tgene_id "G2"; gene_name "A"; gene_type "lncRNA";',
+            'c1\tt\tgene\t200\t300\t.\t-\t.\tgene_id "G3"; gene_name "A";',
+        ]
+        with tempfile.TemporaryDirectory() as temp_dir:
+            gtf_file = f'{temp_dir}/genes.gtf'
+            index_dir = f'{temp_dir}/{GTF_INDEX_DIR}'
+            with open(gtf_file, 'w') as fh:
+                fh.write('\n'.join(lines[:3]) + '\n')
+            annotation = get_annotation(gtf_file, index_dir)
+            self.assertEqual(annotation.gene_id, ['G1', 'G2'])
+            self.assertEqual(annotation.gene_biotype, ['protein_coding', 'lncRNA'])
+            self.assertIsInstance(read_annotation(index_dir, gtf_file).arrays['gene_id'], np.memmap)
+
+            # changed GTF content
+            with open(gtf_file, 'w') as fh:
+                fh.write('\n'.join(lines) + '\n')
+            self.assertIsNone(read_annotation(index_dir, gtf_file))
+            annotation = get_annotation(gtf_file, index_dir)
+            self.assertEqual(annotation.gene_name, ['MT-A', 'A', 'A'])
+            # Gtf_dict renames duplicated gene names
+            self.assertEqual(dict(annotation.get_gtf_dict()), dict(utils.Gtf_dict(gtf_file)))
+            # same content, new mtime
+            os.utime(gtf_file, ns=(0, 0))
+            self.assertIsNotNone(read_annotation(index_dir, gtf_file))
+
+            # incomplete index
+            with open(f'{index_dir}/{ANNOTATION_META}', 'w') as fh:
+                fh.write('{"version"')
+            self.assertIsNone(read_annotation(index_dir, gtf_file))
+
+    def test_concurrent_build(self):
+        import tempfile
+        from multiprocessing.pool import ThreadPool
+        from unittest import mock
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            gtf_file = f'{temp_dir}/genes.gtf'
+            index_dir = f'{temp_dir}/{GTF_INDEX_DIR}'
+            with open(gtf_file, 'w') as fh:
+                for gene in range(100):
+                    fh.write(f'c1\tt\tgene\t{gene * 10 + 1}\t{gene * 10 + 5}\t.\t+\t.\tgene_id "G{gene}";\n')
+            build_arrays = Annotation.build_arrays
+            with mock.patch.object(Annotation, 'build_arrays', side_effect=build_arrays) as mock_build:
+                with ThreadPool(8) as pool:
+                    annotations = pool.map(lambda _: get_annotation(gtf_file, index_dir), range(8))
+            self.assertEqual(mock_build.call_count, 1)
+            for annotation in annotations:
+                self.assertEqual(annotation.gene_id, [f'G{gene}' for gene in range(100)])
+            self.assertEqual(sorted(os.listdir(temp_dir)), [GTF_INDEX_DIR, f'{GTF_INDEX_DIR}.lock', 'genes.gtf'])
+
+
+if __name__ == '__main__':
+    unittest.main()
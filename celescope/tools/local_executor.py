@@ -0,0 +1,178 @@
+"""
+Run the commands of multi_* on the local machine under a total thread and memory budget.
+
+Jobs form a DAG. A job starts when all its dependencies succeeded and its thread(x) and memory(m) hints fit into the
+remaining budget. Among ready jobs, the group(sample) with the fewest running threads goes first, so that all samples
+make progress. If a job fails, its downstream jobs are skipped and the other jobs keep running.
+"""
+
+import os
+import queue
+import subprocess
+import threading
+import time
+import unittest
+
+from celescope.tools import utils
+
+PENDING = 'pending'
+RUNNING = 'running'
+SUCCESS = 'success'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+def get_total_mem_gb():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 3
+
+
+class Job:
+    def __init__(self, name, cmd, m, x, deps, group, index):
+        self.name = name
+        self.cmd = cmd
+        self.m = m
+        self.x = x
+        self.deps = deps
+        self.group = group
+        # submission order
+        self.index = index
+        self.status = PENDING
+        self.returncode = None
+        self.seconds = None
+
+
+class LocalExecutor:
+    """
+    Args:
+        thread: total threads of running jobs
+        mem: total memory(GB) of running jobs
+        logdir: stdout and stderr of job `name` are written to `{logdir}/{name}.log`
+    """
+
+    def __init__(self, thread=None, mem=None, logdir='./log'):
+        self.thread = int(thread) if thread else os.cpu_count()
+        self.mem = float(mem) if mem else get_total_mem_gb()
+        self.logdir = logdir
+        self.jobs = {}
+        self.used_thread = 0
+        self.used_mem = 0
+        # max (used_thread, used_mem) during run
+        self.peak = (0, 0)
+
+    def add_job(self, name, cmd, m=1, x=1, deps=(), group=''):
+        """
+        Resource hints larger than the budget are reduced to the budget, so that the job can run alone.
+        """
+        if name in self.jobs:
+            raise ValueError(f'Duplicate job name: {name}')
+        for dep in deps:
+            if dep not in self.jobs:
+                raise ValueError(f'Job {name} depends on unknown job {dep}')
+        self.jobs[name] = Job(
+            name, cmd, m=min(float(m), self.mem), x=min(int(x), self.thread),
+            deps=list(deps), group=group, index=len(self.jobs),
+        )
+
+    def get_ready_jobs(self):
+        """
+        Returns:
+            pending jobs whose dependencies succeeded, fewest running threads of the group first.
+        """
+        group_thread = {}
+        for job in self.jobs.values():
+            if job.status == RUNNING:
+                group_thread[job.group] = group_thread.get(job.group, 0) + job.x
+        ready = [
+            job for job in self.jobs.values()
+            if job.status == PENDING and all(self.jobs[dep].status == SUCCESS for dep in job.deps)
+        ]
+        return sorted(ready, key=lambda job: (group_thread.get(job.group, 0), job.index))
+
+    def skip_downstream(self, name):
+        for job in self.jobs.values():
+            if job.status == PENDING and name in job.deps:
+                job.status = SKIPPED
+                self.run.logger.warning(f'{job.name} skipped because {name} did not succeed')
+                self.skip_downstream(job.name)
+
+    def fits(self, job):
+        return self.used_thread + job.x <= self.thread and self.used_mem + job.m <= self.mem
+
+    def start(self, job, done_queue):
+        job.status = RUNNING
+        self.used_thread += job.x
+        self.used_mem += job.m
+        self.peak = (max(self.peak[0], self.used_thread), max(self.peak[1], self.used_mem))
+        self.run.logger.info(f'start {job.name}: thread {job.x}, mem {job.m}G')
+
+        def target():
+            start_time = time.time()
+            with open(f'{self.logdir}/{job.name}.log', 'w') as log:
+                returncode = subprocess.call(job.cmd, shell=True, stdout=log, stderr=subprocess.STDOUT)
+            done_queue.put((job, returncode, time.time() - start_time))
+
+        threading.Thread(target=target, daemon=True).start()
+
+    @utils.add_log
+    def run(self):
+        """
+        Returns:
+            {job name: status}
+        """
+        utils.check_mkdir(self.logdir)
+        done_queue = queue.Queue()
+        n_running = 0
+        while True:
+            for job in self.get_ready_jobs():
+                # a job that needs the whole budget still runs when nothing else is running
+                if self.fits(job) or n_running == 0:
+                    self.start(job, done_queue)
+                    n_running += 1
+            if n_running == 0:
+                break
+            job, returncode, seconds = done_queue.get()
+            n_running -= 1
+            self.used_thread -= job.x
+            self.used_mem -= job.m
+            job.returncode = returncode
+            job.seconds = seconds
+            if returncode == 0:
+                job.status = SUCCESS
+                self.run.logger.info(f'{job.name} done. time used: {seconds:.1f}s')
+            else:
+                job.status = FAILED
+                self.run.logger.error(
+                    f'{job.name} failed with return code {returncode}. See {self.logdir}/{job.name}.log')
+                self.skip_downstream(job.name)
+
+        return {name: job.status for name, job in self.jobs.items()}
+
+
+class Test_local_executor(unittest.TestCase):
+    def test_run(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            executor = LocalExecutor(thread=2, mem=10, logdir=temp_dir)
+            for sample in ('s1', 's2', 's3'):
+                executor.add_job(f'a_{sample}', f'sleep 0.2; echo {sample} > {temp_dir}/{sample}', x=1, m=4,
+                                 group=sample)
+                cmd = f'cat {temp_dir}/{sample}' if sample != 's2' else 'exit 1'
+                executor.add_job(f'b_{sample}', cmd, x=1, m=1, deps=[f'a_{sample}'], group=sample)
+                executor.add_job(f'c_{sample}', 'true', x=4, m=1, deps=[f'b_{sample}'], group=sample)
+            executor.add_job('merge', 'true', deps=['c_s1', 'c_s2', 'c_s3'])
+            status = executor.run()
+
+            self.assertEqual(status['c_s1'], SUCCESS)
+            self.assertEqual(status['c_s3'], SUCCESS)
+            self.assertEqual(status['b_s2'], FAILED)
+            self.assertEqual(status['c_s2'], SKIPPED)
+            self.assertEqual(status['merge'], SKIPPED)
+            # m=4: at most 2 jobs of step a run at the same time; x=4 is reduced to 2
+            self.assertEqual(executor.peak, (2, 8))
+            with open(f'{temp_dir}/b_s1.log') as fh:
+                self.assertEqual(fh.read(), 's1\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,21 @@
+import importlib.util
+import os
+import tempfile
+import unittest
+
+import numpy as np
 import scipy.io
 import scipy.sparse
 import pandas as pd
+from xopen import xopen
 
-from celescope.tools.__init__ import (BARCODE_FILE_NAME, FEATURE_FILE_NAME, MATRIX_FILE_NAME)
+from celescope.tools.__init__ import (BARCODE_FILE_NAME, FEATURE_FILE_NAME, MATRIX_FILE_NAME, FEATURE_FILE_NAME_V3,
+    H5_SUFFIX)
 from celescope.tools import utils
 
+# 10X HDF5 feature type
+GENE_EXPRESSION = 'Gene Expression'
+
   
 class Features:
     def __init__(self, gene_id: list, gene_name=None, gene_type=None):
@@ -56,7 +67,16 @@ class CountMatrix:
     @classmethod
     @utils.add_log
     def from_matrix_dir(cls, matrix_dir):
+        """
+        Args:
+            matrix_dir: Matrix Market directory, or 10X HDF5 file ends with `.h5`.
+        """
+        if matrix_dir.endswith(H5_SUFFIX) and os.path.isfile(matrix_dir):
+            return cls.from_h5(matrix_dir)
+
         features_tsv = utils.get_matrix_file_path(matrix_dir, FEATURE_FILE_NAME)
+        if not features_tsv:
+            features_tsv = utils.get_matrix_file_path(matrix_dir, FEATURE_FILE_NAME_V3)
         features = Features.from_tsv(tsv_file=features_tsv)
         barcode_file = utils.get_matrix_file_path(matrix_dir, BARCODE_FILE_NAME)
         barcodes, _ = utils.read_one_col(barcode_file)
@@ -65,13 +85,118 @@ class CountMatrix:
 
         return cls(features, barcodes, matrix)
 
-    def to_matrix_dir(self, matrix_dir):
+    def to_matrix_dir(self, matrix_dir, gzip=False):
+        """
+        Args:
+            gzip: If True, write gzipped files in the 10X v3 layout(`matrix.mtx.gz`, `features.tsv.gz`, `barcodes.tsv.gz`).
+        """
         utils.check_mkdir(dir_name=matrix_dir)
+        if gzip:
+            self.to_matrix_dir_gz(matrix_dir)
+            return
         self.__features.to_tsv(f'{matrix_dir}/{FEATURE_FILE_NAME}')
         pd.Series(self.__barcodes).to_csv(f'{matrix_dir}/{BARCODE_FILE_NAME}', index=False, sep='\t', header=False)
         matrix_path = f'{matrix_dir}/{MATRIX_FILE_NAME}'
         scipy.io.mmwrite(matrix_path, self.__matrix)
 
+    def get_gene_type(self):
+        features = self.__features
+        if features.gene_type:
+            return features.gene_type
+        return [GENE_EXPRESSION] * len(features.gene_id)
+
+    def to_matrix_dir_gz(self, matrix_dir):
+        """
+        Write gzipped Matrix Market directory. xopen uses a threaded gzip writer if pigz or isal is available.
+        """
+        features = self.__features
+        df_features = pd.DataFrame({
+            'gene_id': features.gene_id,
+            'gene_name': features.gene_name,
+            'gene_type': self.get_gene_type(),
+        })
+        with xopen(f'{matrix_dir}/{FEATURE_FILE_NAME_V3}.gz', 'w') as fh:
+            df_features.to_csv(fh, sep='\t', index=False, header=False)
+        with xopen(f'{matrix_dir}/{BARCODE_FILE_NAME}.gz', 'w') as fh:
+            pd.Series(self.__barcodes, dtype=object).to_csv(fh, index=False, sep='\t', header=False)
+
+        with xopen(f'{matrix_dir}/{MATRIX_FILE_NAME}.gz', 'wb') as fh:
+            scipy.io.mmwrite(fh, self.__matrix)
+
+    @classmethod
+    @utils.add_log
+    def from_h5(cls, h5_file):
+        import h5py
+
+        def decode(dataset):
+            return [x.decode() for x in dataset[:]]
+
+        with h5py.File(h5_file, 'r') as f:
+            group = f['matrix']
+            features_group = group['features']
+            features = Features(
+                decode(features_group['id']),
+                decode(features_group['name']),
+                decode(features_group['feature_type']),
+            )
+            barcodes = decode(group['barcodes'])
+            shape = tuple(group['shape'][:])
+            matrix = scipy.sparse.csc_matrix(
+                (group['data'][:], group['indices'][:], group['indptr'][:]), shape=shape)
+
+        return cls(features, barcodes, matrix.tocoo())
+
+    def to_h5(self, h5_file):
+        """
+        Write 10X HDF5 feature-barcode matrix, which can be read by `scanpy.read_10x_h5`.
+        """
+        import h5py
+
+        features = self.__features
+        mtx = self.__matrix.tocsc()
+        mtx.sort_indices()
+        with h5py.File(h5_file, 'w') as f:
+            group = f.create_group('matrix')
+            group.create_dataset('barcodes', data=np.array(self.__barcodes, dtype='S'), compression='gzip')
+            group.create_dataset('data', data=mtx.data.astype(np.int32), compression='gzip')
+            group.create_dataset('indices', data=mtx.indices.astype(np.int64), compression='gzip')
+            group.create_dataset('indptr', data=mtx.indptr.astype(np.int64), compression='gzip')
+            group.create_dataset('shape', data=np.array(mtx.shape, dtype=np.int32))
+
+            features_group = group.create_group('features')
+            features_group.create_dataset('_all_tag_keys', data=np.array(['genome'], dtype='S'))
+            feature_cols = {
+                'id': features.gene_id,
+                'name': features.gene_name,
+                'feature_type': self.get_gene_type(),
+                'genome': [''] * len(features.gene_id),
+            }
+            for key, values in feature_cols.items():
+                features_group.create_dataset(key, data=np.array(values, dtype='S'), compression='gzip')
+
+    @classmethod
+    def from_arrays(cls, features: Features, barcodes: list, gene_index, barcode_index, value=None):
+        """
+        Build from integer-coded arrays without grouping in pandas.
+        Args:
+            gene_index: np.array. Index of each record in features.gene_id.
+            barcode_index: np.array. Index of each record in barcodes.
+            value: np.array. Summed for the same (gene, barcode). If None, count records.
+        Returns:
+            CountMatrix with entries sorted by (gene_index, barcode_index)
+        """
+        n_gene, n_barcode = len(features.gene_id), len(barcodes)
+        key = np.asarray(gene_index, dtype=np.int64) * n_barcode + np.asarray(barcode_index, dtype=np.int64)
+        if value is None:
+            unique_key, data = np.unique(key, return_counts=True)
+        else:
+            value = np.asarray(value)
+            unique_key, inverse = np.unique(key, return_inverse=True)
+            data = np.bincount(inverse, weights=value, minlength=len(unique_key)).astype(value.dtype)
+        row, col = np.divmod(unique_key, max(n_barcode, 1))
+        mtx = scipy.sparse.coo_matrix((data, (row, col)), shape=(n_gene, n_barcode))
+        return cls(features, barcodes, mtx)
+
     @classmethod
     def from_dataframe(cls, df, features: Features, barcodes=None, row='geneID', column='Barcode', value="UMI"):
         """
@@ -82,27 +207,19 @@ class CountMatrix:
             features: Features
             type: type of features, e.g. [gene, protein]
         """
-
-        df = df.groupby([row, column]).agg({value: 'count'})
+        df = df.loc[df[value].notna(), [row, column]]
         if not barcodes:
-            barcodes = df.index.levels[1].tolist()
-        
-        feature_index_dict = {}
-        for index, gene_id in enumerate(features.gene_id):
-            feature_index_dict[gene_id] = index
-
-        barcode_index_dict = {}
-        for index, barcode in enumerate(barcodes):
-            barcode_index_dict[barcode] = index
+            barcodes = sorted(df[column].unique())
 
         # use all barcodes
-        barcode_codes = [barcode_index_dict[barcode] for barcode in df.index.get_level_values(level=1)]
+        barcode_codes = pd.Index(barcodes).get_indexer(df[column])
         # use all gene_id from features even if it is not in df
-        gene_id_codes = [feature_index_dict[gene_id] for gene_id in df.index.get_level_values(level=0)]
-        mtx = scipy.sparse.coo_matrix((df[value], (gene_id_codes, barcode_codes)), 
-            shape=(len(features.gene_id), len(barcodes)))
+        gene_id_codes = pd.Index(features.gene_id).get_indexer(df[row])
+        for codes, col in ((barcode_codes, column), (gene_id_codes, row)):
+            if (codes == -1).any():
+                raise KeyError(df[col].iloc[np.flatnonzero(codes == -1)[0]])
 
-        return cls(features, barcodes, mtx)
+        return cls.from_arrays(features, barcodes, gene_id_codes, barcode_codes)
 
     def __str__(self):
         n_row, n_col = self.shape[0], self.shape[1]
@@ -151,3 +268,43 @@ class CountMatrix:
     def get_matrix(self):
         return self.__matrix
 
+
+
+class Test_matrix(unittest.TestCase):
+    def setUp(self):
+        self.features = Features(['g1', 'g2', 'g3'], ['n1', 'n2', 'n3'])
+        self.df = pd.DataFrame({
+            'geneID': ['g2', 'g1', 'g2', 'g3', 'g2'],
+            'Barcode': ['b2', 'b1', 'b2', 'b1', 'b1'],
+            'UMI': ['u1', 'u2', 'u3', 'u4', 'u5'],
+        })
+        self.dense = [[1, 0], [1, 2], [1, 0]]
+
+    def test_from_dataframe(self):
+        count_matrix = CountMatrix.from_dataframe(self.df, self.features)
+        self.assertEqual(count_matrix.get_barcodes(), ['b1', 'b2'])
+        self.assertEqual(count_matrix.get_matrix().toarray().tolist(), self.dense)
+
+    def test_matrix_dir_gz(self):
+        count_matrix = CountMatrix.from_dataframe(self.df, self.features)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            count_matrix.to_matrix_dir(temp_dir, gzip=True)
+            read_matrix = CountMatrix.from_matrix_dir(temp_dir)
+        self.assertEqual(read_matrix.get_barcodes(), ['b1', 'b2'])
+        self.assertEqual(read_matrix.get_features().gene_name, ['n1', 'n2', 'n3'])
+        self.assertEqual(read_matrix.get_matrix().toarray().tolist(), self.dense)
+
+    @unittest.skipUnless(importlib.util.find_spec('h5py'), 'h5py is not installed')
+    def test_h5(self):
+        count_matrix = CountMatrix.from_dataframe(self.df, self.features)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            h5_file = f'{temp_dir}/matrix{H5_SUFFIX}'
+            count_matrix.to_h5(h5_file)
+            read_matrix = CountMatrix.from_matrix_dir(h5_file)
+        self.assertEqual(read_matrix.get_barcodes(), ['b1', 'b2'])
+        self.assertEqual(read_matrix.get_features().gene_id, ['g1', 'g2', 'g3'])
+        self.assertEqual(read_matrix.get_matrix().toarray().tolist(), self.dense)
+
+
+if __name__ == '__main__':
+    unittest.main()
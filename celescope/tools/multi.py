@@ -2,15 +2,20 @@ import argparse
 import glob
 import itertools
 import os
+import shlex
+import sys
 from collections import defaultdict
 
 import celescope
 from celescope.tools.__init__ import FILTERED_MATRIX_DIR_SUFFIX
 from celescope.tools import utils
+from celescope.tools.local_executor import LocalExecutor, SUCCESS
 from celescope.celescope import ArgFormatter
 from celescope.__init__ import HELP_DICT
 
 TOOLS_DIR = os.path.dirname(celescope.tools.__file__)
+# consecutive steps that `--stream` runs as one job
+STREAM_STEPS = ['barcode', 'cutadapt', 'star']
 
 
 class Multi():
@@ -49,6 +54,11 @@ class Multi():
         self.sjm_cmd = ''
         self.sjm_order = ''
         self.shell_dict = defaultdict(str)
+        self.executor = None
+        # sample: [(cmd, m, x)] of STREAM_STEPS
+        self.stream_cmds = defaultdict(list)
+        # sample: name of the last local job
+        self.last_job = {}
 
         self.outdir_dic = {}
 
@@ -100,9 +110,15 @@ fastq_prefix2_1.fq.gz	fastq_prefix2_2.fq.gz
 ```
 ''',
             required=True)
-        parser.add_argument('--mod', help='Which type of script to generate, `sjm` or `shell`.',
-            choices=['sjm', 'shell'], default='sjm')
+        parser.add_argument('--mod', help='''Which type of script to generate, `sjm` or `shell`.
+`local` runs all steps of all samples on this machine. Steps of different samples run at the same time 
+if their thread and memory fit into `--local_thread` and `--local_mem`.''',
+            choices=['sjm', 'shell', 'local'], default='sjm')
         parser.add_argument('--queue', help='Only works if the `--mod` selects `sjm`.')
+        parser.add_argument('--local_thread', type=int,
+            help='Only works if the `--mod` selects `local`. Total threads of running steps. Default: number of CPUs.')
+        parser.add_argument('--local_mem', type=float,
+            help='Only works if the `--mod` selects `local`. Total memory(GB) of running steps. Default: physical memory.')
         parser.add_argument('--rm_files', action='store_true',
             help='Remove redundant fastq and bam files after running.')
         parser.add_argument('--steps_run', 
@@ -115,6 +131,10 @@ use `--steps_run barcode,cutadapt`
         parser.add_argument('--outdir', help='Output directory.', default="./")
         parser.add_argument('--thread', help=HELP_DICT['thread'], default=4)
         parser.add_argument('--debug', help=HELP_DICT['debug'], action='store_true')
+        parser.add_argument('--resume', help=HELP_DICT['resume'], action='store_true')
+        parser.add_argument('--stream', action='store_true',
+            help='''Run `barcode`, `cutadapt` and `star` of a sample at the same time as one job. Reads are passed 
+through named pipes instead of intermediate fastq files. Metrics and reports are the same. Can not be used with `--gzip`.''')
         self.parser = parser
         return parser
 
@@ -180,7 +200,17 @@ use `--steps_run barcode,cutadapt`
             self.fq_suffix = ".gz"
         if self.args.steps_run != 'all':
             self.steps_run = self.args.steps_run.strip().split(',')
+        if self.args.stream:
+            if self.args.gzip:
+                sys.exit('`--stream` can not be used with `--gzip`.')
+            if not is_consecutive(STREAM_STEPS, self.steps_run):
+                sys.exit(f'`--stream` needs consecutive steps {",".join(STREAM_STEPS)} in steps to run.')
         
+        if self.args.mod == 'local':
+            self.logdir = self.args.outdir + '/log'
+            self.executor = LocalExecutor(
+                thread=self.args.local_thread, mem=self.args.local_mem, logdir=self.logdir)
+
         if self.args.mod == 'sjm':
 
             self.sjm_dir = f'{self.args.outdir}/sjm/'
@@ -203,6 +233,8 @@ use `--steps_run barcode,cutadapt`
                 index += 1
 
     def generate_cmd(self, cmd, step, sample, m=1, x=1):
+        if self.executor:
+            self.add_local_job(cmd, step, sample, m=m, x=x)
         if sample:
             sample = "_" + sample
         sched_options = f'sched_options -w n -cwd -V -l vf={m}g,p={x}'
@@ -216,7 +248,47 @@ job_begin
 job_end
 '''
 
+    def add_local_job(self, cmd, step, sample, m=1, x=1):
+        """
+        A step of a sample depends on the previous step of the sample.
+        A job without sample(merge_report) depends on the last step of all samples.
+        """
+        if sample:
+            name = f'{step}_{sample}'
+            deps = [self.last_job[sample]] if sample in self.last_job else []
+            self.last_job[sample] = name
+        else:
+            name = step
+            deps = list(self.last_job.values())
+        self.executor.add_job(name, cmd, m=m, x=x, deps=deps, group=sample)
+
+    def get_stream_cmd(self, sample):
+        """
+        Returns:
+            command to run STREAM_STEPS of sample through named pipes, total memory and total thread.
+        """
+        fifos = [
+            f'{self.outdir_dic[sample]["barcode"]}/{sample}_2.fq',
+            f'{self.outdir_dic[sample]["cutadapt"]}/{sample}_clean_2.fq',
+        ]
+        app = TOOLS_DIR + '/stream_steps.py'
+        cmd = f'python {app} '
+        for fifo in fifos:
+            cmd += f'--fifo {fifo} '
+        for step_cmd, _m, _x in self.stream_cmds[sample]:
+            # a skipped step would leave the other steps waiting on a named pipe
+            step_cmd = step_cmd.replace(' --resume ', ' ')
+            cmd += f'--cmd {shlex.quote(step_cmd)} '
+        m = sum(int(m) for _cmd, m, _x in self.stream_cmds[sample])
+        x = sum(int(x) for _cmd, _m, x in self.stream_cmds[sample])
+        return cmd, m, x
+
     def process_cmd(self, cmd, step, sample, m=1, x=1):
+        if self.args.stream and step in STREAM_STEPS:
+            self.stream_cmds[sample].append((cmd, m, x))
+            if step != STREAM_STEPS[-1]:
+                return
+            cmd, m, x = self.get_stream_cmd(sample)
         self.generate_cmd(cmd, step, sample, m=m, x=x)
         self.shell_dict[sample] += cmd + '\n'
         if self.last_step:
@@ -246,6 +318,8 @@ job_end
         cmd_line = step_prefix
         if self.args.debug:
             cmd_line += " --debug "
+        if self.args.resume:
+            cmd_line += " --resume "
         for arg in args_dict:
             if args_dict[arg] is False:
                 continue
@@ -280,7 +354,7 @@ job_end
             f'{cmd_line} '
             f'--fq1 {arr[0]} --fq2 {arr[1]} '
         )
-        self.process_cmd(cmd, step, sample, m=5, x=1)
+        self.process_cmd(cmd, step, sample, m=5, x=self.args.thread)
 
     def cutadapt(self, sample):
         step = "cutadapt"
@@ -322,7 +396,7 @@ job_end
             f'--force_cell_num {self.col4_dict[sample]} '
         )
 
-        self.process_cmd(cmd, step, sample, m=10, x=1)
+        self.process_cmd(cmd, step, sample, m=10, x=self.args.thread)
 
     def analysis(self, sample):
         step = 'analysis'
@@ -376,6 +450,12 @@ job_end
             self.sjm_order += f'order {step} after {self.last_step}_{sample}\n'
 
     def end(self):
+        if self.args.mod == 'local':
+            self.merge_report()
+            status = self.executor.run()
+            failed = [name for name in status if status[name] != SUCCESS]
+            if failed:
+                sys.exit(f'Jobs not finished: {",".join(failed)}. Logs are in {self.logdir}')
         if self.args.mod == 'sjm':
             self.merge_report()
             with open(self.sjm_file, 'w') as fh:
@@ -393,6 +473,17 @@ job_end
         self.end()
 
 
+def is_consecutive(sub_list, full_list):
+    """
+    >>> is_consecutive(['barcode', 'cutadapt'], ['sample', 'barcode', 'cutadapt', 'star'])
+    True
+    >>> is_consecutive(['barcode', 'star'], ['sample', 'barcode', 'cutadapt', 'star'])
+    False
+    """
+    n = len(sub_list)
+    return any(full_list[i:i + n] == sub_list for i in range(len(full_list) - n + 1))
+
+
 def get_read(library_id, library_path, read='1'):
     read1_list = [f'_{read}', f'R{read}', f'R{read}_001']
     fq_list = ['fq', 'fastq']
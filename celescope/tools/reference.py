@@ -16,6 +16,8 @@ class GtfParser:
         self.gtf_fn = gtf_fn
         self.gene_id = []
         self.gene_name = []
+        # gene_biotype or gene_type. Empty if neither exists.
+        self.gene_biotype = []
         self.id_name = {}
 
     def get_properties_dict(self, properties_str):
@@ -83,29 +85,37 @@ class GtfParser:
         """
         for _row, _is_comment, annotation, properties in self.gtf_reader_iter():
             if annotation == 'gene':
-                gene_id = properties['gene_id']
-                if 'gene_name' not in properties:
-                    gene_name = gene_id
-                else:
-                    gene_name = properties['gene_name']
-
-                if gene_id in self.id_name:
-                    assert self.id_name[gene_id] == gene_name, (
-                        'one gene_id with multiple gene_name '
-                        f'gene_id: {gene_id}, '
-                        f'gene_name this line: {gene_name}'
-                        f'gene_name previous line: {self.id_name[gene_id]}'
-                    )
-                    self.get_id_name.logger.warning(
-                        'duplicated (gene_id, gene_name)'
-                        f'gene_id: {gene_id}, '
-                        f'gene_name {gene_name}'
-                    )
-                else:
-                    self.gene_id.append(gene_id)
-                    self.gene_name.append(gene_name)
-                    self.id_name[gene_id] = gene_name
-                    
+                self.add_gene(properties)
+
+    def add_gene(self, properties):
+        """
+        Args:
+            properties: properties dict of a gene line from gtf_reader_iter
+        """
+        gene_id = properties['gene_id']
+        if 'gene_name' not in properties:
+            gene_name = gene_id
+        else:
+            gene_name = properties['gene_name']
+
+        if gene_id in self.id_name:
+            assert self.id_name[gene_id] == gene_name, (
+                'one gene_id with multiple gene_name '
+                f'gene_id: {gene_id}, '
+                f'gene_name this line: {gene_name}'
+                f'gene_name previous line: {self.id_name[gene_id]}'
+            )
+            self.get_id_name.logger.warning(
+                'duplicated (gene_id, gene_name)'
+                f'gene_id: {gene_id}, '
+                f'gene_name {gene_name}'
+            )
+        else:
+            self.gene_id.append(gene_id)
+            self.gene_name.append(gene_name)
+            self.gene_biotype.append(properties.get('gene_biotype', properties.get('gene_type', '')))
+            self.id_name[gene_id] = gene_name
+
     def get_features(self):
         """
         Returns:
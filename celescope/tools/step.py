@@ -1,4 +1,5 @@
 import abc
+import fcntl
 import sys
 import io
 import json
@@ -28,6 +29,7 @@ def s_common(parser):
     parser.add_argument('--sample', help='Sample name.', required=True)
     parser.add_argument('--thread', help=HELP_DICT['thread'], default=4)
     parser.add_argument('--debug', help=HELP_DICT['debug'], action='store_true')
+    parser.add_argument('--resume', help=HELP_DICT['resume'], action='store_true')
     return parser
 
 
@@ -141,11 +143,21 @@ class Step:
 
     def _dump_content(self):
         '''dump content to json file
+        Steps of a sample may run at the same time(`multi_* --stream`). Only the summary of this step is updated,
+        and the json file is locked while it is read and written.
         '''
         for slot, path in self._path_dict.items():
             if self.__content_dict[slot]:
-                with open(path, 'w') as f:
-                    json.dump(self.__content_dict[slot], f, indent=4)
+                with open(path, 'a+') as f:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    f.seek(0)
+                    text = f.read()
+                    content = json.loads(text) if text else {}
+                    content[self._step_summary_name] = self.__content_dict[slot][self._step_summary_name]
+                    self.__content_dict[slot] = content
+                    f.seek(0)
+                    f.truncate()
+                    json.dump(content, f, indent=4)
 
     @utils.add_log
     def _render_html(self):
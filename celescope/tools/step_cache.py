@@ -0,0 +1,295 @@
+"""
+Skip steps whose inputs, arguments and outputs have not changed since the last successful run.
+
+After a step succeeds, `{outdir}/.step_cache.json` records:
+- celescope version, assay and step
+- arguments, except those that do not change results(thread, debug, resume)
+- fingerprints of input files and directories found in the arguments
+- fingerprints of all output files in outdir
+- the step summary in `{outdir}/../.metrics.json`
+
+File fingerprints are content digests. A digest is only recomputed when the size or mtime of the file changed, so a
+rewritten file with the same content (e.g. an upstream step that was rerun) still matches. Inputs produced by an
+upstream step reuse the digests recorded in the upstream `.step_cache.json`. If any input of a step changes, the step
+reruns, and so do the downstream steps whose inputs it rewrites with different content.
+"""
+
+import hashlib
+import json
+import os
+import unittest
+
+from celescope.__init__ import __VERSION__
+from celescope.tools import utils
+
+CACHE_FILE = '.step_cache.json'
+IGNORED_ARGS = {'func', 'thread', 'debug', 'resume'}
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def get_digest(path):
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(HASH_BLOCK_SIZE), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def read_cache(outdir):
+    """
+    Returns:
+        cache record dict. None if outdir has no record.
+    """
+    cache_file = f'{outdir}/{CACHE_FILE}'
+    if not os.path.exists(cache_file):
+        return None
+    with open(cache_file) as fh:
+        return json.load(fh)
+
+
+class Fingerprinter:
+    """
+    Compute file fingerprints, reusing digests of known (path, size, mtime_ns).
+    """
+
+    def __init__(self):
+        self.known = {}
+        self.read_dirs = set()
+
+    def add_known(self, fingerprints, base_dir=''):
+        for path, fingerprint in fingerprints.items():
+            if 'digest' in fingerprint:
+                self.known[os.path.abspath(os.path.join(base_dir, path))] = fingerprint
+
+    def add_upstream(self, path):
+        """
+        Reuse the output digests of the step that wrote path.
+        """
+        dirname = os.path.dirname(os.path.abspath(path))
+        if dirname in self.read_dirs:
+            return
+        self.read_dirs.add(dirname)
+        record = read_cache(dirname)
+        if record:
+            self.add_known(record['outputs'], dirname)
+
+    def file_fingerprint(self, path):
+        stat = os.stat(path)
+        fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        known = self.known.get(os.path.abspath(path))
+        if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+            fingerprint['digest'] = known['digest']
+        else:
+            fingerprint['digest'] = get_digest(path)
+        return fingerprint
+
+    def dir_fingerprint(self, path):
+        """
+        Directories(e.g. match_dir, genomeDir) can be large, so only names, sizes and mtimes of files are used.
+        """
+        hasher = hashlib.blake2b(digest_size=16)
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for file_name in sorted(files):
+                file_path = os.path.join(root, file_name)
+                if not os.path.isfile(file_path):
+                    continue
+                stat = os.stat(file_path)
+                hasher.update(f'{os.path.relpath(file_path, path)}\t{stat.st_size}\t{stat.st_mtime_ns}\n'.encode())
+        return {'dir_digest': hasher.hexdigest()}
+
+    def fingerprint(self, path):
+        if os.path.isdir(path):
+            return self.dir_fingerprint(path)
+        self.add_upstream(path)
+        return self.file_fingerprint(path)
+
+
+def same_content(fingerprint1, fingerprint2):
+    return all(fingerprint1.get(key) == fingerprint2.get(key) for key in ('digest', 'dir_digest'))
+
+
+def get_cached_args(args):
+    return {
+        key: value for key, value in sorted(vars(args).items())
+        if key not in IGNORED_ARGS and isinstance(value, (str, int, float, bool, list, type(None)))
+    }
+
+
+def get_input_paths(args):
+    """
+    Returns:
+        existing paths in argument values, except outdir. Comma separated values are split.
+
+    >>> import argparse
+    >>> get_input_paths(argparse.Namespace(outdir='.', fq1='/,/not_exist', thread=4))
+    ['/']
+    """
+    paths = set()
+    for key, value in vars(args).items():
+        if key == 'outdir' or not isinstance(value, str):
+            continue
+        for item in value.split(','):
+            if item and os.path.exists(item):
+                paths.add(item)
+    return sorted(paths)
+
+
+def get_output_paths(outdir):
+    paths = []
+    for root, dirs, files in os.walk(outdir):
+        dirs.sort()
+        for file_name in sorted(files):
+            if file_name == CACHE_FILE and root == outdir:
+                continue
+            paths.append(os.path.relpath(os.path.join(root, file_name), outdir))
+    return paths
+
+
+def get_step_summary(outdir, step):
+    metrics_file = f'{outdir}/../.metrics.json'
+    if not os.path.exists(metrics_file):
+        return None
+    with open(metrics_file) as fh:
+        return json.load(fh).get(f'{step}_summary')
+
+
+class StepCache:
+    """
+    Args:
+        args: parsed step arguments. args.outdir is the step output directory.
+    """
+
+    def __init__(self, args, assay, step):
+        self.args = args
+        self.assay = assay
+        self.step = step
+        self.outdir = args.outdir
+        self.fingerprinter = Fingerprinter()
+
+    def get_record(self):
+        return {
+            'version': __VERSION__,
+            'assay': self.assay,
+            'step': self.step,
+            'args': get_cached_args(self.args),
+            'inputs': {path: self.fingerprinter.fingerprint(path) for path in get_input_paths(self.args)},
+            'outputs': {
+                path: self.fingerprinter.file_fingerprint(f'{self.outdir}/{path}')
+                for path in get_output_paths(self.outdir)
+            },
+            'summary': get_step_summary(self.outdir, self.step),
+        }
+
+    @utils.add_log
+    def is_up_to_date(self):
+        """
+        Returns:
+            True if the last run of the step has the same version, arguments, inputs and outputs.
+        """
+        record = read_cache(self.outdir)
+        if record is None:
+            return False
+        self.fingerprinter.add_known(record['inputs'])
+        self.fingerprinter.add_known(record['outputs'], self.outdir)
+        current = {'version': __VERSION__, 'assay': self.assay, 'step': self.step}
+        for key, value in current.items():
+            if record[key] != value:
+                self.is_up_to_date.logger.info(f'{key} changed')
+                return False
+        # json round trip to compare tuples and lists in the same way
+        if record['args'] != json.loads(json.dumps(get_cached_args(self.args))):
+            self.is_up_to_date.logger.info('arguments changed')
+            return False
+        if sorted(record['inputs']) != get_input_paths(self.args):
+            self.is_up_to_date.logger.info('input files changed')
+            return False
+        for path, fingerprint in record['inputs'].items():
+            if not same_content(self.fingerprinter.fingerprint(path), fingerprint):
+                self.is_up_to_date.logger.info(f'{path} changed')
+                return False
+        for path, fingerprint in record['outputs'].items():
+            output_path = f'{self.outdir}/{path}'
+            if not os.path.isfile(output_path):
+                self.is_up_to_date.logger.info(f'{output_path} missing')
+                return False
+            if not same_content(self.fingerprinter.file_fingerprint(output_path), fingerprint):
+                self.is_up_to_date.logger.info(f'{output_path} changed')
+                return False
+        if record['summary'] is not None and get_step_summary(self.outdir, self.step) != record['summary']:
+            self.is_up_to_date.logger.info('step summary changed')
+            return False
+        return True
+
+    def write(self):
+        record = self.get_record()
+        with open(f'{self.outdir}/{CACHE_FILE}', 'w') as fh:
+            json.dump(record, fh, indent=1)
+
+    def clear(self):
+        cache_file = f'{self.outdir}/{CACHE_FILE}'
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+
+    @utils.add_log
+    def run(self, func):
+        """
+        Run func(args) unless the step is up to date. Record the step after func succeeds.
+        """
+        if self.is_up_to_date():
+            self.run.logger.info(f'{self.assay} {self.step} in {self.outdir} is up to date. Skipped.')
+            return
+        self.clear()
+        func(self.args)
+        self.write()
+
+
+class Test_step_cache(unittest.TestCase):
+    def test_run(self):
+        import argparse
+        import tempfile
+
+        calls = []
+
+        def step_func(args):
+            calls.append(args.outdir)
+            with open(args.fq) as reader, open(f'{args.outdir}/out.txt', 'w') as writer:
+                writer.write(reader.read().upper())
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            fq = f'{temp_dir}/in.txt'
+            with open(fq, 'w') as fh:
+                fh.write('acgt')
+            os.makedirs(f'{temp_dir}/01.step1')
+            os.makedirs(f'{temp_dir}/02.step2')
+            args1 = argparse.Namespace(outdir=f'{temp_dir}/01.step1', fq=fq, thread=1, resume=True)
+            args2 = argparse.Namespace(outdir=f'{temp_dir}/02.step2', fq=f'{temp_dir}/01.step1/out.txt', thread=1)
+
+            def run_all(thread=1):
+                args1.thread = thread
+                StepCache(args1, 'assay', 'step1').run(step_func)
+                StepCache(args2, 'assay', 'step2').run(step_func)
+
+            run_all()
+            self.assertEqual(len(calls), 2)
+            # thread does not matter
+            run_all(thread=4)
+            self.assertEqual(len(calls), 2)
+            # same content with a new mtime
+            os.utime(fq, ns=(0, 0))
+            run_all()
+            self.assertEqual(len(calls), 2)
+            os.remove(f'{temp_dir}/01.step1/out.txt')
+            run_all()
+            self.assertEqual(calls[2:], [args1.outdir])
+            # changed input reruns downstream steps
+            with open(fq, 'w') as fh:
+                fh.write('aaaa')
+            run_all()
+            self.assertEqual(calls[3:], [args1.outdir, args2.outdir])
+            with open(f'{temp_dir}/02.step2/out.txt') as fh:
+                self.assertEqual(fh.read(), 'AAAA')
+
+
+if __name__ == '__main__':
+    unittest.main()
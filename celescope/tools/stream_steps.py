@@ -0,0 +1,99 @@
+"""
+Run consecutive steps of a sample at the same time. Reads are passed between steps through named pipes(FIFO) instead
+of intermediate fastq files. Used by `multi_* --stream`.
+
+If any step fails, the other steps are terminated, because a step blocked on a FIFO would otherwise wait forever.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+from celescope.tools import utils
+
+POLL_SECONDS = 0.5
+
+
+def make_fifos(fifos):
+    for fifo in fifos:
+        os.makedirs(os.path.dirname(os.path.abspath(fifo)), exist_ok=True)
+        if os.path.lexists(fifo):
+            os.remove(fifo)
+        os.mkfifo(fifo)
+
+
+def remove_fifos(fifos):
+    for fifo in fifos:
+        if os.path.lexists(fifo):
+            os.remove(fifo)
+
+
+@utils.add_log
+def run_streamed(cmds, fifos):
+    """
+    Args:
+        cmds: shell commands. They are started at the same time.
+        fifos: named pipes to create before the commands start and remove after they finish.
+    Returns:
+        0 if all commands succeeded, else the return code of the first failed command.
+    """
+    make_fifos(fifos)
+    procs = []
+    try:
+        for cmd in cmds:
+            run_streamed.logger.info(cmd)
+            procs.append(subprocess.Popen(cmd, shell=True))
+        while True:
+            returncodes = [proc.poll() for proc in procs]
+            failed = [(cmd, returncode) for cmd, returncode in zip(cmds, returncodes) if returncode]
+            if failed:
+                cmd, returncode = failed[0]
+                run_streamed.logger.error(f'return code {returncode}: {cmd}')
+                return returncode
+            if all(returncode == 0 for returncode in returncodes):
+                return 0
+            time.sleep(POLL_SECONDS)
+    finally:
+        for proc in procs:
+            if proc.poll() is None:
+                proc.terminate()
+                proc.wait()
+        remove_fifos(fifos)
+
+
+def main():
+    parser = argparse.ArgumentParser('run steps through named pipes')
+    parser.add_argument('--cmd', help='Step command. Can be used multiple times.', action='append', required=True)
+    parser.add_argument('--fifo', help='Named pipe between steps. Can be used multiple times.', action='append',
+                        default=[])
+    args = parser.parse_args()
+
+    sys.exit(run_streamed(args.cmd, args.fifo))
+
+
+class Test_stream_steps(unittest.TestCase):
+    def test_run_streamed(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            fifo1, fifo2, out = f'{temp_dir}/a/1.fq', f'{temp_dir}/b/2.fq', f'{temp_dir}/out.txt'
+            cmds = [
+                f'seq 1 100000 > {fifo1}',
+                f'grep 7 {fifo1} > {fifo2}',
+                f'wc -l < {fifo2} > {out}',
+            ]
+            self.assertEqual(run_streamed(cmds, [fifo1, fifo2]), 0)
+            with open(out) as fh:
+                self.assertEqual(int(fh.read()), 40951)
+            self.assertFalse(os.path.exists(fifo1))
+
+            # the reader of fifo1 would block forever
+            cmds[0] = 'exit 3'
+            self.assertEqual(run_streamed(cmds, [fifo1, fifo2]), 3)
+
+
+if __name__ == '__main__':
+    main()
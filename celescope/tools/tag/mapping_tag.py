@@ -3,6 +3,7 @@ import pysam
 
 from celescope.tools import utils
 from celescope.tools.barcode import Barcode
+from celescope.tools.barcode_index import BarcodeIndex
 from celescope.tools.step import Step, s_common
 
 # n_mismatch = 1 if n_tag_barcode > N_TAG_BARCODE_THRESHOLD else 2
@@ -127,7 +128,7 @@ class Mapping_tag(Step):
 
 
         # mismatch
-        self.mismatch_dict = self.get_tag_barcode_mismatch_dict()
+        self.barcode_index = self.get_tag_barcode_index()
 
         # variables
         self.total_reads = 0
@@ -135,6 +136,7 @@ class Mapping_tag(Step):
         self.reads_unmapped_invalid_linker = 0
         self.reads_unmapped_invalid_barcode = 0
         self.reads_mapped = 0
+        self.reads_ambiguous_barcode = 0
         self.res_dic = utils.genDict()
         self.res_sum_dic = utils.genDict(dim=2)
         self.match_barcode = []
@@ -145,27 +147,31 @@ class Mapping_tag(Step):
         self.invalid_barcode_file = f'{self.outdir}/{self.sample}_invalid_barcode.tsv'
 
     @utils.add_log
-    def get_tag_barcode_mismatch_dict(self):
-        mismatch_dict = {}
+    def get_tag_barcode_index(self):
+        """
+        Returns:
+            BarcodeIndex. Value is the tag name.
+        """
         n_mismatch = 1 if len(self.barcode_dict) > N_TAG_BARCODE_THRESHOLD else 2
-        for seq_id, seq in self.barcode_dict.items():
-            for mismatch_seq in Barcode.findall_mismatch(seq, n_mismatch=n_mismatch):
-                mismatch_dict[mismatch_seq] = seq_id   
-        
-        return mismatch_dict
+        seq_ids = list(self.barcode_dict.keys())
+        seqs = [self.barcode_dict[seq_id] for seq_id in seq_ids]
+        return BarcodeIndex(seqs, n_mismatch=n_mismatch, value_list=seq_ids)
 
 
     def check_barcode_with_mismatch(self, barcode, seq_barcode, umi):
         """
+        Assign the read to the nearest tag barcode.
         Args:
             barcode: cell barcode
             seq_barcode: tag barcode sequence
             umi: UMI sequence
         """
-        if seq_barcode in self.mismatch_dict:
-            seq_id = self.mismatch_dict[seq_barcode]
+        seq_id, _n_mismatch, bool_ambiguous = self.barcode_index.query(seq_barcode)
+        if seq_id is not None:
             self.res_dic[barcode][seq_id][umi] += 1
             self.reads_mapped += 1
+            if bool_ambiguous:
+                self.reads_ambiguous_barcode += 1
         else:
             self.reads_unmapped_invalid_barcode += 1
             self.invalid_barcode_dict[seq_barcode] += 1
@@ -262,6 +268,12 @@ class Mapping_tag(Step):
             total=self.total_reads,
             help_info="Unmapped R2 reads because of too many mismatches in tag-barcode sequence"
         )
+        self.add_metric(
+            name='Reads Mapped Ambiguous Barcode',
+            value=self.reads_ambiguous_barcode,
+            total=self.total_reads,
+            show=False,
+        )
 
     @utils.add_log
     def run(self):
@@ -2,14 +2,38 @@
 import numpy as np
 import pysam
 import sys
-import subprocess
 
 from celescope.tools import utils
+from celescope.tools.bam_count import ReadParser, count_reads
 from celescope.tools.step import Step, s_common
 from celescope.__init__ import HELP_DICT
 from celescope.snp.__init__ import PANEL
 
 
+class TagReadParser(ReadParser):
+    """
+    Barcode, UMI and gene name are read from tags CB, UB and GN(compatible with 10X bam).
+    Reads of target genes are written to the filtered bam.
+    """
+
+    def __init__(self, gene_list, add_RG=False):
+        self.gene_set = set(gene_list)
+        self.add_RG = add_RG
+
+    def parse(self, read):
+        try:
+            return read.get_tag('CB'), read.get_tag('GN'), read.get_tag('UB')
+        except KeyError:
+            return None
+
+    def write(self, read, feature):
+        if feature not in self.gene_set:
+            return False
+        if self.add_RG:
+            read.set_tag(tag='RG', value=read.get_tag('CB'), value_type='Z')
+        return True
+
+
 class Target_metrics(Step):
     """
     ## Features
@@ -39,7 +63,7 @@ class Target_metrics(Step):
         if not self.gene_list:
             sys.exit("You must provide either --panel or --gene_list!")
 
-        self.count_dict = utils.genDict(dim=3, valType=int)
+        self.counts = None
 
         self.add_metric(
             name="Number of Target Genes",
@@ -56,57 +80,41 @@ class Target_metrics(Step):
 
     @utils.add_log
     def read_bam_write_filtered(self):
-        sam_temp = f'{self.out_bam_file}.temp'
         with pysam.AlignmentFile(self.args.bam, "rb") as reader:
             header = reader.header.to_dict()
-            # add RG to header
-            if self.args.add_RG:
-                header['RG'] = []
-                for barcode in self.match_barcode_list:
-                    header['RG'].append({
-                        'ID': barcode,
-                        'SM': barcode,
-                    })
-            with pysam.AlignmentFile(sam_temp, "w", header=header) as writer:
-                for record in reader:
-                    try:
-                        gene_name = record.get_tag('GN')
-                    except KeyError:
-                        continue
-                    # compatible with 10X bam
-                    try:
-                        barcode = record.get_tag('CB')
-                        UMI = record.get_tag('UB')
-                    except KeyError:
-                        continue
-                    if barcode in self.match_barcode and gene_name in self.gene_list:
-                        if self.args.add_RG:
-                            record.set_tag(tag='RG', value=record.get_tag('CB'), value_type='Z')
-                        writer.write(record)
-                    self.count_dict[barcode][gene_name][UMI] += 1
-
-            cmd = f'samtools view -b {sam_temp} -o {self.out_bam_file}; rm {sam_temp}'
-            subprocess.check_call(cmd, shell=True)
+        # add RG to header
+        if self.args.add_RG:
+            header['RG'] = []
+            for barcode in self.match_barcode_list:
+                header['RG'].append({
+                    'ID': barcode,
+                    'SM': barcode,
+                })
+        self.counts = count_reads(
+            self.args.bam,
+            self.match_barcode_list,
+            parser=TagReadParser(self.gene_list, self.args.add_RG),
+            thread=self.thread,
+            out_bam=self.out_bam_file,
+            header=header,
+        )
 
     @utils.add_log
     def parse_count_dict_add_metrics(self):
-        total_reads = 0
-        enriched_reads = 0
-        enriched_reads_in_cells = 0
-        enriched_reads_per_cell_list = []
-
-        for barcode in self.count_dict:
-            cell_enriched_read = 0
-            for gene_name in self.count_dict[barcode]:
-                gene_read = sum(self.count_dict[barcode][gene_name].values())
-                total_reads += gene_read
-                if gene_name in self.gene_list:
-                    enriched_reads += gene_read
-                    if barcode in self.match_barcode:
-                        enriched_reads_in_cells += gene_read
-                        cell_enriched_read += gene_read
-            if barcode in self.match_barcode:
-                enriched_reads_per_cell_list.append(cell_enriched_read)
+        counts = self.counts
+        gene_set = set(self.gene_list)
+        is_target = np.array([feature in gene_set for feature in counts.features], dtype=bool)
+        total_reads = int(counts.feature_read.sum())
+        enriched_reads = int(counts.feature_read[is_target].sum())
+
+        row_is_target = is_target[counts.feature_index]
+        enriched_reads_in_cells = int(counts.read_count[row_is_target].sum())
+        cell_enriched_read = np.bincount(
+            counts.barcode_index[row_is_target],
+            weights=counts.read_count[row_is_target],
+            minlength=len(counts.barcodes),
+        ).astype(int)
+        enriched_reads_per_cell_list = cell_enriched_read[np.unique(counts.barcode_index)].tolist()
 
         self.parse_count_dict_add_metrics.logger.debug(
             f'enriched_reads_per_cell_list: '
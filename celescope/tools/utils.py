@@ -13,6 +13,7 @@ import sys
 from collections import Counter, defaultdict
 from datetime import timedelta
 from functools import wraps
+from multiprocessing import Pool
 
 from Bio.Seq import Seq
 import pandas as pd
@@ -20,6 +21,7 @@ import pysam
 
 from celescope.tools.__init__ import FILTERED_MATRIX_DIR_SUFFIX, BARCODE_FILE_NAME 
 from celescope.__init__ import ROOT_PATH
+from celescope.tools.cli_registry import get_assay_text, get_step_module_name
 
 
 def add_log(func):
@@ -101,10 +103,21 @@ class Gtf_dict(dict):
         work correctly under this condition, but the gene_id will not appear in the Gtf_dict.
     '''
 
-    def __init__(self, gtf_file):
+    GENE_ID_PATTERN = re.compile(r'gene_id "(\S+)";')
+    GENE_NAME_PATTERN = re.compile(r'gene_name "(\S+)"')
+
+    def __init__(self, gtf_file, id_name=None):
+        """
+        Args:
+            id_name: {gene_id: gene_name} from a compiled annotation(see celescope.tools.gtf_index). If not None, the
+                gtf file is not parsed.
+        """
         super().__init__()
         self.gtf_file = gtf_file
-        self.load_gtf()
+        if id_name is None:
+            self.load_gtf()
+        else:
+            self.update(id_name)
 
 
     @add_log
@@ -120,10 +133,7 @@ class Gtf_dict(dict):
             {gene_id: gene_name} dict
         """
 
-        gene_id_pattern = re.compile(r'gene_id "(\S+)";')
-        gene_name_pattern = re.compile(r'gene_name "(\S+)"')
-        id_name = {}
-        c = Counter()
+        gene_name_count = Counter()
         with generic_open(self.gtf_file, mode='rt') as f:
             for line in f:
                 if not line.strip():
@@ -133,31 +143,38 @@ class Gtf_dict(dict):
                 tabs = line.split('\t')
                 gtf_type, attributes = tabs[2], tabs[-1]
                 if gtf_type == 'gene':
-                    gene_id = gene_id_pattern.findall(attributes)[-1]
-                    gene_names = gene_name_pattern.findall(attributes)
-                    if not gene_names:
-                        gene_name = gene_id
-                    else:
-                        gene_name = gene_names[-1]
-                    c[gene_name] += 1
-                    if c[gene_name] > 1:
-                        if gene_id in id_name:
-                            assert id_name[gene_id] == gene_name, (
-                                'one gene_id with multiple gene_name '
-                                f'gene_id: {gene_id}, '
-                                f'gene_name this line: {gene_name}'
-                                f'gene_name previous line: {id_name[gene_id]}'
-                            )
-                            self.load_gtf.logger.warning(
-                                'duplicated (gene_id, gene_name)'
-                                f'gene_id: {gene_id}, '
-                                f'gene_name {gene_name}'
-                            )
-                            c[gene_name] -= 1
-                        else:
-                            gene_name = f'{gene_name}_{c[gene_name]}'
-                    id_name[gene_id] = gene_name
-        self.update(id_name)
+                    self.add_gene(attributes, gene_name_count)
+
+    def add_gene(self, attributes, gene_name_count):
+        """
+        Args:
+            attributes: the last column of a gene line
+            gene_name_count: Counter of gene names added so far
+        """
+        gene_id = Gtf_dict.GENE_ID_PATTERN.findall(attributes)[-1]
+        gene_names = Gtf_dict.GENE_NAME_PATTERN.findall(attributes)
+        if not gene_names:
+            gene_name = gene_id
+        else:
+            gene_name = gene_names[-1]
+        gene_name_count[gene_name] += 1
+        if gene_name_count[gene_name] > 1:
+            if gene_id in self:
+                assert self[gene_id] == gene_name, (
+                    'one gene_id with multiple gene_name '
+                    f'gene_id: {gene_id}, '
+                    f'gene_name this line: {gene_name}'
+                    f'gene_name previous line: {self[gene_id]}'
+                )
+                self.load_gtf.logger.warning(
+                    'duplicated (gene_id, gene_name)'
+                    f'gene_id: {gene_id}, '
+                    f'gene_name {gene_name}'
+                )
+                gene_name_count[gene_name] -= 1
+            else:
+                gene_name = f'{gene_name}_{gene_name_count[gene_name]}'
+        self[gene_id] = gene_name
 
     def __getitem__(self, key):
         '''if key not exist, return key'''
@@ -377,22 +394,7 @@ def find_assay_init(assay):
 
 
 def find_step_module(assay, step):
-    file_path_dict = {
-        'assay': f'{ROOT_PATH}/{assay}/{step}.py',
-        'tools': f'{ROOT_PATH}/tools/{step}.py',
-    }
-
-    init_module = find_assay_init(assay)
-    if os.path.exists(file_path_dict['assay']):
-        step_module = importlib.import_module(f"celescope.{assay}.{step}")
-    elif hasattr(init_module, 'IMPORT_DICT') and step in init_module.IMPORT_DICT:
-        module_path = init_module.IMPORT_DICT[step]
-        step_module = importlib.import_module(f"{module_path}.{step}")
-    elif os.path.exists(file_path_dict['tools']):
-        step_module = importlib.import_module(f"celescope.tools.{step}")
-    else:
-        raise ModuleNotFoundError(f"No module found for {assay}.{step}")
-
+    step_module = importlib.import_module(get_step_module_name(assay, step))
     return step_module
 
 
@@ -437,6 +439,31 @@ def check_mkdir(dir_name):
         os.system(f"mkdir -p {dir_name}")
 
 
+def get_contig_groups(bam, threads, index_file=None):
+    """
+    Returns:
+        list of contig groups in header order. Each group has about 1/(4 * threads) of all reads, so that the
+        groups keep the worker processes busy. '*' is the group of unmapped reads without coordinate.
+    """
+    with pysam.AlignmentFile(bam, "rb", index_filename=index_file) as samfile:
+        stats = [(stat.contig, stat.total) for stat in samfile.get_index_statistics() if stat.total > 0]
+        nocoordinate = samfile.nocoordinate
+    total = sum(n for _, n in stats)
+    group_size = max(total // (threads * 4), 1)
+    groups, group, group_n = [], [], 0
+    for contig, n in stats:
+        group.append(contig)
+        group_n += n
+        if group_n >= group_size:
+            groups.append(group)
+            group, group_n = [], 0
+    if group:
+        groups.append(group)
+    if nocoordinate:
+        groups.append(['*'])
+    return groups
+
+
 class Samtools():
     def __init__(self, in_bam, out_bam, threads=1, debug=False):
         self.in_bam = in_bam
@@ -468,12 +495,15 @@ class Samtools():
         self.samtools_index(self.out_bam)
 
     @add_log
-    def add_tag(self, gtf_file):
+    def add_tag(self, gtf_file, classifier=None):
         """
         - CB cell barcode
         - UB UMI
         - GN gene name
         - GX gene id
+
+        Args:
+            classifier: if not None, classifier.add(read) is called for every read in the same pass.
         """
         gtf_dict = Gtf_dict(gtf_file)
 
@@ -481,25 +511,98 @@ class Samtools():
             header = original_bam.header
             with pysam.AlignmentFile(self.temp_sam_file, "w", header=header) as temp_sam:
                 for read in original_bam:
-                    attr = read.query_name.split('_')
-                    barcode = attr[0]
-                    umi = attr[1]
-                    read.set_tag(tag='CB', value=barcode, value_type='Z')
-                    read.set_tag(tag='UB', value=umi, value_type='Z')
-                    # assign to some gene
-                    if read.has_tag('XT'):
-                        gene_id = read.get_tag('XT')
-                        # if multi-mapping reads are included in original bam,
-                        # there are multiple gene_ids
-                        if ',' in gene_id:
-                            gene_name = [gtf_dict[i] for i in gene_id.split(',')]
-                            gene_name = ','.join(gene_name)
-                        else:
-                            gene_name = gtf_dict[gene_id]
-                        read.set_tag(tag='GN', value=gene_name, value_type='Z')
-                        read.set_tag(tag='GX', value=gene_id, value_type='Z')
+                    Samtools.tag_read(read, gtf_dict)
+                    if classifier is not None:
+                        classifier.add(read)
                     temp_sam.write(read)
 
+    @staticmethod
+    def tag_read(read, gtf_dict):
+        attr = read.query_name.split('_')
+        barcode = attr[0]
+        umi = attr[1]
+        read.set_tag(tag='CB', value=barcode, value_type='Z')
+        read.set_tag(tag='UB', value=umi, value_type='Z')
+        # assign to some gene
+        if read.has_tag('XT'):
+            gene_id = read.get_tag('XT')
+            # if multi-mapping reads are included in original bam,
+            # there are multiple gene_ids
+            if ',' in gene_id:
+                gene_name = [gtf_dict[i] for i in gene_id.split(',')]
+                gene_name = ','.join(gene_name)
+            else:
+                gene_name = gtf_dict[gene_id]
+            read.set_tag(tag='GN', value=gene_name, value_type='Z')
+            read.set_tag(tag='GX', value=gene_id, value_type='Z')
+
+    @add_log
+    def add_tag_sorted(self, gtf_file, name_sorted_bam=None, classifier=None, gtf_dict=None):
+        """
+        Add the same tags as add_tag. out_bam is written as a coordinate sorted BAM without the temp SAM file.
+        - If in_bam is coordinate sorted, groups of references are tagged in parallel by `threads` processes and the
+        sorted parts are concatenated. No coordinate sort is needed.
+        - Otherwise, reads are tagged into a compressed BAM with multithreaded BGZF, then sorted once.
+
+        Args:
+            name_sorted_bam: if not None, out_bam is also sorted by name into this file.
+            classifier: if not None, classifier.add(read) is called for every read in the same pass.
+            gtf_dict: Gtf_dict of gtf_file. If None, it is loaded from gtf_file.
+        """
+        if gtf_dict is None:
+            gtf_dict = Gtf_dict(gtf_file)
+        temp_dir = f'{self.out_bam}_tag.temp'
+        check_mkdir(temp_dir)
+        temp_index = f'{temp_dir}/in.bam.bai'
+        try:
+            pysam.index(self.in_bam, temp_index)
+            is_sorted = True
+        except pysam.SamtoolsError:
+            self.add_tag_sorted.logger.warning(f'{self.in_bam} is not coordinate sorted.')
+            is_sorted = False
+
+        if is_sorted:
+            self.tag_regions(gtf_dict, temp_index, temp_dir, classifier)
+        else:
+            temp_bam = f'{temp_dir}/tagged.bam'
+            with pysam.AlignmentFile(self.in_bam, "rb", threads=self.threads) as original_bam:
+                with pysam.AlignmentFile(temp_bam, "wb", template=original_bam, threads=self.threads) as out:
+                    for read in original_bam:
+                        Samtools.tag_read(read, gtf_dict)
+                        if classifier is not None:
+                            classifier.add(read)
+                        out.write(read)
+            self.samtools_sort(temp_bam, self.out_bam, by='coord')
+        subprocess.check_call(f'rm -r {temp_dir}', shell=True)
+
+        if name_sorted_bam:
+            self.samtools_sort(self.out_bam, name_sorted_bam, by='name')
+
+    def get_regions(self, index_file):
+        return get_contig_groups(self.in_bam, self.threads, index_file)
+
+    @add_log
+    def tag_regions(self, gtf_dict, index_file, temp_dir, classifier=None):
+        regions = self.get_regions(index_file)
+        args_list = [(self.in_bam, index_file, region, f'{temp_dir}/{i}.bam') for i, region in enumerate(regions)]
+        if self.threads <= 1:
+            _init_tag_worker(gtf_dict, classifier)
+            results = [_tag_region(*args) for args in args_list]
+        else:
+            with Pool(self.threads, initializer=_init_tag_worker, initargs=(gtf_dict, classifier)) as pool:
+                results = pool.starmap(_tag_region, args_list)
+        if classifier is not None:
+            for counts in results:
+                classifier.add_counts(counts)
+
+        part_bams = [args[-1] for args in args_list]
+        if part_bams:
+            pysam.cat('-o', self.out_bam, *part_bams)
+        else:
+            # no reads
+            with pysam.AlignmentFile(self.in_bam, "rb") as original_bam:
+                pysam.AlignmentFile(self.out_bam, "wb", template=original_bam).close()
+
     @add_log
     def add_RG(self, barcodes):
         """
@@ -529,6 +632,36 @@ class Samtools():
         subprocess.check_call(cmd, shell=True)
 
 
+# gene_id:gene_name dict and read classifier of worker processes. Set once by the pool initializer.
+_worker_gtf_dict = None
+_worker_classifier = None
+
+
+def _init_tag_worker(gtf_dict, classifier):
+    global _worker_gtf_dict, _worker_classifier
+    _worker_gtf_dict = gtf_dict
+    _worker_classifier = classifier
+
+
+def _tag_region(in_bam, index_file, contigs, out_bam):
+    """
+    Tag reads of contigs in in_bam and write them to out_bam.
+    Returns:
+        classifier counts of these reads. None if there is no classifier.
+    """
+    with pysam.AlignmentFile(in_bam, "rb", index_filename=index_file) as original_bam:
+        with pysam.AlignmentFile(out_bam, "wb", template=original_bam) as out:
+            for contig in contigs:
+                for read in original_bam.fetch(contig):
+                    Samtools.tag_read(read, _worker_gtf_dict)
+                    if _worker_classifier is not None:
+                        _worker_classifier.add(read)
+                    out.write(read)
+    if _worker_classifier is not None:
+        return _worker_classifier.pop_counts()
+    return None
+
+
 def read_CID(CID_file):
     """
     return df_index, df_valid
@@ -538,13 +671,6 @@ def read_CID(CID_file):
     return df_index, df_valid
 
 
-def get_assay_text(assay):
-    """
-    add sinlge cell prefix
-    """
-    return 'Single-cell ' + assay
-
-
 def check_arg_not_none(args, arg_name):
     """
     check if args.arg_name is not None
@@ -598,5 +724,44 @@ class Test_utils(unittest.TestCase):
         self.assertEqual(gtf_dict['gene_id_not_exist'], 'gene_id_not_exist')
         fp.close()
 
+    def test_add_tag_sorted(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            gtf = f'{temp_dir}/genes.gtf'
+            with open(gtf, 'w') as fh:
+                fh.write('c1\tt\tgene\t1\t100\t.\t+\t.\tgene_id "G1"; gene_name "N1";\n')
+            header = pysam.AlignmentHeader.from_dict({
+                'HD': {'VN': '1.6', 'SO': 'coordinate'},
+                'SQ': [{'SN': f'c{i}', 'LN': 10000} for i in range(4)],
+            })
+            in_bam = f'{temp_dir}/in.bam'
+            names = []
+            with pysam.AlignmentFile(in_bam, 'wb', header=header) as fh:
+                for ref in [0, 1, 1, 3, 3, 3, -1]:
+                    read = pysam.AlignedSegment(header)
+                    read.query_name = f'BC{len(names)}_UMI{len(names)}_{len(names)}'
+                    read.query_sequence = 'ACGT'
+                    if ref >= 0:
+                        read.reference_id = ref
+                        read.reference_start = len(names) * 10
+                        read.cigarstring = '4M'
+                        read.set_tag('XT', 'G1')
+                    else:
+                        read.is_unmapped = True
+                    names.append(read.query_name)
+                    fh.write(read)
+
+            for threads in (1, 2):
+                out_bam = f'{temp_dir}/out{threads}.bam'
+                Samtools(in_bam, out_bam, threads=threads).add_tag_sorted(gtf)
+                with pysam.AlignmentFile(out_bam) as fh:
+                    reads = list(fh.fetch(until_eof=True))
+                self.assertEqual([read.query_name for read in reads], names)
+                self.assertEqual(reads[1].get_tag('CB'), 'BC1')
+                self.assertEqual(reads[1].get_tag('GN'), 'N1')
+                self.assertFalse(reads[-1].has_tag('GX'))
+                self.assertFalse(os.path.exists(f'{out_bam}_tag.temp'))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,60 @@
+"""
+Benchmark celescope CLI startup time and guard against import regressions.
+`celescope <assay> <step> --help` should not import any module in cli_registry.HEAVY_MODULES.
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+from celescope.tools.cli_registry import HEAVY_MODULES
+
+CODE = '''
+import sys
+from celescope.celescope import main
+try:
+    main(sys.argv[1:])
+except SystemExit:
+    pass
+sys.stderr.write(",".join(sorted(m for m in sys.modules if m.split(".")[0] in {heavy_modules})))
+'''
+
+
+def run_cli(cli_args):
+    """
+    Returns:
+        seconds, heavy modules imported
+    """
+    start = time.time()
+    result = subprocess.run(
+        [sys.executable, '-c', CODE.format(heavy_modules=HEAVY_MODULES)] + cli_args,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True,
+    )
+    heavy = sorted(set(m.split('.')[0] for m in result.stderr.strip().split(',') if m))
+    return time.time() - start, heavy
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark celescope CLI startup')
+    parser.add_argument('--commands', help='Semicolon separated celescope arguments.',
+        default='-h;rna -h;rna barcode -h;rna count -h;vdj consensus -h')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max_seconds', help='Fail if median time of a command exceeds this.', type=float,
+        default=1.0)
+    args = parser.parse_args()
+
+    failed = []
+    print('\t'.join(['command', 'median_seconds', 'heavy_modules']))
+    for command in args.commands.split(';'):
+        cli_args = command.split()
+        times = []
+        for _ in range(args.repeat):
+            seconds, heavy = run_cli(cli_args)
+            times.append(seconds)
+        median = statistics.median(times)
+        print('\t'.join([command, str(round(median, 3)), ','.join(heavy)]))
+        if heavy or median > args.max_seconds:
+            failed.append(command)
+    if failed:
+        sys.exit(f'Startup regression: {";".join(failed)}')
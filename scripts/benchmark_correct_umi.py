@@ -0,0 +1,54 @@
+"""
+Benchmark Count.correct_umi against Count.correct_umi_by_scan on synthetic high-UMI-count genes.
+"""
+import argparse
+import random
+import time
+
+from celescope.tools.count import Count
+
+
+def simulate_umi_dict(n_umi, umi_len, error_rate, seed):
+    """
+    Simulate {umi_seq: read_count} of one highly expressed gene.
+    True UMIs have 1-20 reads. Each read has a chance of one sequencing error in UMI.
+    """
+    rng = random.Random(seed)
+    umi_dict = {}
+    for _ in range(n_umi):
+        umi = ''.join(rng.choice('ACGT') for _ in range(umi_len))
+        for _ in range(rng.randint(1, 20)):
+            read_umi = umi
+            if rng.random() < error_rate:
+                pos = rng.randrange(umi_len)
+                read_umi = umi[:pos] + rng.choice('ACGT') + umi[pos + 1:]
+            umi_dict[read_umi] = umi_dict.get(read_umi, 0) + 1
+    return umi_dict
+
+
+def run_benchmark(func, umi_dict):
+    umi_dict = dict(umi_dict)
+    start = time.time()
+    result = func(umi_dict)
+    return time.time() - start, umi_dict, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark UMI correction')
+    parser.add_argument('--n_umi_list', help='Comma separated number of true UMIs per gene.', default='1000,2000,5000,10000')
+    parser.add_argument('--umi_len', help='UMI length.', type=int, default=12)
+    parser.add_argument('--error_rate', help='Probability of one UMI sequencing error per read.', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print('\t'.join(['n_true_umi', 'n_raw_umi', 'n_corrected_umi', 'scan_seconds', 'index_seconds', 'speedup']))
+    for n_umi in map(int, args.n_umi_list.split(',')):
+        raw_umi_dict = simulate_umi_dict(n_umi, args.umi_len, args.error_rate, args.seed)
+        scan_time, scan_dict, scan_result = run_benchmark(Count.correct_umi_by_scan, raw_umi_dict)
+        index_time, index_dict, index_result = run_benchmark(Count.correct_umi, raw_umi_dict)
+        if scan_dict != index_dict or scan_result != index_result:
+            raise ValueError(f'Different results with n_umi={n_umi}')
+        print('\t'.join(map(str, [
+            n_umi, len(raw_umi_dict), index_result[0],
+            round(scan_time, 3), round(index_time, 3), round(scan_time / index_time, 1),
+        ])))
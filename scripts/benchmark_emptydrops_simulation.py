@@ -0,0 +1,69 @@
+"""
+Benchmark simulate_multinomial_loglikelihoods against simulate_multinomial_loglikelihoods_batched.
+Simulated log likelihoods and ambient p-values are checked to be identical under the same seed.
+"""
+import argparse
+import time
+
+import numpy as np
+import scipy.stats as sp_stats
+
+import celescope.tools.emptydrop_cr.stats as cr_stats
+
+
+def simulate_input(n_feature, n_barcode, seed):
+    """
+    Returns:
+        profile_p: ambient profile
+        umis_per_bc: UMI counts of candidate barcodes, ranging from 500 to 20000
+        obs_loglk: observed log likelihoods. Half of the barcodes are from the ambient profile.
+    """
+    rng = np.random.RandomState(seed)
+    profile_p = rng.dirichlet(np.full(n_feature, 0.3))
+    profile_p = profile_p[profile_p > 0]
+    profile_p /= profile_p.sum()
+    umis_per_bc = np.exp(rng.uniform(np.log(500), np.log(20000), n_barcode)).astype(int)
+    obs_loglk = np.zeros(n_barcode)
+    cell_p = rng.dirichlet(np.full(len(profile_p), 0.3))
+    for i, n in enumerate(umis_per_bc):
+        p = profile_p if i % 2 == 0 else cell_p
+        counts = rng.multinomial(n, p)
+        obs_loglk[i] = sp_stats.multinomial.logpmf(counts, n, p=profile_p)
+    return profile_p, umis_per_bc, obs_loglk
+
+
+def run_benchmark(func, profile_p, umis_per_bc, obs_loglk, args, **kwargs):
+    np.random.seed(args.seed)
+    start = time.time()
+    distinct_n, sim_loglk = func(profile_p, umis_per_bc, num_sims=args.num_sims, **kwargs)
+    pvalues = cr_stats.compute_ambient_pvalues(umis_per_bc, obs_loglk, distinct_n, sim_loglk)
+    return time.time() - start, sim_loglk, pvalues
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark EmptyDrops multinomial simulation')
+    parser.add_argument('--n_feature', type=int, default=5000)
+    parser.add_argument('--n_barcode', type=int, default=2000)
+    parser.add_argument('--num_sims', type=int, default=1000)
+    parser.add_argument('--n_jobs_list', help='Comma separated number of processes.', default='1,4')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    profile_p, umis_per_bc, obs_loglk = simulate_input(args.n_feature, args.n_barcode, args.seed)
+    serial_time, serial_loglk, serial_pvalues = run_benchmark(
+        cr_stats.simulate_multinomial_loglikelihoods, profile_p, umis_per_bc, obs_loglk, args)
+
+    print('\t'.join(['method', 'n_jobs', 'seconds', 'speedup', 'identical_loglk', 'identical_pvalues']))
+    print('\t'.join(map(str, ['serial', 1, round(serial_time, 3), 1.0, True, True])))
+    for n_jobs in map(int, args.n_jobs_list.split(',')):
+        batched_time, batched_loglk, batched_pvalues = run_benchmark(
+            cr_stats.simulate_multinomial_loglikelihoods_batched, profile_p, umis_per_bc, obs_loglk, args,
+            n_jobs=n_jobs)
+        same_loglk = np.array_equal(serial_loglk, batched_loglk)
+        same_pvalues = np.array_equal(serial_pvalues, batched_pvalues)
+        print('\t'.join(map(str, [
+            'batched', n_jobs, round(batched_time, 3), round(serial_time / batched_time, 1),
+            same_loglk, same_pvalues,
+        ])))
+        if not (same_loglk and same_pvalues):
+            raise ValueError(f'Different results with n_jobs={n_jobs}')